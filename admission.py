@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+# coding=UTF-8
+# Title:       admission.py
+# Description: Measures the event loop lag and rejects requests while the application is overloaded.
+# Author       David Nellessen <david.nellessen@familo.net>
+# Date:        16.10.26
+# Note:
+# ==============================================================================
+
+# Import modules
+import logging
+import tornado.ioloop
+import metrics
+
+
+# Reasons for rejecting a request.
+EVENT_LOOP_LAG = 'event_loop_lag'
+NEXMO_BACKLOG = 'nexmo_backlog'
+
+
+class LagMonitor(object):
+    """
+    Measures how late the IOLoop runs a callback scheduled every 'interval'
+    seconds. Everything runs on the IOLoop, so this lag delays every request
+    in flight, e.g. when parsing a large batch of phone numbers or a slow
+    callback hogs the CPU. A blocked IOLoop is measured once it runs again.
+    """
+    def __init__(self, interval=0.1, io_loop=None):
+        self.interval = interval
+        self.io_loop = io_loop or tornado.ioloop.IOLoop.current()
+        self.lag = 0.0
+        self.max_lag = 0.0
+        self.expected = None
+        self.timeout = None
+
+    def start(self):
+        self.expected = self.io_loop.time() + self.interval
+        self.timeout = self.io_loop.call_at(self.expected, self.check)
+
+    def stop(self):
+        if self.timeout:
+            self.io_loop.remove_timeout(self.timeout)
+            self.timeout = None
+
+    def check(self):
+        self.lag = max(0.0, self.io_loop.time() - self.expected)
+        self.max_lag = max(self.max_lag, self.lag)
+        metrics.EVENT_LOOP_LAG.observe(self.lag)
+        self.start()
+
+    def stats(self):
+        return {'lag_ms': round(self.lag * 1000, 3),
+                'max_lag_ms': round(self.max_lag * 1000, 3)}
+
+
+class AdmissionControl(object):
+    """
+    Rejects new requests while the event loop lag measured by 'lag_monitor'
+    exceeds 'max_lag' seconds or more than 'max_pending_sends' requests to
+    Nexmo are in flight or waiting in the queue of the 'governor' (see
+    nexmoclient.SendGovernor). Rejecting at once keeps the requests in flight
+    from timing out too. A threshold of 0 disables the respective check.
+    """
+    def __init__(self, lag_monitor, governor, max_lag=0, max_pending_sends=0):
+        self.lag_monitor = lag_monitor
+        self.governor = governor
+        self.max_lag = max_lag
+        self.max_pending_sends = max_pending_sends
+        self.counters = {'admitted': 0, EVENT_LOOP_LAG: 0, NEXMO_BACKLOG: 0}
+
+    def check(self):
+        """
+        Returns None if a request is admitted or the reason for rejecting it.
+        """
+        if self.max_lag and self.lag_monitor.lag > self.max_lag:
+            reason = EVENT_LOOP_LAG
+        elif self.max_pending_sends and self.governor.in_flight + len(self.governor.queue) > self.max_pending_sends:
+            reason = NEXMO_BACKLOG
+        else:
+            self.counters['admitted'] += 1
+            return None
+        if not self.counters[reason] % 100:
+            logging.warning('Overloaded ({}), rejecting requests'.format(reason))
+        self.counters[reason] += 1
+        return reason
+
+    def stats(self):
+        stats = dict(self.counters)
+        stats.update(self.lag_monitor.stats())
+        return stats
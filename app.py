@@ -8,25 +8,50 @@
 # ==============================================================================
 
 # Import modules
+import errno
 import logging
 from urlparse import urlparse
 import os
+import random
+import signal
+import sys
+import time
+import tornado.httpserver
 import tornado.ioloop
 import tornado.locale
+import tornado.netutil
+import tornado.process
 import tornado.web
+from tornado import gen
 from tornado.options import define, options
-import pygeoip
-import toredis
+import admission
+import dlr
+import geolocation
 import handler
+import idempotency
+import limiter
+import metrics
 import nexmoclient
+import phonecache
+import profiling
+import redispool
+import sendqueue
 import configuration
-from functools import partial
 
 
 
 # Define command line parameters.
 define('port', default=int(os.environ.get('PORT', 8888)), type=int, help='Run this application on the given port, e.g. 80 (default 8888)')
 define('localhostonly', default=bool(os.environ.get('LOCALHOSTONLY', False)), type=bool, help='Application listens on localhost only (default False)')
+define('processes', default=int(os.environ.get('PROCESSES', 1)), type=int, help='Number of server processes sharing the port, 0 starts one per CPU (default 1)')
+define('metrics_path', default=str(os.environ.get('METRICS_PATH', '/metrics')), type=str, help='Path of the Prometheus metrics, empty disables them (default /metrics)')
+define('max_event_loop_lag', default=float(os.environ.get('MAX_EVENT_LOOP_LAG', 0)), type=float, help='Seconds of event loop lag above which message and validation requests are rejected with 503, 0 disables it (default 0)')
+define('max_pending_sends', default=int(os.environ.get('MAX_PENDING_SENDS', 0)), type=int, help='Number of Nexmo requests in flight or waiting above which message and validation requests are rejected with 503, 0 disables it (default 0)')
+define('shed_retry_after', default=int(os.environ.get('SHED_RETRY_AFTER', 1)), type=int, help='Seconds in the Retry-After header of rejected requests (default 1)')
+define('server_timing', default=bool(os.environ.get('SERVER_TIMING', False)), type=bool, help='Report the time spent in the stages of a request in the Server-Timing header (default False)')
+define('profile_sample_rate', default=float(os.environ.get('PROFILE_SAMPLE_RATE', 0)), type=float, help='Share of requests profiled with cProfile, can be changed at /admin/profile (default 0)')
+define('admin_token', default=str(os.environ.get('ADMIN_TOKEN', '')), type=str, help='Token in the X-Admin-Token header of requests to the admin routes, empty disables them')
+define('shutdown_timeout', default=float(os.environ.get('SHUTDOWN_TIMEOUT', 30)), type=float, help='Seconds to wait for requests in flight on SIGTERM before exiting (default 30)')
 define('nexmo_api_key', default=str(os.environ.get('NEXMO_API_KEY', '')), type=str, help='Your Nexmo API key')
 define('nexmo_api_secret', default=str(os.environ.get('NEXMO_API_SECRET', '')), type=str, help='Your Nexmo API secret')
 define('nexmo_domain', default=str(os.environ.get('NEXMO_DOMAIN', 'rest.nexmo.com')), type=str, help='Nexmo API domain (default rest.nexmo.com)')
@@ -40,12 +65,50 @@ define('sender', default=str(os.environ.get('SENDER', '')), type=str, help='The
 define('request_path', default=str(os.environ.get('REQUEST_PATH', '/message/')), type=str, help='The path for the default message handler (default /message/)')
 define('limit_amount', default=int(os.environ.get('LIMIT_AMOUNT', 10)), type=int, help='The amount of requests per user per handler allowed (default 10)')
 define('limit_expires', default=int(os.environ.get('LIMIT_EXPIRES', 3600)), type=int, help='The time in seconds after that the limit defined by limit_amount expires')
+define('limit_strategy', default=str(os.environ.get('LIMIT_STRATEGY', 'fixed_window')), type=str, help='How requests are limited: fixed_window or gcra (default fixed_window)')
+define('validation_batch_unit', default=int(os.environ.get('VALIDATION_BATCH_UNIT', 100)), type=int, help='Numbers of a batch validation request counting as one request for limit_amount (default 100)')
+define('validation_batch_max_size', default=int(os.environ.get('VALIDATION_BATCH_MAX_SIZE', 1000)), type=int, help='Maximum number of phone numbers per batch validation request, at most limit_amount times validation_batch_unit (default 1000)')
+define('bulk_max_size', default=int(os.environ.get('BULK_MAX_SIZE', 1000)), type=int, help='Maximum number of receivers per bulk message request (default 1000)')
+define('bulk_api_key', default=str(os.environ.get('BULK_API_KEY', '')), type=str, help='Key in the X-Api-Key header of bulk message requests, empty disables them')
+define('bulk_limit_amount', default=int(os.environ.get('BULK_LIMIT_AMOUNT', 10000)), type=int, help='The amount of bulk message receivers per user per handler allowed (default 10000)')
+define('bulk_limit_expires', default=int(os.environ.get('BULK_LIMIT_EXPIRES', 3600)), type=int, help='The time in seconds after that the limit defined by bulk_limit_amount expires (default 3600)')
+define('nexmo_send_concurrency', default=int(os.environ.get('NEXMO_SEND_CONCURRENCY', 10)), type=int, help='Maximum number of concurrent Nexmo requests of a bulk message request (default 10)')
+define('nexmo_send_rate', default=int(os.environ.get('NEXMO_SEND_RATE', 30)), type=int, help='Maximum number of messages per second sent to Nexmo, should match your account limit, 0 disables pacing (default 30)')
+define('nexmo_max_in_flight', default=int(os.environ.get('NEXMO_MAX_IN_FLIGHT', 20)), type=int, help='Maximum number of concurrent requests to Nexmo (default 20)')
+define('nexmo_retry_attempts', default=int(os.environ.get('NEXMO_RETRY_ATTEMPTS', 3)), type=int, help='Maximum number of attempts to send a message if Nexmo fails temporarily (default 3)')
+define('nexmo_retry_deadline', default=int(os.environ.get('NEXMO_RETRY_DEADLINE', 10)), type=int, help='Seconds after that a message is not retried anymore (default 10)')
+define('nexmo_http_client', default=str(os.environ.get('NEXMO_HTTP_CLIENT', 'auto')), type=str, help='HTTP client for Nexmo requests: curl (keeps connections alive, requires pycurl), simple or auto (curl if installed) (default auto)')
+define('nexmo_connect_timeout', default=float(os.environ.get('NEXMO_CONNECT_TIMEOUT', 5)), type=float, help='Seconds to wait for a connection to Nexmo (default 5)')
+define('nexmo_request_timeout', default=float(os.environ.get('NEXMO_REQUEST_TIMEOUT', 20)), type=float, help='Seconds to wait for a request to Nexmo to complete (default 20)')
+define('nexmo_breaker_error_rate', default=float(os.environ.get('NEXMO_BREAKER_ERROR_RATE', 0.5)), type=float, help='Share of failed Nexmo requests within 30 seconds that stops sending for nexmo_breaker_reset_timeout seconds, 0 disables it (default 0.5)')
+define('nexmo_breaker_latency', default=float(os.environ.get('NEXMO_BREAKER_LATENCY', 5)), type=float, help='Seconds after that a Nexmo request is slow, sending stops if half of the requests within 30 seconds are slow, 0 disables it (default 5)')
+define('nexmo_breaker_reset_timeout', default=float(os.environ.get('NEXMO_BREAKER_RESET_TIMEOUT', 10)), type=float, help='Seconds sending to Nexmo stops before it is probed again (default 10)')
+define('idempotency_window', default=int(os.environ.get('IDEMPOTENCY_WINDOW', 0)), type=int, help='Seconds duplicates of a message request get the recorded response instead of sending again, 0 disables it (default 0)')
+define('idempotency_pending_ttl', default=int(os.environ.get('IDEMPOTENCY_PENDING_TTL', 0)), type=int, help='Seconds a message request in progress blocks its duplicates, 0 derives it from nexmo_retry_deadline and nexmo_request_timeout (default 0)')
+define('dlr_flush_size', default=int(os.environ.get('DLR_FLUSH_SIZE', 500)), type=int, help='Number of buffered delivery receipts written to Redis at once (default 500)')
+define('dlr_flush_interval', default=float(os.environ.get('DLR_FLUSH_INTERVAL', 1)), type=float, help='Seconds between writes of buffered delivery receipts to Redis (default 1)')
+define('dlr_ttl', default=int(os.environ.get('DLR_TTL', 86400)), type=int, help='Seconds the delivery receipt of a message is kept (default 86400)')
+define('queue_mode', default=bool(os.environ.get('QUEUE_MODE', False)), type=bool, help='Queue messages in Redis and respond with 202 at once, messages are sent by worker.py (default False)')
+define('queue_job_ttl', default=int(os.environ.get('QUEUE_JOB_TTL', 86400)), type=int, help='Seconds the state of a queued message is kept (default 86400)')
 define('guess_country', default=bool(os.environ.get('GUESS_COUNTRY', '')), type=bool, help='If True autocompletes non-internation phone numbers according to the browser locale (default True)')
 define('default_country', default=str(os.environ.get('DEFAULT_COUNTRY', 'DE')), type=str, help='The default country for when getting browser locale fails (default DE)')
+define('limiter_backend', default=str(os.environ.get('LIMITER_BACKEND', 'redis')), type=str, help='Where to count requests for limiting them: redis or memory (single process only) (default redis)')
+define('limit_memory_size', default=int(os.environ.get('LIMIT_MEMORY_SIZE', 1000000)), type=int, help='Maximum number of counters kept by the memory limiter backend (default 1000000)')
+define('limit_key_layout', default=str(os.environ.get('LIMIT_KEY_LAYOUT', 'plain')), type=str, help='How the redis limiter backend stores counters: plain (one key per client) or compact (hashes per window) (default plain)')
+define('limit_compact_shards', default=int(os.environ.get('LIMIT_COMPACT_SHARDS', 4096)), type=int, help='Number of Redis hashes per handler and window of the compact key layout, see the README for sizing (default 4096)')
+define('limiter_fail_open', default=bool(os.environ.get('LIMITER_FAIL_OPEN', False)), type=bool, help='Allow requests if the redis limiter backend can not count them instead of rejecting them with the error limiter_unavailable (default False)')
+define('limit_cache_size', default=int(os.environ.get('LIMIT_CACHE_SIZE', 10000)), type=int, help='Number of clients over their limit remembered locally to spare Redis calls, 0 disables it (default 10000)')
+define('geoip_engine', default=str(os.environ.get('GEOIP_ENGINE', 'pygeoip')), type=str, help='GeoIP lookup engine: pygeoip or ranges (compiled sorted arrays, faster but slower to load) (default pygeoip)')
+define('geoip_path', default=str(os.environ.get('GEOIP_PATH', os.path.dirname(os.path.abspath(__file__)))), type=str, help='Directory containing GeoIP.dat and GeoIPv6.dat (default the directory of app.py)')
+define('geoip_mode', default=str(os.environ.get('GEOIP_MODE', 'memory')), type=str, help='How GeoIP data is loaded: memory (private copy per process) or mmap (read-only, shared by all processes) (default memory)')
+define('geoip_cache_size', default=int(os.environ.get('GEOIP_CACHE_SIZE', 10000)), type=int, help='Number of IP addresses whose country is cached, 0 disables it (default 10000)')
+define('phone_cache_size', default=int(os.environ.get('PHONE_CACHE_SIZE', 10000)), type=int, help='Number of parsed phone numbers cached, 0 disables it (default 10000)')
 define('redis_host', default=str(os.environ.get('REDIS_HOST', 'localhost')), type=str, help='Connect with Redis using this port (default localhost)')
 define('redis_port', default=int(os.environ.get('REDIS_PORT', 6379)), type=int, help='Connect with Redis using this port (default 6379)')
 define('redis_password', default=str(os.environ.get('REDIS_PASSWORD', '')), type=str, help='Redis password')
 define('redis_db', default=int(os.environ.get('REDIS_DB', 0)), type=int, help='Work on this Redis DB (default 0)')
+define('redis_pool_size', default=int(os.environ.get('REDIS_POOL_SIZE', 4)), type=int, help='Number of Redis connections (default 4)')
+define('redis_health_check_interval', default=int(os.environ.get('REDIS_HEALTH_CHECK_INTERVAL', 5)), type=int, help='Seconds between PINGs to detect dead Redis connections, 0 disables it (default 5)')
 
 
 
@@ -58,32 +121,68 @@ class NexmoApplication(tornado.web.Application):
     """
     def __init__(self, api_key, api_secret, domain='rest.nexmo.com', endpoint='sms/json',
                  ssl=False, long_virtual_number=None, dlr_url=None, development_mode=False,
-                 message=None, sender=None, request_path='/message/', limit_amount=10, limit_expires=3600, guess_country=True,
-                 default_country='DE', redis_host='localhost', redis_port=6379, redis_password='', redis_db=0,
-                 callback=None, io_loop=None):
+                 message=None, sender=None, request_path='/message/', limit_amount=10, limit_expires=3600, limit_strategy='fixed_window',
+                 validation_batch_unit=100, validation_batch_max_size=1000, bulk_max_size=1000,
+                 bulk_api_key='', bulk_limit_amount=10000, bulk_limit_expires=3600,
+                 nexmo_send_concurrency=10, nexmo_send_rate=30, nexmo_max_in_flight=20,
+                 nexmo_retry_attempts=3, nexmo_retry_deadline=10, nexmo_http_client='auto',
+                 nexmo_connect_timeout=5, nexmo_request_timeout=20, nexmo_breaker_error_rate=0.5,
+                 nexmo_breaker_latency=5, nexmo_breaker_reset_timeout=10, idempotency_window=0, idempotency_pending_ttl=0, dlr_flush_size=500,
+                 dlr_flush_interval=1, dlr_ttl=86400, queue_mode=False, queue_job_ttl=86400,
+                 guess_country=True, default_country='DE', limiter_backend='redis', limit_memory_size=1000000,
+                 limit_key_layout='plain', limit_compact_shards=4096, limit_cache_size=10000,
+                 limiter_fail_open=False, geoip_engine='pygeoip',
+                 geoip_path='.', geoip_mode='memory', geoip_cache_size=10000, geo_databases=None, phone_cache_size=10000, redis_host='localhost', redis_port=6379, redis_password='', redis_db=0,
+                 redis_pool_size=4, redis_health_check_interval=5, metrics_path='/metrics', max_event_loop_lag=0,
+                 max_pending_sends=0, shed_retry_after=1, server_timing=False,
+                 profile_sample_rate=0, admin_token='', callback=None, io_loop=None):
         # Handlers defining the URL scheme.
         handlers = [
             (r"/validate_number/", type('ConfiguredNumberValidationHandler', (handler.NumberValidationHandler,),
                                         {'limit_amount': limit_amount, 'limit_expires': limit_expires,
+                                         'limit_strategy': limit_strategy,
+                                         'batch_unit': validation_batch_unit,
+                                         'batch_max_size': validation_batch_max_size,
                                          'guess_country': guess_country, 'default_country': default_country})),
-        ] + self.parse_handler_from_config(limit_amount, limit_expires, guess_country, default_country)
+        ] + self.parse_handler_from_config(limit_amount, limit_expires, limit_strategy, bulk_max_size,
+                                           bulk_limit_amount, bulk_limit_expires, guess_country, default_country)
+        if queue_mode:
+            handlers += [(r"/job/([0-9a-f]{32})", handler.JobStatusHandler)]
         if dlr_url:
-            handlers += [(urlparse(dlr_url).path, handler.DLRHandler)]
+            handlers += [(urlparse(dlr_url).path, handler.DLRHandler),
+                         (r"/status/([0-9A-Za-z-]+)", handler.MessageStatusHandler)]
+        if metrics_path:
+            handlers += [(metrics_path, handler.MetricsHandler)]
+        if admin_token:
+            handlers += [(r"/admin/profile", handler.ProfileHandler)]
         if message and sender and request_path and not request_path in configuration.SIMPLE_MESSAGE_HANDLERS:
             handlers += [self.get_default_handler(message, sender, request_path, limit_amount, limit_expires,
+                                                  limit_strategy, bulk_max_size, bulk_limit_amount, bulk_limit_expires,
                                                   guess_country, default_country)]
         logging.debug('Registered handler: {}'.format(handlers))
 
-        # Setup Nexmo client.
+        # Setup Nexmo client sharing the cache of parsed phone numbers with the handlers.
+        self.phone_cache = phonecache.PhoneNumberCache(phone_cache_size)
         self.nexmo_client = nexmoclient.AsyncNexmoClient(api_key, api_secret, domain, endpoint, ssl,
-                                                         long_virtual_number, dlr_url, development_mode)
+                                                         long_virtual_number, dlr_url, development_mode,
+                                                         self.phone_cache, nexmo_send_concurrency, nexmo_send_rate,
+                                                         nexmo_max_in_flight,
+                                                         nexmoclient.RetryPolicy(nexmo_retry_attempts,
+                                                                                 nexmo_retry_deadline),
+                                                         nexmo_http_client, nexmo_connect_timeout,
+                                                         nexmo_request_timeout,
+                                                         nexmoclient.CircuitBreaker(
+                                                             nexmo_breaker_error_rate, nexmo_breaker_latency,
+                                                             reset_timeout=nexmo_breaker_reset_timeout))
 
-        # Load GeoIP database.
-        self.geo_ip = pygeoip.GeoIP('GeoIP.dat', pygeoip.MEMORY_CACHE)
-        self.geo_ipv6 = pygeoip.GeoIP('GeoIPv6.dat', pygeoip.MEMORY_CACHE)
+        # Load GeoIP database unless it was loaded before, e.g. once before forking.
+        self.geo_ip, self.geo_ipv6 = geo_databases or load_geo_databases(geoip_path, geoip_engine, geoip_mode)
+        self.geo_resolver = geolocation.GeoIPResolver(self.geo_ip, self.geo_ipv6, geoip_cache_size)
 
         # Configure application settings.
-        settings = {'gzip': True}
+        settings = {'gzip': True, 'server_timing': server_timing, 'admin_token': admin_token,
+                    'bulk_api_key': bulk_api_key,
+                    'shed_retry_after': shed_retry_after}
 
         # Call super constructor to initiate a Tornado Application.
         tornado.web.Application.__init__(self, handlers, **settings)
@@ -91,32 +190,70 @@ class NexmoApplication(tornado.web.Application):
         # Set members for later access.
         self.limit_amount = limit_amount
         self.limit_expires = limit_expires
+        self.in_flight = 0
+        self.profiler = profiling.RequestProfiler(profile_sample_rate)
+        if limiter_backend == 'memory':
+            self.limiter = limiter.MemoryLimiter(limit_memory_size)
+        else:
+            self.limiter = limiter.RedisLimiter(self, limit_cache_size, limit_key_layout, limit_compact_shards,
+                                                limiter_fail_open)
+        self.send_queue = sendqueue.SendQueue(self, queue_job_ttl) if queue_mode else None
+        # A claimed idempotency key must not expire while its message is still being sent.
+        if idempotency_window:
+            pending_ttl = idempotency_pending_ttl or idempotency.IdempotencyStore.get_pending_ttl(self.nexmo_client)
+            self.idempotency = idempotency.IdempotencyStore(self, idempotency_window, pending_ttl)
+        else:
+            self.idempotency = None
 
-        # Create db connection.
-        self.redis_host = redis_host
-        self.redis_port = redis_port
-        self.redis_password = redis_password
-        self.redis_db = redis_db
-        self.io_loop = io_loop
-        self.redis = toredis.Client(io_loop=io_loop)
-        self.redis_connect(redis_host, redis_port, redis_password, redis_db, callback=callback, io_loop=io_loop)
-
-
-    def redis_connect(self, redis_host, redis_port, redis_password, redis_db, callback=None, io_loop=None):
-        self.redis = toredis.Client(io_loop=io_loop)
-        redis_select = partial(self.redis.select, index=redis_db, callback=partial(callback, self))
-        if redis_password:
-            redis_auth = partial(self.redis.auth, password=redis_password, callback=redis_select)
+        # Create db connections. The memory limiter backend does not need Redis
+        # unless messages are queued, delivery receipts are received or
+        # idempotency keys are recorded.
+        self.io_loop = io_loop or tornado.ioloop.IOLoop.current()
+        self.lag_monitor = admission.LagMonitor(io_loop=self.io_loop)
+        self.lag_monitor.start()
+        self.admission = admission.AdmissionControl(self.lag_monitor, self.nexmo_client.governor,
+                                                    max_event_loop_lag, max_pending_sends)
+        if dlr_url:
+            self.receipts = dlr.ReceiptBuffer(self, dlr_flush_size, dlr_flush_interval, dlr_ttl, io_loop=self.io_loop)
+            self.receipts.start()
+        else:
+            self.receipts = None
+        def on_ready(status):
+            if callback:
+                callback(self, status)
+        if limiter_backend == 'memory' and not queue_mode and not dlr_url and not idempotency_window:
+            self.redis_pool = None
+            self.io_loop.add_callback(on_ready, None)
         else:
-            redis_auth = redis_select
-        self.redis.connect(host=redis_host, port=redis_port, callback=redis_auth)
+            self.redis_pool = redispool.RedisPool(redis_host, redis_port, redis_password, redis_db,
+                                                  size=redis_pool_size,
+                                                  health_check_interval=redis_health_check_interval,
+                                                  io_loop=self.io_loop)
+            self.redis_pool.connect(callback=on_ready)
 
 
-    def redis_reconnect(self, callback=None):
-        self.redis_connect(self.redis_host, self.redis_port, self.redis_password, self.redis_db, callback, self.io_loop)
+    def log_request(self, handler):
+        """
+        Logs and counts a finished request.
+        """
+        super(NexmoApplication, self).log_request(handler)
+        name = type(handler).__name__
+        metrics.REQUESTS.labels(name, handler.get_status()).inc()
+        metrics.REQUEST_DURATION.labels(name).observe(handler.request.request_time())
 
 
-    def parse_handler_from_config(self, limit_amount, limit_expires, guess_country, default_country):
+    @property
+    def redis(self):
+        """
+        A ready Redis connection of the pool.
+        """
+        if not self.redis_pool:
+            raise redispool.RedisUnavailableError('Redis is not configured')
+        return self.redis_pool.get()
+
+
+    def parse_handler_from_config(self, limit_amount, limit_expires, limit_strategy, bulk_max_size,
+                                  bulk_limit_amount, bulk_limit_expires, guess_country, default_country):
         handlers = []
         conf = configuration.SIMPLE_MESSAGE_HANDLERS
         for (k, v) in conf.iteritems():
@@ -124,19 +261,142 @@ class NexmoApplication(tornado.web.Application):
                              (handler.SimpleMessageHandler,),
                              {'message': v['message'], 'sender': v['sender'],
                               'limit_amount': limit_amount, 'limit_expires': limit_expires,
+                              'limit_strategy': v.get('limit_strategy', limit_strategy),
+                              'limit_policy': configuration.LIMIT_POLICIES.get(k),
+                              'bulk_max_size': bulk_max_size,
+                              'bulk_limit_amount': bulk_limit_amount, 'bulk_limit_expires': bulk_limit_expires,
                               'guess_country': guess_country, 'default_country': default_country})
             handlers.append((k, v['type']))
         return handlers
 
-    def get_default_handler(self, message, sender, path, limit_amount, limit_expires, guess_country, default_country):
+    def get_default_handler(self, message, sender, path, limit_amount, limit_expires, limit_strategy, bulk_max_size,
+                            bulk_limit_amount, bulk_limit_expires, guess_country, default_country):
             return (path, type('DefaultMessageHandler',
                                            (handler.SimpleMessageHandler,),
                                            {'message': message, 'sender': sender,
                                             'limit_amount': limit_amount, 'limit_expires': limit_expires,
+                                            'limit_strategy': limit_strategy,
+                                            'limit_policy': configuration.LIMIT_POLICIES.get(path),
+                                            'bulk_max_size': bulk_max_size,
+                                            'bulk_limit_amount': bulk_limit_amount,
+                                            'bulk_limit_expires': bulk_limit_expires,
                                             'guess_country': guess_country, 'default_country': default_country}))
 
 
 
+def load_geo_databases(path, engine, mode):
+    """
+    Loads the GeoIP databases and logs the time it took.
+    """
+    start = time.time()
+    databases = geolocation.load_databases(path, engine, mode)
+    logging.info('Loaded GeoIP databases from {} ({} engine, {} mode) in {:.1f}ms'.format(
+        path, engine, mode, (time.time() - start) * 1000))
+    return databases
+
+
+def fork_workers(processes, sockets=(), max_restarts=100):
+    """
+    Forks 'processes' worker processes and returns the number of the worker
+    in each of them. The parent process never returns: it stops the workers
+    with SIGTERM when it gets SIGTERM or SIGINT, restarts workers that
+    crashed and exits when all workers exited. The listening 'sockets' shared by the workers are
+    closed in the parent when it is stopped, so that no connections are
+    accepted once the workers stopped accepting.
+
+    This is like tornado.process.fork_processes() except that the parent
+    knows its workers to pass on signals, which is needed for a graceful
+    shutdown.
+    """
+    children = {}
+    stopping = []
+
+    def start_worker(number):
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            # Ctrl-C signals the whole process group, the parent passes it on as SIGTERM.
+            signal.signal(signal.SIGINT, signal.SIG_IGN)
+            # Do not share the random state, e.g. for retry jitter, with the other workers.
+            random.seed()
+            return number
+        children[pid] = number
+        return None
+
+    for number in range(processes):
+        if start_worker(number) is not None:
+            return number
+
+    def forward(signum, frame):
+        stopping.append(signum)
+        for sock in sockets:
+            sock.close()
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+    signal.signal(signal.SIGTERM, forward)
+    signal.signal(signal.SIGINT, forward)
+
+    logging.info('Started {} worker processes'.format(processes))
+    restarts = 0
+    while children:
+        try:
+            pid, status = os.wait()
+        except OSError as exc:
+            if exc.errno == errno.EINTR:
+                continue
+            raise
+        number = children.pop(pid, None)
+        if number is None:
+            continue
+        if os.WIFSIGNALED(status):
+            logging.warning('Worker {} (pid {}) killed by signal {}'.format(number, pid, os.WTERMSIG(status)))
+        elif os.WEXITSTATUS(status) != 0:
+            logging.warning('Worker {} (pid {}) exited with status {}'.format(number, pid, os.WEXITSTATUS(status)))
+        else:
+            logging.info('Worker {} (pid {}) exited'.format(number, pid))
+            continue
+        if stopping:
+            continue
+        restarts += 1
+        if restarts > max_restarts:
+            logging.error('Too many worker restarts, giving up')
+            forward(signal.SIGTERM, None)
+            continue
+        if start_worker(number) is not None:
+            return number
+    sys.exit(0)
+
+
+def start_server(app, sockets):
+    """
+    Starts an HTTPServer for 'app' accepting connections on the listening
+    'sockets', which may have been bound before forking.
+    """
+    server = tornado.httpserver.HTTPServer(app, xheaders=True)
+    server.add_sockets(sockets)
+    return server
+
+
+@gen.coroutine
+def shutdown(server, app, timeout):
+    """
+    Stops 'server' accepting connections, waits up to 'timeout' seconds for
+    the requests in flight of 'app' and writes buffered delivery receipts.
+    """
+    if server:
+        server.stop()
+    logging.info('Shutting down, waiting for {} requests in flight'.format(app.in_flight))
+    deadline = time.time() + timeout
+    while app.in_flight > 0 and time.time() < deadline:
+        yield gen.sleep(0.05)
+    if app.in_flight > 0:
+        logging.warning('Shutdown timeout exceeded with {} requests in flight'.format(app.in_flight))
+    if app.receipts:
+        app.receipts.stop()
+        yield app.receipts.flush()
 
 
 def main():
@@ -148,6 +408,15 @@ def main():
     tornado.options.parse_command_line()
     port = tornado.options.options.port
     localhostonly = tornado.options.options.localhostonly
+    processes = tornado.options.options.processes
+    shutdown_timeout = tornado.options.options.shutdown_timeout
+    metrics_path = tornado.options.options.metrics_path
+    max_event_loop_lag = tornado.options.options.max_event_loop_lag
+    max_pending_sends = tornado.options.options.max_pending_sends
+    shed_retry_after = tornado.options.options.shed_retry_after
+    server_timing = tornado.options.options.server_timing
+    profile_sample_rate = tornado.options.options.profile_sample_rate
+    admin_token = tornado.options.options.admin_token
     nexmo_api_key = tornado.options.options.nexmo_api_key
     nexmo_api_secret = tornado.options.options.nexmo_api_secret
     nexmo_domain = tornado.options.options.nexmo_domain
@@ -155,24 +424,126 @@ def main():
     nexmo_ssl = tornado.options.options.nexmo_ssl
     nexmo_long_virtual_number = tornado.options.options.nexmo_long_virtual_number
     nexmo_dlr_url = tornado.options.options.nexmo_dlr_url
-    if nexmo_dlr_url:
-        logging.error('DLR not yet implemented')
-        return
     development_mode = tornado.options.options.development_mode
     message = tornado.options.options.message
     sender = tornado.options.options.sender
     request_path = tornado.options.options.request_path
     limit_amount = tornado.options.options.limit_amount
     limit_expires = tornado.options.options.limit_expires
+    limit_strategy = tornado.options.options.limit_strategy
+    validation_batch_unit = tornado.options.options.validation_batch_unit
+    validation_batch_max_size = tornado.options.options.validation_batch_max_size
+    bulk_max_size = tornado.options.options.bulk_max_size
+    bulk_api_key = tornado.options.options.bulk_api_key
+    bulk_limit_amount = tornado.options.options.bulk_limit_amount
+    bulk_limit_expires = tornado.options.options.bulk_limit_expires
+    nexmo_send_concurrency = tornado.options.options.nexmo_send_concurrency
+    nexmo_send_rate = tornado.options.options.nexmo_send_rate
+    nexmo_max_in_flight = tornado.options.options.nexmo_max_in_flight
+    nexmo_retry_attempts = tornado.options.options.nexmo_retry_attempts
+    nexmo_retry_deadline = tornado.options.options.nexmo_retry_deadline
+    nexmo_http_client = tornado.options.options.nexmo_http_client
+    nexmo_connect_timeout = tornado.options.options.nexmo_connect_timeout
+    nexmo_request_timeout = tornado.options.options.nexmo_request_timeout
+    nexmo_breaker_error_rate = tornado.options.options.nexmo_breaker_error_rate
+    nexmo_breaker_latency = tornado.options.options.nexmo_breaker_latency
+    nexmo_breaker_reset_timeout = tornado.options.options.nexmo_breaker_reset_timeout
+    idempotency_window = tornado.options.options.idempotency_window
+    idempotency_pending_ttl = tornado.options.options.idempotency_pending_ttl
+    dlr_flush_size = tornado.options.options.dlr_flush_size
+    dlr_flush_interval = tornado.options.options.dlr_flush_interval
+    dlr_ttl = tornado.options.options.dlr_ttl
+    queue_mode = tornado.options.options.queue_mode
+    queue_job_ttl = tornado.options.options.queue_job_ttl
     guess_country = tornado.options.options.guess_country
     default_country = tornado.options.options.default_country
+    limiter_backend = tornado.options.options.limiter_backend
+    limit_memory_size = tornado.options.options.limit_memory_size
+    limit_key_layout = tornado.options.options.limit_key_layout
+    limit_compact_shards = tornado.options.options.limit_compact_shards
+    limit_cache_size = tornado.options.options.limit_cache_size
+    limiter_fail_open = tornado.options.options.limiter_fail_open
+    geoip_engine = tornado.options.options.geoip_engine
+    geoip_path = tornado.options.options.geoip_path
+    geoip_mode = tornado.options.options.geoip_mode
+    geoip_cache_size = tornado.options.options.geoip_cache_size
+    phone_cache_size = tornado.options.options.phone_cache_size
     redis_host = tornado.options.options.redis_host
     redis_port = tornado.options.options.redis_port
     redis_password = tornado.options.options.redis_password
     redis_db = tornado.options.options.redis_db
+    redis_pool_size = tornado.options.options.redis_pool_size
+    redis_health_check_interval = tornado.options.options.redis_health_check_interval
     if (message and (not sender or not request_path)) or (sender and (not message or not request_path)):
         logging.error('You must specify message AND sender AND request_path')
         return
+    if nexmo_retry_attempts < 1:
+        logging.error('nexmo_retry_attempts must be at least 1')
+        return
+    if nexmo_send_rate < 0 or nexmo_max_in_flight < 1:
+        logging.error('nexmo_send_rate must not be negative and nexmo_max_in_flight must be at least 1')
+        return
+    if nexmo_http_client not in nexmoclient.HTTP_CLIENTS:
+        logging.error('nexmo_http_client must be one of: {}'.format(', '.join(nexmoclient.HTTP_CLIENTS)))
+        return
+    if nexmo_connect_timeout <= 0 or nexmo_request_timeout <= 0:
+        logging.error('nexmo_connect_timeout and nexmo_request_timeout must be positive')
+        return
+    if not 0 <= nexmo_breaker_error_rate <= 1 or nexmo_breaker_latency < 0 or nexmo_breaker_reset_timeout <= 0:
+        logging.error('nexmo_breaker_error_rate must be between 0 and 1, nexmo_breaker_latency must not be negative '
+                      'and nexmo_breaker_reset_timeout must be positive')
+        return
+    if idempotency_window < 0 or idempotency_pending_ttl < 0:
+        logging.error('idempotency_window and idempotency_pending_ttl must not be negative')
+        return
+    if dlr_flush_size < 1 or dlr_flush_interval <= 0:
+        logging.error('dlr_flush_size must be at least 1 and dlr_flush_interval must be positive')
+        return
+    if validation_batch_unit < 1:
+        logging.error('validation_batch_unit must be at least 1')
+        return
+    if limit_amount and validation_batch_max_size > limit_amount * validation_batch_unit:
+        # Such batches would always be rejected by the limitation.
+        logging.error('validation_batch_max_size must not exceed limit_amount times validation_batch_unit')
+        return
+    if limit_strategy not in limiter.STRATEGIES:
+        logging.error('limit_strategy must be one of: {}'.format(', '.join(limiter.STRATEGIES)))
+        return
+    for path, policy in configuration.LIMIT_POLICIES.items():
+        try:
+            limiter.validate_policy(policy)
+        except ValueError as exc:
+            logging.error('Invalid limit policy for {}: {}'.format(path, exc))
+            return
+    if limiter_backend not in limiter.BACKENDS:
+        logging.error('limiter_backend must be one of: {}'.format(', '.join(sorted(limiter.BACKENDS))))
+        return
+    if limit_key_layout not in limiter.KEY_LAYOUTS:
+        logging.error('limit_key_layout must be one of: {}'.format(', '.join(limiter.KEY_LAYOUTS)))
+        return
+    if limit_compact_shards < 1:
+        logging.error('limit_compact_shards must be at least 1')
+        return
+    if geoip_engine not in geolocation.ENGINES:
+        logging.error('geoip_engine must be one of: {}'.format(', '.join(geolocation.ENGINES)))
+        return
+    if geoip_mode not in geolocation.MODES:
+        logging.error('geoip_mode must be one of: {}'.format(', '.join(geolocation.MODES)))
+        return
+    if max_event_loop_lag < 0 or max_pending_sends < 0 or shed_retry_after < 0:
+        logging.error('max_event_loop_lag, max_pending_sends and shed_retry_after must not be negative')
+        return
+    if not 0 <= profile_sample_rate <= 1:
+        logging.error('profile_sample_rate must be between 0 and 1')
+        return
+    if processes < 0:
+        logging.error('processes must not be negative')
+        return
+    if processes == 0:
+        processes = tornado.process.cpu_count()
+    if limiter_backend == 'memory' and processes > 1:
+        logging.error('limiter_backend memory counts requests per process and cannot be used with processes > 1')
+        return
     if tornado.options.options.localhostonly:
         address='127.0.0.1'
         address_info = 'Listening to localhost only'
@@ -183,6 +554,15 @@ def main():
     logging.info('''Starting Nexmo Application with the following parameters:
 port: {port}
 localhostonly: {localhostonly} ({address_info})
+processes: {processes}
+shutdown_timeout: {shutdown_timeout}
+metrics_path: {metrics_path}
+max_event_loop_lag: {max_event_loop_lag}
+max_pending_sends: {max_pending_sends}
+shed_retry_after: {shed_retry_after}
+server_timing: {server_timing}
+profile_sample_rate: {profile_sample_rate}
+admin_token: {admin_token}
 nexmo_api_key: {nexmo_api_key}
 nexmo_api_secret: ****
 nexmo_domain: {nexmo_domain}
@@ -196,34 +576,141 @@ sender: {sender}
 request_path: {request_path}
 limit_amount: {limit_amount}
 limit_expires: {limit_expires}
+limit_strategy: {limit_strategy}
+validation_batch_unit: {validation_batch_unit}
+validation_batch_max_size: {validation_batch_max_size}
+bulk_max_size: {bulk_max_size}
+bulk_api_key: {bulk_api_key}
+bulk_limit_amount: {bulk_limit_amount}
+bulk_limit_expires: {bulk_limit_expires}
+nexmo_send_concurrency: {nexmo_send_concurrency}
+nexmo_send_rate: {nexmo_send_rate}
+nexmo_max_in_flight: {nexmo_max_in_flight}
+nexmo_retry_attempts: {nexmo_retry_attempts}
+nexmo_retry_deadline: {nexmo_retry_deadline}
+nexmo_http_client: {nexmo_http_client}
+nexmo_connect_timeout: {nexmo_connect_timeout}
+nexmo_request_timeout: {nexmo_request_timeout}
+nexmo_breaker_error_rate: {nexmo_breaker_error_rate}
+nexmo_breaker_latency: {nexmo_breaker_latency}
+nexmo_breaker_reset_timeout: {nexmo_breaker_reset_timeout}
+idempotency_window: {idempotency_window}
+idempotency_pending_ttl: {idempotency_pending_ttl}
+dlr_flush_size: {dlr_flush_size}
+dlr_flush_interval: {dlr_flush_interval}
+dlr_ttl: {dlr_ttl}
+queue_mode: {queue_mode}
+queue_job_ttl: {queue_job_ttl}
 guess_country: {guess_country}
 default_country: {default_country}
+limiter_backend: {limiter_backend}
+limit_memory_size: {limit_memory_size}
+limit_key_layout: {limit_key_layout}
+limit_compact_shards: {limit_compact_shards}
+limit_cache_size: {limit_cache_size}
+limiter_fail_open: {limiter_fail_open}
+geoip_engine: {geoip_engine}
+geoip_path: {geoip_path}
+geoip_mode: {geoip_mode}
+geoip_cache_size: {geoip_cache_size}
+phone_cache_size: {phone_cache_size}
 redis_host: {redis_host}
 redis_port: {redis_port}
 redis_password: {redis_password}
 redis_db: {redis_db}
+redis_pool_size: {redis_pool_size}
+redis_health_check_interval: {redis_health_check_interval}
 
 Initialization starting...
-    '''.format(port=port, localhostonly=localhostonly, address_info=address_info, nexmo_api_key=nexmo_api_key,
+    '''.format(port=port, localhostonly=localhostonly, address_info=address_info, processes=processes,
+               shutdown_timeout=shutdown_timeout, metrics_path=metrics_path, max_event_loop_lag=max_event_loop_lag,
+               max_pending_sends=max_pending_sends, shed_retry_after=shed_retry_after, server_timing=server_timing,
+               profile_sample_rate=profile_sample_rate,
+               admin_token={True: 'Yes', False: 'No token given, admin routes disabled'}.get(bool(admin_token)),
+               nexmo_api_key=nexmo_api_key,
                nexmo_api_secret=nexmo_api_secret, nexmo_domain=nexmo_domain, nexmo_endpoint=nexmo_endpoint,
                nexmo_ssl=nexmo_ssl, nexmo_long_virtual_number=nexmo_long_virtual_number, nexmo_dlr_url=nexmo_dlr_url,
                development_mode=development_mode, message=message, sender=sender, request_path=request_path, limit_amount=limit_amount,
-               limit_expires=limit_expires, guess_country=guess_country, default_country=default_country,
+               limit_expires=limit_expires, limit_strategy=limit_strategy,
+               validation_batch_unit=validation_batch_unit, validation_batch_max_size=validation_batch_max_size,
+               bulk_max_size=bulk_max_size,
+               bulk_api_key={True: 'Yes', False: 'No key given, bulk messages disabled'}.get(bool(bulk_api_key)),
+               bulk_limit_amount=bulk_limit_amount, bulk_limit_expires=bulk_limit_expires,
+               nexmo_send_concurrency=nexmo_send_concurrency,
+               nexmo_send_rate=nexmo_send_rate, nexmo_max_in_flight=nexmo_max_in_flight,
+               nexmo_retry_attempts=nexmo_retry_attempts, nexmo_retry_deadline=nexmo_retry_deadline,
+               nexmo_http_client=nexmo_http_client, nexmo_connect_timeout=nexmo_connect_timeout,
+               nexmo_request_timeout=nexmo_request_timeout, nexmo_breaker_error_rate=nexmo_breaker_error_rate,
+               nexmo_breaker_latency=nexmo_breaker_latency, nexmo_breaker_reset_timeout=nexmo_breaker_reset_timeout,
+               idempotency_window=idempotency_window, idempotency_pending_ttl=idempotency_pending_ttl,
+               dlr_flush_size=dlr_flush_size, dlr_flush_interval=dlr_flush_interval, dlr_ttl=dlr_ttl,
+               queue_mode=queue_mode, queue_job_ttl=queue_job_ttl,
+               guess_country=guess_country,
+               default_country=default_country,
+               limiter_backend=limiter_backend, limit_memory_size=limit_memory_size,
+               limit_key_layout=limit_key_layout, limit_compact_shards=limit_compact_shards,
+               limit_cache_size=limit_cache_size, limiter_fail_open=limiter_fail_open, geoip_engine=geoip_engine,
+               geoip_path=geoip_path, geoip_mode=geoip_mode, geoip_cache_size=geoip_cache_size,
+               phone_cache_size=phone_cache_size,
                redis_host=redis_host, redis_port=redis_port,
-               redis_password={True: 'Yes', False: 'No password given'}.get(bool(redis_password)), redis_db=redis_db))
+               redis_password={True: 'Yes', False: 'No password given'}.get(bool(redis_password)), redis_db=redis_db,
+               redis_pool_size=redis_pool_size, redis_health_check_interval=redis_health_check_interval))
 
-    # Start application an listen on given port.
+    # Load read-only data once before forking so that the workers share it.
+    geo_databases = load_geo_databases(geoip_path, geoip_engine, geoip_mode)
+
+    # The workers share the listening sockets bound before forking.
+    sockets = tornado.netutil.bind_sockets(port, address=address)
+    if processes > 1:
+        fork_workers(processes, sockets)
+
+    # Start application an listen on given port. Every worker has its own
+    # IOLoop, Nexmo client and Redis connections.
+    server = []
     def on_ready_callback(app, status):
         logging.info('...Application initialization completed. Start listening on port {}'.format(port))
-        app.listen(port, address=address, xheaders=True)
+        server.append(start_server(app, sockets))
+
+    def stop():
+        future = shutdown(server[0] if server else None, app, shutdown_timeout)
+        io_loop.add_future(future, lambda future: io_loop.stop())
+
+    def on_signal(signum, frame):
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        io_loop.add_callback_from_signal(stop)
+
+    io_loop = tornado.ioloop.IOLoop.instance()
+    signal.signal(signal.SIGTERM, on_signal)
     app = NexmoApplication(api_key=nexmo_api_key,
                api_secret=nexmo_api_secret, domain=nexmo_domain, endpoint=nexmo_endpoint,
                ssl=nexmo_ssl, long_virtual_number=nexmo_long_virtual_number, dlr_url=nexmo_dlr_url,
                development_mode=development_mode, message=message, sender=sender, request_path=request_path, limit_amount=limit_amount,
-               limit_expires=limit_expires, guess_country=guess_country, default_country=default_country,
-               redis_host=redis_host, redis_port=redis_port, redis_password=redis_password, redis_db=redis_db,
-               callback=on_ready_callback)
-    tornado.ioloop.IOLoop.instance().start()
+               limit_expires=limit_expires, limit_strategy=limit_strategy,
+               validation_batch_unit=validation_batch_unit, validation_batch_max_size=validation_batch_max_size,
+               bulk_max_size=bulk_max_size, bulk_api_key=bulk_api_key, bulk_limit_amount=bulk_limit_amount,
+               bulk_limit_expires=bulk_limit_expires, nexmo_send_concurrency=nexmo_send_concurrency,
+               nexmo_send_rate=nexmo_send_rate, nexmo_max_in_flight=nexmo_max_in_flight,
+               nexmo_retry_attempts=nexmo_retry_attempts, nexmo_retry_deadline=nexmo_retry_deadline,
+               nexmo_http_client=nexmo_http_client, nexmo_connect_timeout=nexmo_connect_timeout,
+               nexmo_request_timeout=nexmo_request_timeout, nexmo_breaker_error_rate=nexmo_breaker_error_rate,
+               nexmo_breaker_latency=nexmo_breaker_latency, nexmo_breaker_reset_timeout=nexmo_breaker_reset_timeout,
+               idempotency_window=idempotency_window, idempotency_pending_ttl=idempotency_pending_ttl,
+               dlr_flush_size=dlr_flush_size, dlr_flush_interval=dlr_flush_interval, dlr_ttl=dlr_ttl,
+               queue_mode=queue_mode, queue_job_ttl=queue_job_ttl,
+               guess_country=guess_country,
+               default_country=default_country,
+               limiter_backend=limiter_backend, limit_memory_size=limit_memory_size,
+               limit_key_layout=limit_key_layout, limit_compact_shards=limit_compact_shards,
+               limit_cache_size=limit_cache_size, limiter_fail_open=limiter_fail_open, geoip_engine=geoip_engine,
+               geoip_path=geoip_path, geoip_mode=geoip_mode, geoip_cache_size=geoip_cache_size,
+               geo_databases=geo_databases, phone_cache_size=phone_cache_size,
+               redis_host=redis_host, redis_port=redis_port,
+               redis_password=redis_password, redis_db=redis_db, redis_pool_size=redis_pool_size,
+               redis_health_check_interval=redis_health_check_interval, metrics_path=metrics_path,
+               max_event_loop_lag=max_event_loop_lag, max_pending_sends=max_pending_sends,
+               shed_retry_after=shed_retry_after, server_timing=server_timing,
+               profile_sample_rate=profile_sample_rate, admin_token=admin_token, callback=on_ready_callback)
+    io_loop.start()
 
 
 # Run main method if script is run from command line.
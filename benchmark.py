@@ -0,0 +1,521 @@
+#!/usr/bin/env python
+# coding=UTF-8
+# Title:       benchmark.py
+# Description: Benchmarks for the hot paths of this application.
+# Author       David Nellessen <david.nellessen@familo.net>
+# Date:        16.10.26
+# Note:        Run with a local Redis, e.g. python benchmark.py --benchmark=limiter
+#              The http benchmark runs offline: python benchmark.py --benchmark=http
+# ==============================================================================
+
+# Import modules
+import bisect
+import itertools
+import json
+import os
+import random
+import re
+import socket
+import struct
+import subprocess
+import sys
+import time
+from functools import partial
+import tornado.httpserver
+import tornado.ioloop
+import tornado.options
+from tornado import gen, web
+from tornado.escape import url_escape
+from tornado.httpclient import HTTPRequest
+from tornado.options import define, options
+import pygeoip
+import toredis
+import geolocation
+import limiter
+import nexmoclient
+import phonecache
+from app import NexmoApplication
+
+
+define('benchmark', default='limiter', type=str, help='The benchmark to run (default limiter)')
+define('requests', default=10000, type=int, help='Number of operations per benchmark (default 10000)')
+define('concurrency', default=50, type=int, help='Number of concurrent operations (default 50)')
+define('bench_redis_host', default='localhost', type=str, help='Redis host used by benchmarks (default localhost)')
+define('bench_redis_port', default=6379, type=int, help='Redis port used by benchmarks (default 6379)')
+define('bench_redis_db', default=15, type=int, help='Redis DB used by benchmarks, will be flushed (default 15)')
+define('bench_memory_clients', default='100000,1000000,4000000', type=str, help='Numbers of clients at which the limiter_memory benchmark reports the Redis memory (default 100000,1000000,4000000)')
+define('bench_limiter_backend', default='memory', type=str, help='Limiter backend of the http benchmark: memory (offline) or redis (default memory)')
+define('bench_nexmo_latency', default=50, type=float, help='Milliseconds the stub Nexmo server of the http benchmark takes per request (default 50)')
+define('bench_nexmo_statuses', default='0:1', type=str, help='Message status codes returned by the stub Nexmo server with their shares, e.g. 0:0.95,1:0.05 (default 0:1)')
+define('bench_role', default='', type=str, help='Internal: run a server process of the http benchmark, nexmo or app')
+define('bench_port', default=0, type=int, help='Internal: port of the server process of the http benchmark')
+define('bench_nexmo_port', default=0, type=int, help='Internal: port of the stub Nexmo server of the http benchmark')
+
+
+class CountingRedis(toredis.Client):
+    """
+    A toredis client counting the commands sent to Redis. Every command
+    is a round trip since toredis waits for each reply.
+    """
+    commands = 0
+
+    def send_message(self, args, callback=None):
+        self.commands += 1
+        return super(CountingRedis, self).send_message(args, callback)
+
+
+class BenchmarkApplication(object):
+    """
+    Provides the members of NexmoApplication the limiters make use of.
+    """
+    def __init__(self, redis):
+        self.redis = redis
+
+
+class LegacyLimiter(limiter.RedisLimiter):
+    """
+    The former GET, INCR, EXPIRE implementation of BaseHandler.limit_call
+    for comparison.
+    """
+    @gen.coroutine
+    def check(self, chash, remote_ip, amount, expire, strategy='fixed_window', cost=1):
+        key = self.get_key(chash, remote_ip)
+        redis = self.application.redis
+        current_value = yield gen.Task(redis.get, key)
+        if current_value != None and int(current_value) >= amount:
+            raise gen.Return(False)
+        yield gen.Task(redis.incr, key)
+        if not current_value: yield gen.Task(redis.expire, key, expire)
+        raise gen.Return(True)
+
+
+class StubNexmoHandler(web.RequestHandler):
+    """
+    Answers requests to the Nexmo SMS API after 'latency' seconds. The
+    status code of each message is drawn from 'codes' by the cumulative
+    shares 'bounds', see parse_statuses().
+    """
+    message_ids = itertools.count()
+
+    def initialize(self, latency, bounds, codes):
+        self.latency = latency
+        self.bounds = bounds
+        self.codes = codes
+
+    @gen.coroutine
+    def post(self):
+        if self.latency:
+            yield gen.sleep(self.latency)
+        status = self.codes[bisect.bisect_right(self.bounds, random.random() * self.bounds[-1])]
+        message = {'status': status, 'to': self.get_argument('to', '')}
+        if status == '0':
+            message['message-id'] = '%016X' % next(self.message_ids)
+        else:
+            message['error-text'] = 'Benchmark status {}'.format(status)
+        self.finish({'message-count': '1', 'messages': [message]})
+
+
+class CpuTimeHandler(web.RequestHandler):
+    """
+    Reports the CPU seconds used by the application process so far.
+    """
+    def get(self):
+        user, system = os.times()[:2]
+        self.finish({'cpu_seconds': user + system})
+
+
+def parse_statuses(spec):
+    """
+    Parses a comma separated list of status codes with their shares, e.g.
+    '0:0.95,1:0.05', into a list of cumulative shares and a list of codes.
+    Raises ValueError if 'spec' is invalid.
+    """
+    bounds, codes = [], []
+    total = 0.0
+    for item in spec.split(','):
+        code, share = item.split(':')
+        if float(share) <= 0:
+            raise ValueError('Shares must be positive')
+        total += float(share)
+        bounds.append(total)
+        codes.append(code.strip())
+    return bounds, codes
+
+
+def phone_number_corpus(size):
+    """
+    Returns 'size' phone numbers. Like real traffic the corpus repeats
+    popular numbers: they are picked from 1000 national and international
+    numbers with a skewed distribution.
+    """
+    random.seed(0)
+    numbers = []
+    for i in range(1000):
+        if i % 2:
+            numbers.append('+49 151 %08d' % random.randint(0, 99999999))
+        else:
+            numbers.append('0151 %08d' % random.randint(0, 99999999))
+    return [numbers[int(random.paretovariate(1.2)) % len(numbers)] for _ in range(size)]
+
+
+def percentile(values, percent):
+    """
+    Returns the given percentile of a sorted list of values.
+    """
+    if not values:
+        return None
+    index = min(len(values) - 1, int(round(percent / 100.0 * (len(values) - 1))))
+    return values[index]
+
+
+def summarize(name, durations, total_time, **extra):
+    """
+    Builds a machine readable result from a list of durations in seconds.
+    """
+    durations = sorted(durations)
+    result = {'name': name,
+              'operations': len(durations),
+              'ops_per_second': round(len(durations) / total_time, 1) if total_time else None,
+              'p50_ms': round(percentile(durations, 50) * 1000, 3),
+              'p95_ms': round(percentile(durations, 95) * 1000, 3),
+              'p99_ms': round(percentile(durations, 99) * 1000, 3)}
+    result.update(extra)
+    return result
+
+
+@gen.coroutine
+def run_concurrently(operation, requests, concurrency):
+    """
+    Runs the coroutine function 'operation' with the given concurrency and
+    returns the duration of every single call and the total time.
+    """
+    durations = []
+    counter = [0]
+
+    @gen.coroutine
+    def worker():
+        while counter[0] < requests:
+            i = counter[0]
+            counter[0] += 1
+            start = time.time()
+            yield operation(i)
+            durations.append(time.time() - start)
+
+    start = time.time()
+    yield [worker() for _ in range(concurrency)]
+    raise gen.Return((durations, time.time() - start))
+
+
+@gen.coroutine
+def connect_redis(io_loop):
+    redis = CountingRedis(io_loop=io_loop)
+    yield gen.Task(redis.connect, options.bench_redis_host, options.bench_redis_port)
+    yield gen.Task(redis.select, options.bench_redis_db)
+    yield gen.Task(redis.flushdb)
+    redis.commands = 0
+    raise gen.Return(redis)
+
+
+@gen.coroutine
+def benchmark_limiter(io_loop):
+    """
+    Compares the round trips and latency of the legacy limiter with the
+    scripted one and with the memory backend. Requests are spread over 1000
+    IP addresses with a limit of 10 calls so that both allowed and rejected
+    calls are measured.
+    """
+    results = []
+    engines = (('legacy', 'fixed_window', partial(LegacyLimiter, blocked_cache_size=0)),
+               ('script', 'fixed_window', partial(limiter.RedisLimiter, blocked_cache_size=0)),
+               ('script_blocked_cache', 'fixed_window', limiter.RedisLimiter),
+               ('script_gcra', 'gcra', partial(limiter.RedisLimiter, blocked_cache_size=0)),
+               ('memory', 'fixed_window', lambda application: limiter.MemoryLimiter()),
+               ('memory_gcra', 'gcra', lambda application: limiter.MemoryLimiter()))
+    for name, strategy, limiter_factory in engines:
+        redis = yield connect_redis(io_loop)
+        engine = limiter_factory(BenchmarkApplication(redis))
+
+        def operation(i):
+            return engine.check('benchmark', '10.0.%d.%d' % (i % 1000 // 256, i % 256), 10, 3600, strategy)
+        durations, total_time = yield run_concurrently(operation, options.requests, options.concurrency)
+        results.append(summarize('limiter_' + name, durations, total_time,
+                                 redis_round_trips_per_call=round(float(redis.commands) / len(durations), 3),
+                                 limiter=engine.stats()))
+    raise gen.Return(results)
+
+
+@gen.coroutine
+def get_used_memory(redis):
+    info = yield gen.Task(redis.info)
+    raise gen.Return(int(re.search(r'used_memory:(\d+)', info).group(1)))
+
+
+@gen.coroutine
+def get_hash_encoding(redis):
+    key = yield gen.Task(redis.randomkey)
+    encoding = yield gen.Task(redis.object, 'ENCODING', [key])
+    raise gen.Return(encoding)
+
+
+@gen.coroutine
+def benchmark_limiter_memory(io_loop):
+    """
+    Compares the Redis memory used by the plain and the compact key layout
+    (with --limit_compact_shards) when the clients of one handler and window
+    reach each of --bench_memory_clients. Every operation counts a call of
+    another client, half of them using IPv4 and half IPv6 addresses.
+    --requests is not used.
+    """
+    checkpoints = sorted(int(clients) for clients in options.bench_memory_clients.split(','))
+    results = []
+    for layout in limiter.KEY_LAYOUTS:
+        redis = yield connect_redis(io_loop)
+        initial_memory = yield get_used_memory(redis)
+        engine = limiter.RedisLimiter(BenchmarkApplication(redis), blocked_cache_size=0, key_layout=layout,
+                                      compact_shards=options.limit_compact_shards)
+        clients = 0
+        for checkpoint in checkpoints:
+            def operation(i, offset=clients):
+                i += offset
+                if i % 2:
+                    remote_ip = '2001:db8::%x:%x' % (i // 65536, i % 65536)
+                else:
+                    remote_ip = '10.%d.%d.%d' % (i // 65536 % 256, i // 256 % 256, i % 256)
+                return engine.check('number_validation', remote_ip, 10, 3600)
+            durations, total_time = yield run_concurrently(operation, checkpoint - clients, options.concurrency)
+            clients = checkpoint
+            used_memory = (yield get_used_memory(redis)) - initial_memory
+            keys = yield gen.Task(redis.dbsize)
+            extra = {}
+            if layout == 'compact':
+                extra = {'compact_shards': options.limit_compact_shards,
+                         'clients_per_hash': clients // options.limit_compact_shards,
+                         'hash_encoding': (yield get_hash_encoding(redis))}
+            results.append(summarize('limiter_memory_' + layout, durations, total_time, clients=clients,
+                                     used_memory_bytes=used_memory, redis_keys=keys,
+                                     bytes_per_client=round(float(used_memory) / clients, 1), **extra))
+    raise gen.Return(results)
+
+
+@gen.coroutine
+def benchmark_geoip(io_loop):
+    """
+    Compares lookups of random IPv4 and IPv6 addresses with pygeoip and the
+    compiled range arrays, one by one and in batches of 1000.
+    """
+    random.seed(0)
+    corpus = {
+        'ipv4': [socket.inet_ntoa(struct.pack('>I', random.getrandbits(32)))
+                 for _ in range(options.requests)],
+        'ipv6': [socket.inet_ntop(socket.AF_INET6, struct.pack('>QQ', random.getrandbits(61) | 1 << 61,
+                                                               random.getrandbits(64)))
+                 for _ in range(options.requests)],
+    }
+    engines = {
+        'ipv4': {'pygeoip': pygeoip.GeoIP('GeoIP.dat', pygeoip.MEMORY_CACHE),
+                 'ranges': geolocation.RangeGeoIP('GeoIP.dat')},
+        'ipv6': {'pygeoip': pygeoip.GeoIP('GeoIPv6.dat', pygeoip.MEMORY_CACHE),
+                 'ranges': geolocation.RangeGeoIP('GeoIPv6.dat', ipv6=True)},
+    }
+    results = []
+    for family in ('ipv4', 'ipv6'):
+        addrs = corpus[family]
+        for name in ('pygeoip', 'ranges'):
+            engine = engines[family][name]
+            durations = []
+            start = time.time()
+            for addr in addrs:
+                lookup_start = time.time()
+                engine.country_code_by_addr(addr)
+                durations.append(time.time() - lookup_start)
+            results.append(summarize('geoip_{}_{}'.format(name, family), durations, time.time() - start))
+        engine = engines[family]['ranges']
+        durations = []
+        start = time.time()
+        for i in range(0, len(addrs), 1000):
+            batch_start = time.time()
+            engine.country_codes_by_addrs(addrs[i:i + 1000])
+            durations.append(time.time() - batch_start)
+        total_time = time.time() - start
+        results.append(summarize('geoip_ranges_batch_{}'.format(family), durations, total_time,
+                                 addresses_per_second=round(len(addrs) / total_time, 1),
+                                 numpy=geolocation.numpy is not None))
+    raise gen.Return(results)
+
+
+@gen.coroutine
+def benchmark_phonenumbers(io_loop):
+    """
+    Compares parsing and formatting phone numbers for every request with the
+    PhoneNumberCache, see phone_number_corpus().
+    """
+    corpus = phone_number_corpus(options.requests)
+
+    def parse_uncached(number):
+        parsed = phonecache.PhoneNumberCache.parse_uncached(number)
+        return parsed or phonecache.PhoneNumberCache.parse_uncached(number, 'DE')
+
+    cache = phonecache.PhoneNumberCache()
+
+    def parse_cached(number):
+        return cache.parse(number) or cache.parse(number, 'DE')
+
+    results = []
+    for name, parse, stats in (('uncached', parse_uncached, lambda: None),
+                               ('cached', parse_cached, cache.stats)):
+        durations = []
+        start = time.time()
+        for number in corpus:
+            parse_start = time.time()
+            parse(number)
+            durations.append(time.time() - parse_start)
+        results.append(summarize('phonenumbers_' + name, durations, time.time() - start, cache=stats()))
+    raise gen.Return(results)
+
+
+def get_unused_port():
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def start_server_process(role, port, *args):
+    """
+    Starts this script in a server role of the http benchmark. The options
+    given to the benchmark are passed on, e.g. to configure the application.
+    """
+    return subprocess.Popen([sys.executable, os.path.abspath(__file__)] + sys.argv[1:] +
+                            ['--bench_role=' + role, '--bench_port={}'.format(port), '--logging=warning'] +
+                            list(args))
+
+
+@gen.coroutine
+def wait_for_server(client, url, timeout=60):
+    deadline = time.time() + timeout
+    while True:
+        response = yield client.fetch(url, raise_error=False)
+        if response.code != 599:
+            raise gen.Return(response)
+        if time.time() > deadline:
+            raise RuntimeError('{} did not start within {}s'.format(url, timeout))
+        yield gen.sleep(0.1)
+
+
+@gen.coroutine
+def get_cpu_seconds(client, base_url):
+    response = yield client.fetch(base_url + '/_bench/cpu')
+    raise gen.Return(json.loads(response.body)['cpu_seconds'])
+
+
+@gen.coroutine
+def benchmark_http(io_loop):
+    """
+    Drives /validate_number/ and /message/, with and without JSONP, against
+    the application running in its own process with a stub Nexmo server
+    (see --bench_nexmo_latency and --bench_nexmo_statuses) and the memory
+    limiter backend, so it runs offline. Limits are high enough to never be
+    reached. Requests come from 1000 client addresses by X-Real-Ip. Besides
+    the latency percentiles seen by the client the CPU time the application
+    process used per request is reported, which unlike the throughput does
+    not depend on the speed of the load generator.
+    """
+    parse_statuses(options.bench_nexmo_statuses)
+    if options.bench_limiter_backend == 'redis':
+        # Flushes the DB of the application.
+        redis = yield connect_redis(io_loop)
+        redis.close()
+    nexmo_port, app_port = get_unused_port(), get_unused_port()
+    processes = [start_server_process('nexmo', nexmo_port),
+                 start_server_process('app', app_port, '--bench_nexmo_port={}'.format(nexmo_port))]
+    client = nexmoclient.create_http_client('auto', options.concurrency)
+    base_url = 'http://127.0.0.1:{}'.format(app_port)
+    results = []
+    try:
+        yield wait_for_server(client, base_url + '/_bench/cpu')
+        numbers = phone_number_corpus(options.requests)
+        ips = [socket.inet_ntoa(struct.pack('>I', random.randint(0x01000000, 0xDFFFFFFF))) for _ in range(1000)]
+        scenarios = (('validate_number', '/validate_number/?number={}'),
+                     ('validate_number_jsonp', '/validate_number/?number={}&callback=callback'),
+                     ('message', '/message/?receiver={}'),
+                     ('message_jsonp', '/message/?receiver={}&callback=callback'))
+        for name, path in scenarios:
+            codes = {}
+
+            @gen.coroutine
+            def operation(i):
+                request = HTTPRequest(base_url + path.format(url_escape(numbers[i])),
+                                      headers={'X-Real-Ip': ips[i % len(ips)]})
+                response = yield client.fetch(request, raise_error=False)
+                codes[response.code] = codes.get(response.code, 0) + 1
+
+            cpu_start = yield get_cpu_seconds(client, base_url)
+            durations, total_time = yield run_concurrently(operation, options.requests, options.concurrency)
+            cpu = (yield get_cpu_seconds(client, base_url)) - cpu_start
+            results.append(summarize('http_' + name, durations, total_time,
+                                     app_cpu_ms_per_request=round(cpu * 1000 / len(durations), 4),
+                                     status_codes=dict((str(code), count) for code, count in codes.items()),
+                                     concurrency=options.concurrency,
+                                     limiter_backend=options.bench_limiter_backend,
+                                     nexmo_latency_ms=options.bench_nexmo_latency,
+                                     nexmo_statuses=options.bench_nexmo_statuses))
+    finally:
+        client.close()
+        for process in processes:
+            process.terminate()
+            process.wait()
+    raise gen.Return(results)
+
+
+def run_stub_nexmo():
+    bounds, codes = parse_statuses(options.bench_nexmo_statuses)
+    app = web.Application([(r'/sms/json', StubNexmoHandler,
+                            {'latency': options.bench_nexmo_latency / 1000.0, 'bounds': bounds, 'codes': codes})])
+    app.listen(options.bench_port, address='127.0.0.1')
+    tornado.ioloop.IOLoop.instance().start()
+
+
+def run_app():
+    def on_ready(app, status):
+        app.add_handlers(r'.*$', [(r'/_bench/cpu', CpuTimeHandler)])
+        server = tornado.httpserver.HTTPServer(app, xheaders=True)
+        server.listen(options.bench_port, address='127.0.0.1')
+    NexmoApplication(api_key='benchmark', api_secret='benchmark', domain='127.0.0.1:{}'.format(options.bench_nexmo_port),
+                     message='Benchmark message', sender='Benchmark', limit_amount=10 ** 9, nexmo_send_rate=0,
+                     nexmo_max_in_flight=options.concurrency, limit_strategy=options.limit_strategy,
+                     limiter_backend=options.bench_limiter_backend, limit_key_layout=options.limit_key_layout,
+                     limit_cache_size=options.limit_cache_size, geoip_engine=options.geoip_engine,
+                     geoip_path=options.geoip_path, geoip_mode=options.geoip_mode,
+                     geoip_cache_size=options.geoip_cache_size, phone_cache_size=options.phone_cache_size,
+                     nexmo_http_client=options.nexmo_http_client, redis_host=options.bench_redis_host,
+                     redis_port=options.bench_redis_port, redis_db=options.bench_redis_db, callback=on_ready)
+    tornado.ioloop.IOLoop.instance().start()
+
+
+BENCHMARKS = {
+    'geoip': benchmark_geoip,
+    'http': benchmark_http,
+    'limiter': benchmark_limiter,
+    'limiter_memory': benchmark_limiter_memory,
+    'phonenumbers': benchmark_phonenumbers,
+}
+
+
+def main():
+    tornado.options.parse_command_line()
+    if options.bench_role == 'nexmo':
+        return run_stub_nexmo()
+    if options.bench_role == 'app':
+        return run_app()
+    io_loop = tornado.ioloop.IOLoop.instance()
+    names = options.benchmark.split(',') if options.benchmark != 'all' else sorted(BENCHMARKS)
+    for name in names:
+        results = io_loop.run_sync(partial(BENCHMARKS[name], io_loop))
+        for result in results:
+            print(json.dumps(result, sort_keys=True))
+
+
+# Run main method if script is run from command line.
+if __name__ == "__main__":
+    main()
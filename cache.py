@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+# coding=UTF-8
+# Title:       cache.py
+# Description: A bounded in-process LRU cache with optional expiry per entry.
+# Author       David Nellessen <david.nellessen@familo.net>
+# Date:        16.10.26
+# Note:
+# ==============================================================================
+
+# Import modules
+import time
+from collections import OrderedDict
+
+
+class LRUCache(object):
+    """
+    A least recently used cache holding at most 'size' entries. Each entry
+    may have an absolute expiry timestamp after which it is treated as
+    missing. The cache counts hits, misses, evictions (entries dropped
+    because the cache was full) and expirations so it can be sized.
+    """
+    def __init__(self, size=10000, clock=time.time):
+        self.size = size
+        self.clock = clock
+        self.data = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def __len__(self):
+        return len(self.data)
+
+    def get(self, key, default=None):
+        """
+        Returns the value for 'key' or 'default' if it is not cached or
+        has expired.
+        """
+        try:
+            value, expires = self.data.pop(key)
+        except KeyError:
+            self.misses += 1
+            return default
+        if expires is not None and expires <= self.clock():
+            self.expirations += 1
+            self.misses += 1
+            return default
+        self.data[key] = (value, expires)
+        self.hits += 1
+        return value
+
+    def set(self, key, value, expires=None):
+        """
+        Caches 'value' for 'key' until the timestamp 'expires' (or until it
+        is evicted if 'expires' is None).
+        """
+        if self.size <= 0:
+            return
+        self.data.pop(key, None)
+        self.data[key] = (value, expires)
+        while len(self.data) > self.size:
+            self.data.popitem(last=False)
+            self.evictions += 1
+
+    def delete(self, key):
+        self.data.pop(key, None)
+
+    def clear(self):
+        self.data.clear()
+
+    def stats(self):
+        """
+        Returns the counters of this cache as a dict.
+        """
+        return {'size': len(self.data),
+                'max_size': self.size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'expirations': self.expirations}
@@ -12,7 +12,30 @@ SIMPLE_MESSAGE_HANDLERS = {}
 # Define simple message handlers. Syntax:
 # SIMPLE_MESSAGE_HANDLERS['/desired_path/'] = {'message': 'The mssage that will be sent',
 #                                              'sender': 'The sender title or phone number'}
+# Optionally set 'limit_strategy' to 'fixed_window' or 'gcra' to override --limit_strategy.
 
 # Example:
 #SIMPLE_MESSAGE_HANDLERS['/example/'] = {'message': 'Lade hier Familonet https://www.familo.net/start',
-#                                        'sender': 'Familonet'}
\ No newline at end of file
+#                                        'sender': 'Familonet'}
+
+LIMIT_POLICIES = {}
+
+# Define limit policies of message handlers by their path, including the path
+# of the default message handler (--request_path). A policy replaces the limit
+# per IP address given by --limit_amount and --limit_expires with several
+# fixed window limits that are all checked and counted in one Redis call.
+# A request is rejected if any of them is acceded. Syntax:
+# LIMIT_POLICIES['/desired_path/'] = [{'dimension': 'ip', 'amount': 10, 'expires': 3600}, ...]
+# Dimensions:
+#   'ip': per IP address of the client
+#   'receiver': per phone number of the receiver
+#   'country': per country calling code of the receiver (e.g. 49)
+#   'handler': for all requests of the handler, e.g. as a spending cap
+# A dimension may have several limits with different amounts or expires, e.g.
+# a burst and a sustained limit per IP address.
+
+# Example:
+#LIMIT_POLICIES['/example/'] = [{'dimension': 'ip', 'amount': 10, 'expires': 3600},
+#                               {'dimension': 'receiver', 'amount': 3, 'expires': 86400},
+#                               {'dimension': 'country', 'amount': 1000, 'expires': 3600},
+#                               {'dimension': 'handler', 'amount': 10000, 'expires': 86400}]
@@ -0,0 +1,196 @@
+#!/usr/bin/env python
+# coding=UTF-8
+# Title:       dlr.py
+# Description: Parses Nexmo delivery receipts and stores them in Redis in batches.
+# Author       David Nellessen <david.nellessen@familo.net>
+# Date:        16.10.26
+# Note:        See https://docs.nexmo.com/messaging/sms-api/api-reference#delivery_receipt
+# ==============================================================================
+
+# Import modules
+import itertools
+import logging
+import time
+import tornado.ioloop
+from tornado import gen
+from limiter import RedisScript
+
+
+# Prefix of the Redis hashes holding the latest receipt of a message.
+RECEIPT_KEY_PREFIX = 'sms_dlr:'
+
+# Receipt states after which the state of a message does not change anymore.
+FINAL_STATES = ('delivered', 'expired', 'failed', 'rejected')
+
+# Fields of a parsed receipt besides the message ID, stored in this order.
+FIELDS = ('status', 'number', 'err_code', 'price', 'network', 'timestamp', 'updated')
+
+
+def parse_receipt(params):
+    """
+    Returns a dict of the receipt fields from the request parameters of a
+    Nexmo delivery receipt. Raises ValueError if the message ID or the status
+    is missing.
+    """
+    message_id = params.get('messageId')
+    status = params.get('status')
+    if not message_id or not status:
+        raise ValueError('messageId and status are required')
+    return {'message_id': message_id,
+            'status': status.lower(),
+            'number': params.get('msisdn', ''),
+            'err_code': params.get('err-code', ''),
+            'price': params.get('price', ''),
+            'network': params.get('network-code', ''),
+            'timestamp': params.get('message-timestamp', ''),
+            'updated': int(time.time())}
+
+
+def supersedes(receipt, previous):
+    """
+    Tells if 'receipt' replaces 'previous'. Receipts may arrive out of order,
+    so an intermediate state never replaces a final one.
+    """
+    return not previous or previous['status'] not in FINAL_STATES or receipt['status'] in FINAL_STATES
+
+
+class ReceiptBuffer(object):
+    """
+    Collects delivery receipts in memory and writes them to Redis in batches,
+    every 'flush_interval' seconds or as soon as 'flush_size' receipts are
+    buffered. A batch costs one round trip to Redis instead of one per
+    receipt, which matters for the receipt storm following a large campaign.
+    Only the latest receipt of a message is kept. Receipts are stored for
+    'ttl' seconds.
+
+    If Redis is unavailable the receipts are kept for the next flush as long
+    as less than 'max_size' receipts are buffered, newer ones are dropped.
+
+    Like limiter.RedisLimiter this uses the Redis connection of
+    'application'.
+    """
+    # KEYS are the receipt keys. ARGV[1] is the TTL followed by the FIELDS of
+    # every receipt. Returns the number of receipts written.
+    store_script = RedisScript("""
+local final = {""" + ', '.join("['{}'] = true".format(state) for state in FINAL_STATES) + """}
+local written = 0
+for i, key in ipairs(KEYS) do
+    local base = (i - 1) * """ + str(len(FIELDS)) + """ + 1
+    local current = redis.call('HGET', key, 'status')
+    if not (current and final[current] and not final[ARGV[base + 1]]) then
+        redis.call('HMSET', key, """ + ', '.join("'{}', ARGV[base + {}]".format(field, n + 1)
+                                             for n, field in enumerate(FIELDS)) + """)
+        redis.call('EXPIRE', key, ARGV[1])
+        written = written + 1
+    end
+end
+return written
+""")
+
+    def __init__(self, application, flush_size=500, flush_interval=1.0, ttl=86400, max_size=None, io_loop=None):
+        self.application = application
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.ttl = ttl
+        self.max_size = max_size or flush_size * 20
+        self.io_loop = io_loop or tornado.ioloop.IOLoop.current()
+        self.pending = {}
+        self.flushing = False
+        self.timer = None
+        self.counters = {'received': 0, 'written': 0, 'batches': 0, 'failed_batches': 0, 'dropped': 0}
+        self.flush_time_max = 0.0
+
+    def start(self):
+        self.timer = tornado.ioloop.PeriodicCallback(self.flush, self.flush_interval * 1000, io_loop=self.io_loop)
+        self.timer.start()
+
+    def stop(self):
+        if self.timer:
+            self.timer.stop()
+
+    def add(self, receipt):
+        """
+        Buffers a receipt returned by parse_receipt().
+        """
+        self.counters['received'] += 1
+        if receipt['message_id'] not in self.pending and len(self.pending) >= self.max_size:
+            self.counters['dropped'] += 1
+            return
+        if supersedes(receipt, self.pending.get(receipt['message_id'])):
+            self.pending[receipt['message_id']] = receipt
+        if len(self.pending) >= self.flush_size and not self.flushing:
+            self.io_loop.add_callback(self.flush)
+
+    @gen.coroutine
+    def flush(self):
+        """
+        Writes the buffered receipts to Redis, in batches of up to
+        'flush_size' receipts.
+        """
+        if self.flushing:
+            return
+        self.flushing = True
+        try:
+            while self.pending:
+                batch = list(itertools.islice(self.pending.itervalues(), self.flush_size))
+                for receipt in batch:
+                    del self.pending[receipt['message_id']]
+                if not (yield self.write(batch)):
+                    # Keep the receipts for the next flush unless newer ones arrived meanwhile.
+                    for receipt in batch:
+                        if len(self.pending) >= self.max_size:
+                            self.counters['dropped'] += 1
+                        elif receipt['message_id'] not in self.pending:
+                            self.pending[receipt['message_id']] = receipt
+                    break
+        finally:
+            self.flushing = False
+
+    @gen.coroutine
+    def write(self, batch):
+        """
+        Writes a batch of receipts to Redis and resolves to True on success.
+        """
+        keys = [RECEIPT_KEY_PREFIX + receipt['message_id'] for receipt in batch]
+        args = [self.ttl]
+        for receipt in batch:
+            args += [receipt[field] for field in FIELDS]
+        start = time.time()
+        try:
+            written = yield self.store_script(self.application.redis, keys, args)
+        except Exception:
+            logging.exception('Writing {} delivery receipts failed'.format(len(batch)))
+            self.counters['failed_batches'] += 1
+            raise gen.Return(False)
+        if written is None:
+            logging.error('Writing {} delivery receipts failed: Redis connection lost'.format(len(batch)))
+            self.counters['failed_batches'] += 1
+            raise gen.Return(False)
+        self.flush_time_max = max(self.flush_time_max, time.time() - start)
+        self.counters['batches'] += 1
+        self.counters['written'] += written
+        raise gen.Return(True)
+
+    @gen.coroutine
+    def get(self, message_id):
+        """
+        Resolves to the latest receipt of a message as a dict or None if
+        there is none.
+        """
+        if message_id in self.pending:
+            raise gen.Return(dict(self.pending[message_id]))
+        result = yield gen.Task(self.application.redis.hgetall, RECEIPT_KEY_PREFIX + message_id)
+        if isinstance(result, Exception):
+            raise result
+        if not result:
+            raise gen.Return(None)
+        receipt = dict(zip(result[::2], result[1::2]))
+        receipt['message_id'] = message_id
+        receipt['updated'] = int(receipt['updated'])
+        raise gen.Return(receipt)
+
+    def stats(self):
+        stats = dict(self.counters)
+        stats['pending'] = len(self.pending)
+        stats['flush_time_max_ms'] = round(self.flush_time_max * 1000, 3)
+        return stats
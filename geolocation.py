@@ -0,0 +1,283 @@
+#!/usr/bin/env python
+# coding=UTF-8
+# Title:       geolocation.py
+# Description: Resolves the country of IP addresses using the GeoIP databases.
+# Author       David Nellessen <david.nellessen@familo.net>
+# Date:        16.10.26
+# Note:
+# ==============================================================================
+
+# Import modules
+import bisect
+import logging
+import mmap
+import os
+import socket
+import struct
+import time
+from array import array
+import pygeoip
+from pygeoip import const
+import metrics
+from cache import LRUCache
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+class GeoIPResolver(object):
+    """
+    Resolves the country code of IPv4 and IPv6 addresses. The database is
+    chosen by the address family up front and results (including misses)
+    are memoized in a LRUCache of 'cache_size' entries, since many requests
+    come from the same NAT or mobile carrier gateways.
+    """
+    def __init__(self, geo_ip, geo_ipv6, cache_size=10000):
+        self.geo_ip = geo_ip
+        self.geo_ipv6 = geo_ipv6
+        self.cache = LRUCache(cache_size)
+
+    def country_code_by_addr(self, ip):
+        """
+        Returns the country code for 'ip' or None if it is unknown.
+        """
+        start = time.time()
+        country = self.cache.get(ip, False)
+        if country is False:
+            country = self.lookup(ip)
+            self.cache.set(ip, country)
+        metrics.GEOIP_LOOKUP.observe(time.time() - start)
+        return country
+
+    def lookup(self, ip):
+        if ':' in ip:
+            if ip.lower().startswith('::ffff:') and '.' in ip:
+                # IPv4-mapped IPv6 address.
+                database, ip = self.geo_ip, ip[7:]
+            else:
+                database = self.geo_ipv6
+        else:
+            database = self.geo_ip
+        try:
+            return database.country_code_by_addr(ip) or None
+        except (pygeoip.GeoIPError, socket.error, ValueError) as exc:
+            logging.debug('GeoIP lookup of {} failed: {}'.format(ip, exc))
+            return None
+
+    def stats(self):
+        return self.cache.stats()
+
+
+class RangeGeoIP(object):
+    """
+    A GeoIP country database (GeoIP.dat or GeoIPv6.dat) compiled once into
+    flat sorted arrays: the first address of every range and the country
+    ID of that range. A lookup is a binary search instead of walking the
+    binary trie of the database byte by byte like pygeoip does.
+
+    IPv4 ranges start at unsigned 32 bit integers. IPv6 ranges start at 16
+    byte big endian strings, which compare like the addresses they stand
+    for. country_codes_by_addrs() resolves many addresses at once and is
+    vectorized with NumPy if it is installed.
+
+    Results equal pygeoip's country_code_by_addr() except for IPv6
+    addresses below 10^10 (within ::/96), for which pygeoip only walks 32
+    bits of the trie.
+
+    If 'mmap_cache' is True (requires NumPy) the compiled arrays are
+    written to '<filename>.ranges' once and memory-mapped read-only, so
+    processes share them through the page cache and later starts do not
+    compile the database again.
+    """
+    # Header of the cache file: magic string and number of ranges.
+    cache_header = struct.Struct('<8sQ')
+    cache_magic = 'GEORNG1\0'
+
+    def __init__(self, filename, ipv6=False, mmap_cache=False):
+        self.ipv6 = ipv6
+        self.mapped = False
+        self.country_codes = const.COUNTRY_CODES
+        if mmap_cache and numpy is None:
+            logging.warning('NumPy is needed to memory-map GeoIP ranges, loading {} into memory'.format(filename))
+        elif mmap_cache:
+            try:
+                self.load_cache(filename)
+                return
+            except (IOError, OSError) as exc:
+                logging.warning('Cannot memory-map GeoIP ranges of {}, loading it into memory: {}'.format(filename, exc))
+        self.starts, self.country_ids = self.compile_file(filename)
+        if numpy is not None:
+            if ipv6:
+                self.numpy_starts = numpy.array(self.starts, dtype='S16')
+            else:
+                self.numpy_starts = numpy.frombuffer(self.starts, dtype=numpy.uint32)
+            self.numpy_country_ids = numpy.frombuffer(self.country_ids, dtype=numpy.uint16)
+            self.numpy_country_codes = numpy.array(self.country_codes, dtype=object)
+
+    def compile_file(self, filename):
+        """
+        Returns the start addresses and country IDs of the database file.
+        """
+        with open(filename, 'rb') as f:
+            data = f.read()
+        starts, country_ids = self.compile(data, 128 if self.ipv6 else 32)
+        if self.ipv6:
+            starts = [struct.pack('>QQ', start >> 64, start & 0xffffffffffffffff) for start in starts]
+        else:
+            starts = array('I', starts)
+        return starts, array('H', country_ids)
+
+    def load_cache(self, filename):
+        """
+        Memory-maps the compiled arrays of the database file, compiling
+        them into the cache file first if it is missing, outdated or
+        invalid.
+        """
+        cache_filename = filename + '.ranges'
+        if (not os.path.exists(cache_filename)
+                or os.path.getmtime(cache_filename) < os.path.getmtime(filename)):
+            self.write_cache(filename, cache_filename)
+        try:
+            self.map_cache(cache_filename)
+        except IOError as exc:
+            logging.warning('Compiling the GeoIP ranges of {} again: {}'.format(filename, exc))
+            self.write_cache(filename, cache_filename)
+            self.map_cache(cache_filename)
+
+    def write_cache(self, filename, cache_filename):
+        """
+        Compiles the database file into the cache file.
+        """
+        starts, country_ids = self.compile_file(filename)
+        temp_filename = '{}.{}.tmp'.format(cache_filename, os.getpid())
+        with open(temp_filename, 'wb') as f:
+            f.write(self.cache_header.pack(self.cache_magic, len(starts)))
+            f.write(''.join(starts) if self.ipv6 else starts.tostring())
+            f.write(country_ids.tostring())
+        # Renaming is atomic, so concurrently starting processes never
+        # see a partial file.
+        os.rename(temp_filename, cache_filename)
+
+    def map_cache(self, cache_filename):
+        """
+        Memory-maps the arrays of the cache file. Raises IOError if it is
+        not a GeoIP ranges file or its size is wrong, e.g. if it is
+        truncated.
+        """
+        with open(cache_filename, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            if size < self.cache_header.size:
+                raise IOError('{} is truncated'.format(cache_filename))
+            cache = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, count = self.cache_header.unpack_from(cache)
+        if magic != self.cache_magic:
+            cache.close()
+            raise IOError('{} is not a GeoIP ranges file'.format(cache_filename))
+        if size != self.cache_header.size + count * ((16 if self.ipv6 else 4) + 2):
+            cache.close()
+            raise IOError('{} does not match its number of ranges'.format(cache_filename))
+        self.mmap = cache
+        offset = self.cache_header.size
+        start_dtype = 'S16' if self.ipv6 else numpy.uint32
+        self.numpy_starts = numpy.frombuffer(self.mmap, start_dtype, count, offset)
+        offset += self.numpy_starts.nbytes
+        self.numpy_country_ids = numpy.frombuffer(self.mmap, numpy.uint16, count, offset)
+        self.numpy_country_codes = numpy.array(self.country_codes, dtype=object)
+        self.starts = self.numpy_starts
+        self.country_ids = self.numpy_country_ids
+        self.mapped = True
+
+    @staticmethod
+    def compile(data, bits):
+        """
+        Walks the trie of a GeoIP country database depth first and returns
+        the sorted start addresses of all ranges and their country IDs.
+        Adjacent ranges of the same country are merged.
+        """
+        starts = []
+        country_ids = []
+        # Items are (is_leaf, record, depth, first address).
+        stack = [(False, 0, bits - 1, 0)]
+        while stack:
+            leaf, record, depth, prefix = stack.pop()
+            if leaf:
+                if not country_ids or country_ids[-1] != record:
+                    starts.append(prefix)
+                    country_ids.append(record)
+                continue
+            offset = record * 2 * const.STANDARD_RECORD_LENGTH
+            node = struct.unpack('<6B', data[offset:offset + 6])
+            # Push the right child first so the left one is processed first.
+            for bit, record in ((1, node[3] | node[4] << 8 | node[5] << 16),
+                                (0, node[0] | node[1] << 8 | node[2] << 16)):
+                start = prefix | (bit << depth)
+                if record >= const.COUNTRY_BEGIN:
+                    stack.append((True, record - const.COUNTRY_BEGIN, depth - 1, start))
+                else:
+                    stack.append((False, record, depth - 1, start))
+        return starts, country_ids
+
+    def pack(self, addr):
+        """
+        Returns the value 'addr' is searched by in self.starts.
+        """
+        if self.ipv6:
+            return socket.inet_pton(socket.AF_INET6, addr)
+        return struct.unpack('>I', socket.inet_aton(addr))[0]
+
+    def country_code_by_addr(self, addr):
+        """
+        Returns the country code of 'addr' or '' if it is unknown like
+        pygeoip.GeoIP.country_code_by_addr(). Raises socket.error for
+        invalid addresses.
+        """
+        if self.mapped:
+            index = int(numpy.searchsorted(self.numpy_starts, self.pack(addr), side='right')) - 1
+        else:
+            index = bisect.bisect_right(self.starts, self.pack(addr)) - 1
+        return self.country_codes[self.country_ids[index]]
+
+    def country_codes_by_addrs(self, addrs):
+        """
+        Returns a list with the country code of every address in 'addrs'.
+        Invalid addresses resolve to None.
+        """
+        packed = []
+        valid = []
+        for addr in addrs:
+            try:
+                packed.append(self.pack(addr))
+                valid.append(True)
+            except (socket.error, ValueError, TypeError):
+                valid.append(False)
+        if numpy is None:
+            codes = iter([self.country_codes[self.country_ids[bisect.bisect_right(self.starts, value) - 1]]
+                          for value in packed])
+        else:
+            if self.ipv6:
+                values = numpy.array(packed, dtype='S16')
+            else:
+                values = numpy.array(packed, dtype=numpy.uint32)
+            indexes = numpy.searchsorted(self.numpy_starts, values, side='right') - 1
+            codes = iter(self.numpy_country_codes[self.numpy_country_ids[indexes]].tolist())
+        return [next(codes) if is_valid else None for is_valid in valid]
+
+
+def load_databases(path, engine='pygeoip', mode='memory'):
+    """
+    Opens GeoIP.dat and GeoIPv6.dat in the directory 'path' with the given
+    engine. In 'mmap' mode the files are memory-mapped read-only, so all
+    processes on a host share them through the page cache, while 'memory'
+    mode reads them into private memory of each process.
+    """
+    filenames = (os.path.join(path, 'GeoIP.dat'), os.path.join(path, 'GeoIPv6.dat'))
+    if engine == 'ranges':
+        return tuple(RangeGeoIP(filename, ipv6=ipv6, mmap_cache=mode == 'mmap')
+                     for filename, ipv6 in zip(filenames, (False, True)))
+    flags = pygeoip.MMAP_CACHE if mode == 'mmap' else pygeoip.MEMORY_CACHE
+    return tuple(pygeoip.GeoIP(filename, flags) for filename in filenames)
+
+
+ENGINES = ('pygeoip', 'ranges')
+MODES = ('memory', 'mmap')
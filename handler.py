@@ -10,10 +10,19 @@
 # Import modules
 from tornado import web, gen,  escape
 from tornado.escape import utf8
+from tornado.util import raise_exc_info
+import hmac
+import json
 import logging
-import phonenumbers
-import pygeoip
-from tornado.iostream import StreamClosedError
+import sys
+import time
+import dlr
+import idempotency
+import metrics
+import profiling
+from limiter import LimiterUnavailableError
+from nexmoclient import NexmoUnavailableError
+from sendqueue import QueueUnavailableError
 
 
 class BaseHandler(web.RequestHandler):
@@ -21,13 +30,108 @@ class BaseHandler(web.RequestHandler):
     A base handler providing localization features, phone number validation
     and formation as well as use of service limitation based on IP addresses.
     It also implements support for JSONP (for cross-domain requests).
+
+    The time spent in the stages of a request (limit, parse, geoip, nexmo
+    and queue) is recorded by add_timing() and reported in the Server-Timing
+    header if the application setting 'server_timing' is True.
     """
     guess_country = True
     default_country = 'DE'
+    # Requests are rejected while the application is overloaded, see prepare().
+    shed_load = False
+    # Requests may be sampled by the application's profiling.RequestProfiler.
+    profile = False
+    # Requests in flight are awaited when the application shuts down.
+    track_in_flight = True
 
     def __init__(self, application, request, **kwargs):
         super(BaseHandler, self).__init__(application, request, **kwargs)
         self.counter = {}
+        self.timings = {}
+        self.tracked = False
+        self.profiled = False
+
+
+    def on_finish(self):
+        if self.tracked:
+            self.application.in_flight -= 1
+        if self.profiled:
+            self.application.profiler.stop()
+
+
+    def prepare(self):
+        """
+        Counts the request as in flight and starts profiling it if sampled.
+        Rejects the request with 503 before any work is done if this handler
+        sheds load and the application's admission.AdmissionControl reports
+        that it is overloaded.
+        """
+        if self.track_in_flight:
+            self.application.in_flight += 1
+            self.tracked = True
+        if self.profile:
+            self.profiled = self.application.profiler.start()
+        if not self.shed_load:
+            return
+        reason = self.application.admission.check()
+        if reason:
+            metrics.SHED_REQUESTS.labels(type(self).__name__, reason).inc()
+            self.set_status(503)
+            self.set_header('Retry-After', self.settings.get('shed_retry_after', 1))
+            self.finish({'status': 'error',
+                         'error': 'overloaded',
+                         'message': 'Service Overloaded'})
+
+
+    def log_exception(self, typ, value, tb):
+        """
+        Logs an unavailable limiter as a warning instead of an uncaught
+        exception, it is reported by write_error().
+        """
+        if isinstance(value, LimiterUnavailableError):
+            logging.warning('Rejecting request, the limiter is unavailable: ' + str(value))
+            return
+        super(BaseHandler, self).log_exception(typ, value, tb)
+
+
+    def write_error(self, status_code, **kwargs):
+        """
+        Rejects requests that can not be limited because the limiter fails
+        closed and its backend is unavailable.
+        """
+        if 'exc_info' in kwargs and isinstance(kwargs['exc_info'][1], LimiterUnavailableError):
+            self.set_status(503)
+            self.finish({'status': 'error',
+                         'error': 'limiter_unavailable',
+                         'message': 'Limiter Unavailable'})
+            return
+        super(BaseHandler, self).write_error(status_code, **kwargs)
+
+
+    def add_timing(self, stage, duration):
+        """
+        Adds 'duration' seconds to the time this request spent in 'stage'.
+        """
+        self.timings[stage] = self.timings.get(stage, 0.0) + duration
+
+
+    def get_server_timing(self):
+        """
+        Returns the stage timings and the total time of this request as the
+        value of a Server-Timing header.
+        """
+        timings = ['{};dur={:.3f}'.format(stage, duration * 1000) for stage, duration in sorted(self.timings.items())]
+        return ', '.join(timings + ['total;dur={:.3f}'.format(self.request.request_time() * 1000)])
+
+
+    def finish(self, chunk=None):
+        """
+        Overwrites the default finish method to add the Server-Timing header
+        unless the headers were flushed already.
+        """
+        if self.settings.get('server_timing') and not self._headers_written:
+            self.set_header('Server-Timing', self.get_server_timing())
+        return super(BaseHandler, self).finish(chunk)
 
 
     def write(self, chunk):
@@ -39,6 +143,8 @@ class BaseHandler(web.RequestHandler):
                                "by using async operations without the "
                                "@asynchronous decorator.")
         if isinstance(chunk, dict):
+            if 'status' in chunk:
+                metrics.RESPONSES.labels(type(self).__name__, chunk['status'], chunk.get('error', '')).inc()
             chunk = escape.json_encode(chunk)
             self.set_header("Content-Type", "application/json; charset=UTF-8")
             callback = self.get_argument('callback', None)
@@ -83,15 +189,9 @@ class BaseHandler(web.RequestHandler):
         Determines the user's country by his IP-address. This will return
         the country code or None if not found.
         """
-        try:
-            country = self.application.geo_ip.country_code_by_addr(
-                                                    self.request.remote_ip)
-        except pygeoip.GeoIPError:
-            try:
-                country = self.application.geo_ipv6.country_code_by_addr(
-                                                     self.request.remote_ip)
-            except pygeoip.GeoIPError:
-                pass
+        start = time.time()
+        country = self.application.geo_resolver.country_code_by_addr(self.request.remote_ip)
+        self.add_timing('geoip', time.time() - start)
         if not country:
             logging.warning('Could not locate country for ' + self.request.remote_ip)
             return None
@@ -104,9 +204,43 @@ class BaseHandler(web.RequestHandler):
         """
         Validates and parses a phonenumber. It will return a
         phone number object or False if parsing failed.
+        See parse_number() for how the country is guessed.
+        """
+        parsed = self.parse_number(number)
+        return parsed.number if parsed else False
 
-        If the phone number is not given in full international notion the
-        parameter the country will be guesses if the class attribute guess_country
+
+    def parse_number(self, number, country_code=None):
+        """
+        Validates and parses a phonenumber. It will return a
+        phonecache.ParsedNumber holding the phone number object and its
+        international and E164 formats or None if parsing failed. Results
+        are cached by the application's phone_cache.
+
+        If the phone number is not given in full international notion it is
+        parsed for the country 'country_code' or, if it is None, for the
+        country returned by guess_country_code().
+        """
+        phone_cache = self.application.phone_cache
+        start = time.time()
+        parsed = phone_cache.parse(number)
+        self.add_timing('parse', time.time() - start)
+        if parsed:
+            return parsed
+        # Parse the phone number into international notion.
+        country_code = country_code or self.guess_country_code()
+        start = time.time()
+        parsed = phone_cache.parse(number, country_code)
+        self.add_timing('parse', time.time() - start)
+        return parsed
+
+
+    def guess_country_code(self):
+        """
+        Returns the country code for phone numbers not given in full
+        international notion.
+
+        The country will be guesses if the class attribute guess_country
         is True. Guessing will be done as follows:
         1. If a query string parameter 'country' is given as a country code
         (i.e. 'US', 'DE', ...) it will be used.
@@ -116,75 +250,199 @@ class BaseHandler(web.RequestHandler):
         Accept-Language will be used.
         4. As a fall-back the classes default_country attribute will be used.
         """
-        try:
-            return phonenumbers.parse(number)
-        except:
-            # Get the country code to use for phone number parsing.
-            if self.__class__.guess_country:
-                country_code = self.get_argument('country', None)
-                if country_code == None:
-                    country_code = self.get_user_country_by_ip()
-                if country_code == None:
-                    code = self.get_browser_locale_code().replace('-', '_')
-                    parts = code.split('_')
-                    if len(parts) > 1: country_code = parts[1]
-                if country_code == None: country_code = self.__class__.default_country
-                country_code = country_code.upper()
-                logging.debug("Final country code: " + country_code)
-            else:
-                country_code = self.__class__.default_country
-            # Parse the phone number into international notion.
-            try:
-                number_parsed = phonenumbers.parse(number, country_code)
-                return number_parsed
-            except:
-                return False
+        if self.__class__.guess_country:
+            country_code = self.get_argument('country', None)
+            if country_code == None:
+                country_code = self.get_user_country_by_ip()
+            if country_code == None:
+                code = self.get_browser_locale_code().replace('-', '_')
+                parts = code.split('_')
+                if len(parts) > 1: country_code = parts[1]
+            if country_code == None: country_code = self.__class__.default_country
+            country_code = country_code.upper()
+            logging.debug("Final country code: " + country_code)
+        else:
+            country_code = self.__class__.default_country
+        return country_code
+
 
+    def get_batch_arguments(self, name):
+        """
+        Parses the body of a batch request. It is either a JSON object with
+        the list 'name' and an optional 'country' or plain text with one
+        item per line and the optional query string parameter 'country'.
+        Returns the list and the country or raises ValueError.
+        """
+        country_code = self.get_argument('country', None)
+        if self.request.headers.get('Content-Type', '').startswith('application/json'):
+            try:
+                body = json.loads(self.request.body)
+                items = body[name]
+                country_code = body.get('country', country_code)
+            except (TypeError, KeyError, AttributeError):
+                raise ValueError('Invalid batch request')
+            if not isinstance(items, list):
+                raise ValueError('Invalid batch request')
+            return items, country_code
+        items = [item.strip() for item in self.request.body.decode('utf-8', 'replace').splitlines()]
+        return [item for item in items if item], country_code
+
+    def check_country_argument(self, country_code):
+        """
+        Returns True if 'country_code' is a string or None. Otherwise, e.g.
+        for {"country": 49}, the request is finished with status 400.
+        """
+        if country_code is None or isinstance(country_code, basestring):
+            return True
+        self.set_status(400)
+        self.finish({'status': 'error',
+                     'error': 'invalid_arguments',
+                     'message': 'country must be a country code like "DE"'})
+        return False
 
     @gen.coroutine
-    def limit_call(self, chash=None, amount=2, expire=10):
+    def limit_call(self, chash=None, amount=2, expire=10, strategy='fixed_window', cost=1):
         """
         Use this function to limit user requests. Returns True if this function
         was called less then 'amount' times in the last 'expire' seconds with
         the same value 'chash' and the same remote IP address or False
-        otherwise.
+        otherwise. A call with a 'cost' counts as that many calls. See
+        limiter.BaseLimiter for the available strategies.
         """
-        key = 'limit_call_' + chash + '_' + self.request.remote_ip
-        redis = self.application.redis
-        try:
-            current_value = yield gen.Task(redis.get, key)
-        except StreamClosedError:
-            yield gen.Task(self.application.redis_reconnect)
-            redis = self.application.redis
-            current_value = yield gen.Task(redis.get, key)
-        if current_value != None and int(current_value) >= amount:
-            logging.info('Call Limitation acceded: ' + key)
-            raise gen.Return(False)
-        else:
-            yield gen.Task(redis.incr, key)
-            if not current_value: yield gen.Task(redis.expire, key, expire)
-            raise gen.Return(True)
+        start = time.time()
+        allowed = yield self.application.limiter.check(chash, self.request.remote_ip, amount, expire, strategy, cost)
+        duration = time.time() - start
+        metrics.LIMIT_CHECK.observe(duration)
+        self.add_timing('limit', duration)
+        raise gen.Return(allowed)
 
 
-class DLRHandler(web.RequestHandler):
+    @gen.coroutine
+    def limit_policy_call(self, policy, numbers, cost=1):
+        """
+        Limits user requests by the limits of 'policy' (see
+        configuration.LIMIT_POLICIES) in one call of the limiter. A request
+        sending to the phonecache.ParsedNumber list 'numbers' counts once
+        per receiver and country and 'cost' times per IP address and for the
+        handler. Returns None if the request is allowed or the dimension of
+        the first limit acceded otherwise.
+        """
+        chash = self.request.path
+        limits = []
+        dimensions = []
+        for limit in policy:
+            dimension, amount, expires = limit['dimension'], limit['amount'], limit['expires']
+            if dimension == 'ip':
+                costs = {self.request.remote_ip: cost}
+            elif dimension == 'handler':
+                costs = {'': cost}
+            else:
+                costs = {}
+                for number in numbers:
+                    value = number.e164 if dimension == 'receiver' else str(number.number.country_code)
+                    costs[value] = costs.get(value, 0) + 1
+            for value, value_cost in costs.items():
+                limits.append((self.application.limiter.get_policy_key(chash, dimension, amount, expires, value),
+                               amount, expires, value_cost))
+                dimensions.append(dimension)
+        start = time.time()
+        exceeded = yield self.application.limiter.check_many(limits)
+        duration = time.time() - start
+        metrics.LIMIT_CHECK.observe(duration)
+        self.add_timing('limit', duration)
+        raise gen.Return(None if exceeded is None else dimensions[exceeded])
+
+
+class DLRHandler(BaseHandler):
     """
-    Handles delivery receipts.
+    Handles delivery receipts. They are buffered and written to Redis in
+    batches by the application's dlr.ReceiptBuffer.
     """
     def get(self):
         """
-        All delivery receipts will be send as HTTP-GET requests.
+        Delivery receipts are sent as HTTP-GET or form encoded POST requests.
         """
-        # TODO: Parse request!
-        logging.info('Received DLR. Not yet parsed though.')
+        try:
+            receipt = dlr.parse_receipt(dict((name, self.get_argument(name)) for name in self.request.arguments))
+        except ValueError as exc:
+            logging.warning('Invalid DLR: {}'.format(exc))
+            raise web.HTTPError(400)
+        self.application.receipts.add(receipt)
 
+    post = get
 
 
+
+class MessageStatusHandler(BaseHandler):
+    """
+    Reports the latest delivery receipt of a message by its Nexmo message ID.
+    The route is public, so the receiver's number, the price and the network
+    are left out.
+    """
+
+    @gen.coroutine
+    def get(self, message_id):
+        receipt = yield self.application.receipts.get(message_id)
+        if not receipt:
+            self.set_status(404)
+            self.finish({'status': 'error',
+                         'error': 'receipt_not_found'})
+            return
+        self.finish({'status': 'ok',
+                     'message_id': message_id,
+                     'state': receipt['status'],
+                     'err_code': receipt['err_code'],
+                     'timestamp': receipt['timestamp'],
+                     'updated': receipt['updated']})
+
+
+
+@web.stream_request_body
 class NumberValidationHandler(BaseHandler):
     """
-    Validates a phone number.
+    Validates a phone number, or many with POST requests. The body of POST
+    requests is streamed, so that it is capped while it is read instead of
+    after Tornado buffered it (see prepare()).
     """
     limit_amount = 10
     limit_expires = 3600
+    limit_strategy = 'fixed_window'
+    shed_load = True
+    # Numbers of a batch counting as one call for the limitation.
+    batch_unit = 100
+    batch_max_size = 1000
+    # Bodies larger than batch_max_size times this are rejected before parsing.
+    batch_bytes_per_number = 64
+    # Number of results written at once in batch mode.
+    batch_flush_size = 500
+    profile = True
+
+    def prepare(self):
+        """
+        Caps the body of POST requests at 'batch_max_size' times
+        'batch_bytes_per_number'. Bodies announced to be larger are rejected
+        before they are read. The connection of bodies growing larger
+        anyway, e.g. chunked ones, is closed by Tornado.
+        """
+        super(NumberValidationHandler, self).prepare()
+        self.body_chunks = []
+        if self._finished or self.request.method != 'POST':
+            return
+        max_body_size = self.batch_max_size * self.batch_bytes_per_number
+        try:
+            content_length = int(self.request.headers.get('Content-Length', 0))
+        except ValueError:
+            content_length = 0
+        if content_length > max_body_size:
+            self.finish({'status': 'error',
+                         'error': 'batch_too_large'})
+            return
+        self.request.connection.set_max_body_size(max_body_size)
+
+
+    def data_received(self, chunk):
+        if not self._finished:
+            self.body_chunks.append(chunk)
 
     @gen.coroutine
     def get(self):
@@ -203,7 +461,8 @@ class NumberValidationHandler(BaseHandler):
         4. As a fall-back the classes attribute default_country will be used.
         """
         # Limit calls.
-        if self.limit_amount and not (yield self.limit_call('number_validation', self.limit_amount, self.limit_expires)):
+        if self.limit_amount and not (yield self.limit_call('number_validation', self.limit_amount, self.limit_expires,
+                                                                 self.limit_strategy)):
             #raise web.HTTPError(403, 'Number Validation request limit acceded')
             self.finish({'status': 'error',
                          'error': 'limit_acceded'})
@@ -216,14 +475,73 @@ class NumberValidationHandler(BaseHandler):
                          'error': 'number_missing'})
             return
         logging.debug('Received number {} for validation'.format(number))
-        numberobj = self.parse_phonenumber(number)
-        if numberobj:
-            number = phonenumbers.format_number(numberobj,
-                                   phonenumbers.PhoneNumberFormat.INTERNATIONAL)
+        parsed = self.parse_number(number)
+        if parsed:
+            number = parsed.international
         else: number = False
         self.finish({'status': 'ok',
                      'number': number})
 
+    @gen.coroutine
+    def post(self):
+        """
+        Validates a batch of phone numbers. The request body is either a JSON
+        object {"numbers": [...], "country": "US"} or one number per line
+        with the optional query string parameter 'country'. The country is
+        used for numbers not given in full international notion, otherwise
+        it is guessed like for GET requests.
+
+        The batch is limited like one call per 'batch_unit' numbers. The
+        results are streamed as JSON lines {"input": ..., "number": ...} in
+        the order of the numbers, "number" being False for invalid ones.
+
+        The body is parsed as a whole, so its size is capped by prepare() to
+        bound the memory of a request.
+        """
+        self.request.body = b''.join(self.body_chunks)
+        self.body_chunks = []
+        try:
+            numbers, country_code = self.get_batch_arguments('numbers')
+        except ValueError:
+            self.finish({'status': 'error',
+                         'error': 'invalid_request'})
+            return
+        if not self.check_country_argument(country_code):
+            return
+        if not numbers:
+            self.finish({'status': 'error',
+                         'error': 'number_missing'})
+            return
+        if len(numbers) > self.batch_max_size:
+            self.finish({'status': 'error',
+                         'error': 'batch_too_large'})
+            return
+
+        # Limit calls.
+        cost = (len(numbers) + self.batch_unit - 1) // self.batch_unit
+        if self.limit_amount and not (yield self.limit_call('number_validation', self.limit_amount, self.limit_expires,
+                                                                 self.limit_strategy, cost)):
+            self.finish({'status': 'error',
+                         'error': 'limit_acceded'})
+            return
+
+        logging.debug('Received {} numbers for validation'.format(len(numbers)))
+        # Guess the country only once per batch.
+        country_code = country_code.upper() if country_code else self.guess_country_code()
+        self.set_header('Content-Type', 'application/x-ndjson; charset=UTF-8')
+        lines = []
+        for number in numbers:
+            parsed = self.parse_number(number, country_code) if isinstance(number, basestring) else None
+            lines.append(json.dumps({'input': number,
+                                     'number': parsed.international if parsed else False}))
+            if len(lines) >= self.batch_flush_size:
+                self.write('\n'.join(lines) + '\n')
+                lines = []
+                yield self.flush()
+        if lines:
+            self.write('\n'.join(lines) + '\n')
+        self.finish()
+
 
 
 class SimpleMessageHandler(BaseHandler):
@@ -231,46 +549,362 @@ class SimpleMessageHandler(BaseHandler):
     sender = 'Put a sender title or number here'
     limit_amount = 10
     limit_expires = 3600
+    limit_strategy = 'fixed_window'
+    # Limits replacing limit_amount, see configuration.LIMIT_POLICIES.
+    limit_policy = None
+    bulk_max_size = 1000
+    # Receivers of bulk requests per IP address, counted apart from limit_amount.
+    bulk_limit_amount = 10000
+    bulk_limit_expires = 3600
+    shed_load = True
+    profile = True
 
     @gen.coroutine
     def get(self):
-        # Limit calls.
-        if self.limit_amount and not (yield (self.limit_call('example_handler', self.limit_amount, self.limit_expires))):
-            self.finish({'status': 'error',
-                         'error': 'limit_acceded'})
-            return
+        """
+        Sends the message to the receiver given as the query string parameter
+        'receiver'. If the application records idempotency keys, duplicates
+        of a request get its response without sending the message again, see
+        get_idempotency_key().
+        """
+        receiver = self.get_argument('receiver', None)
+
+        # Answer duplicates with the recorded response. They don't count for the limitation.
+        # Without idempotency keys the receiver is parsed after the limit check.
+        store = self.application.idempotency
+        parsed = self.parse_number(receiver) if receiver and store else None
+        key = self.get_idempotency_key(parsed) if store and parsed else None
+        if key:
+            recorded = yield store.claim(key)
+            if recorded is idempotency.IN_PROGRESS:
+                self.finish({'status': 'error',
+                             'error': 'request_in_progress',
+                             'number': parsed.international})
+                return
+            if recorded:
+                code, response = recorded
+                self.set_status(code)
+                self.set_header('Idempotent-Replayed', 'true')
+                self.finish(response)
+                return
+
+        try:
+            response = yield self.send_single(receiver, parsed)
+        except Exception:
+            if not key:
+                raise
+            # Release the key before re-raising, so that duplicates waiting for it and retries are processed.
+            exc_info = sys.exc_info()
+            yield store.complete(key, 500, {'status': 'error', 'error': 'internal_error'}, record=False)
+            raise_exc_info(exc_info)
+        if key:
+            # Only successful requests are recorded, failed ones may be retried.
+            yield store.complete(key, self.get_status(), response, record=response['status'] == 'ok')
+        self.finish(response)
+
+    def get_idempotency_key(self, parsed):
+        """
+        Returns the idempotency key of a request for the receiver 'parsed'.
+        It is given by the client as the header Idempotency-Key or the query
+        string parameter 'idempotency_key', otherwise it is derived from the
+        receiver's number, the remote IP address and the idempotency window
+        of the request, so that a recorded response is not replayed to other
+        clients or to requests sending again later. Keys are scoped by the
+        handler's path.
+        """
+        key = self.request.headers.get('Idempotency-Key') or self.get_argument('idempotency_key', None)
+        if key:
+            return u'{}:key:{}'.format(self.request.path, key)
+        window = int(time.time() // self.application.idempotency.ttl)
+        return u'{}:number:{}:{}:{}'.format(self.request.path, parsed.e164, self.request.remote_ip, window)
+
+    @gen.coroutine
+    def send_single(self, receiver, parsed):
+        """
+        Limits the request and sends the message to 'receiver' parsed as
+        'parsed'. If 'parsed' is None the receiver is parsed after the limit
+        check, so that clients over their limit don't pay for parsing.
+        Resolves to the response.
+        """
+        # Limit calls. Policies count per receiver and country, so they need the parsed number.
+        if self.limit_policy:
+            if parsed is None and receiver:
+                parsed = self.parse_number(receiver)
+            exceeded = yield self.limit_policy_call(self.limit_policy, [parsed] if parsed else [])
+            if exceeded:
+                raise gen.Return({'status': 'error',
+                                  'error': 'limit_acceded',
+                                  'limit': exceeded})
+        elif self.limit_amount and not (yield (self.limit_call('example_handler', self.limit_amount,
+                                                                self.limit_expires, self.limit_strategy))):
+            raise gen.Return({'status': 'error',
+                              'error': 'limit_acceded'})
 
         # Get receiver's phone number as 'receiver' parameter.
-        receiver = self.get_argument('receiver', None)
         if not receiver:
+            raise gen.Return({'status': 'error',
+                              'error': 'receiver_missing'})
+
+        # Check the parsed phone number.
+        if parsed is None:
+            parsed = self.parse_number(receiver)
+        if not parsed:
+            raise gen.Return({'status': 'error',
+                              'error': 'receiver_validation'})
+
+        # Formatted numbers for processing and displaying.
+        receiver_nice = parsed.international
+        receiver = parsed.e164
+
+        # In queue mode workers send the message later.
+        if self.application.send_queue:
+            start = time.time()
+            try:
+                job_ids = yield self.application.send_queue.enqueue([(self.__class__.sender, receiver, receiver_nice,
+                                                                      self.__class__.message)])
+            except QueueUnavailableError:
+                raise gen.Return({'status': 'error',
+                                  'error': 'queue_unavailable',
+                                  'message': 'Queue Unavailable',
+                                  'number': receiver_nice})
+            finally:
+                self.add_timing('queue', time.time() - start)
+            self.set_status(202)
+            raise gen.Return({'status': 'ok',
+                              'message': 'Message queued',
+                              'number': receiver_nice,
+                              'job_id': job_ids[0]})
+
+        # Send message to receiver.
+        start = time.time()
+        try:
+            result = yield self.application.nexmo_client.send(self.__class__.sender, receiver,
+                                                              self.__class__.message)
+        except NexmoUnavailableError:
+            raise gen.Return({'status': 'error',
+                              'error': 'nexmo_unavailable',
+                              'message': 'Nexmo Service Unavailable',
+                              'number': receiver_nice})
+        finally:
+            self.add_timing('nexmo', time.time() - start)
+
+        # Process result.
+        if result:
+            raise gen.Return({'status': 'ok',
+                              'message': 'Message sent',
+                              'number': receiver_nice,
+                              'message_ids': result})
+        raise gen.Return({'status': 'error',
+                          'error': 'nexmo_error',
+                          'message': 'Nexmo Service Error',
+                          'number': receiver_nice})
+
+    @gen.coroutine
+    def post(self):
+        """
+        Sends the message to many receivers. The request body is either a
+        JSON object {"receivers": [...], "country": "US"} or one receiver per
+        line with the optional query string parameter 'country'. All
+        receivers are validated before sending and the response reports the
+        result for every receiver in their order.
+
+        Requests must carry the application's bulk API key in the X-Api-Key
+        header. Every receiver counts as one call for the bulk limit
+        'bulk_limit_amount' or, if the handler has one, for the limit policy.
+        """
+        key = self.request.headers.get('X-Api-Key', '')
+        bulk_api_key = self.settings.get('bulk_api_key')
+        if not bulk_api_key or not hmac.compare_digest(utf8(key), utf8(bulk_api_key)):
+            raise web.HTTPError(403)
+        try:
+            receivers, country_code = self.get_batch_arguments('receivers')
+        except ValueError:
+            self.finish({'status': 'error',
+                         'error': 'invalid_request'})
+            return
+        if not self.check_country_argument(country_code):
+            return
+        if not receivers:
             self.finish({'status': 'error',
                          'error': 'receiver_missing'})
             return
+        if len(receivers) > self.bulk_max_size:
+            self.finish({'status': 'error',
+                         'error': 'batch_too_large'})
+            return
 
-        # Parse the given phone number.
-        receiverobj = self.parse_phonenumber(receiver)
-        if not receiverobj:
+        # Parse all phone numbers first.
+        country_code = country_code.upper() if country_code else self.guess_country_code()
+        parsed = [self.parse_number(receiver, country_code) if isinstance(receiver, basestring) else None
+                  for receiver in receivers]
+        valid = [number for number in parsed if number]
+
+        # Limit calls.
+        if self.limit_policy:
+            exceeded = yield self.limit_policy_call(self.limit_policy, valid, len(receivers))
+            if exceeded:
+                self.finish({'status': 'error',
+                             'error': 'limit_acceded',
+                             'limit': exceeded})
+                return
+        elif self.bulk_limit_amount and not (yield (self.limit_call('bulk_message', self.bulk_limit_amount,
+                                                                     self.bulk_limit_expires, self.limit_strategy,
+                                                                     len(receivers)))):
             self.finish({'status': 'error',
-                         'error': 'receiver_validation'})
+                         'error': 'limit_acceded'})
             return
 
-        # Format numbers for processing and displaying.
-        receiver_nice = phonenumbers.format_number(receiverobj,
-                                   phonenumbers.PhoneNumberFormat.INTERNATIONAL)
-        receiver = phonenumbers.format_number(receiverobj,
-                                   phonenumbers.PhoneNumberFormat.E164)
+        # Send message to all valid receivers or queue it in queue mode.
+        queued = bool(self.application.send_queue)
+        start = time.time()
+        if queued:
+            try:
+                results = iter((yield self.application.send_queue.enqueue([(self.__class__.sender, number.e164,
+                                                                            number.international,
+                                                                            self.__class__.message)
+                                                                           for number in valid])))
+            except QueueUnavailableError:
+                self.finish({'status': 'error',
+                             'error': 'queue_unavailable',
+                             'message': 'Queue Unavailable'})
+                return
+        else:
+            results = iter((yield self.application.nexmo_client.send_many(self.__class__.sender,
+                                                                          [number.e164 for number in valid],
+                                                                          self.__class__.message)))
+        self.add_timing('queue' if queued else 'nexmo', time.time() - start)
+
+        # Process results.
+        report = []
+        for receiver, number in zip(receivers, parsed):
+            if not number:
+                report.append({'receiver': receiver, 'number': False,
+                               'status': 'error', 'error': 'receiver_validation'})
+                continue
+            result = next(results)
+            if queued:
+                report.append({'receiver': receiver, 'number': number.international, 'status': 'queued',
+                               'job_id': result})
+            elif result:
+                report.append({'receiver': receiver, 'number': number.international, 'status': 'ok',
+                               'message_ids': result})
+            else:
+                report.append({'receiver': receiver, 'number': number.international, 'status': 'error',
+                               'error': 'nexmo_unavailable' if result is None else 'nexmo_error'})
+        if queued:
+            self.set_status(202)
+            self.finish({'status': 'ok',
+                         'queued': len(valid),
+                         'failed': len(report) - len(valid),
+                         'results': report})
+            return
+        sent = len([item for item in report if item['status'] == 'ok'])
+        self.finish({'status': 'ok',
+                     'sent': sent,
+                     'failed': len(report) - sent,
+                     'results': report})
 
-        # Send message to receiver.
-        result = yield gen.Task(self.application.nexmo_client.send_message,
-                                self.__class__.sender, receiver,
-                                self.__class__.message)
 
-        # Process result.
-        if result: self.finish({'status': 'ok',
-                                'message': 'Message sent',
-                                'number': receiver_nice})
-        else: self.finish({'status': 'error',
-                           'error': 'nexmo_error',
-                           'message': 'Nexmo Service Error',
-                           'number': receiver_nice})
+class JobStatusHandler(BaseHandler):
+    """
+    Reports the state of a message queued in queue mode.
+    """
+
+    @gen.coroutine
+    def get(self, job_id):
+        job = yield self.application.send_queue.get_job(job_id)
+        if not job:
+            self.set_status(404)
+            self.finish({'status': 'error',
+                         'error': 'job_not_found'})
+            return
+        self.finish({'status': 'ok',
+                     'job_id': job_id,
+                     'state': job['status'],
+                     'number': job['number'].decode('utf-8'),
+                     'message_ids': job['message_ids'].split(',') if job.get('message_ids') else [],
+                     'created': int(job['created']),
+                     'updated': int(job['updated'])})
+
+
+class MetricsHandler(BaseHandler):
+    """
+    Exposes the metrics of this process in the Prometheus text format.
+    """
+    track_in_flight = False
+
+    def get(self):
+        application = self.application
+        metrics.REQUESTS_IN_FLIGHT.set(application.in_flight)
+        governor = application.nexmo_client.governor
+        metrics.NEXMO_IN_FLIGHT.set(governor.in_flight)
+        metrics.NEXMO_QUEUED.set(len(governor.queue))
+        metrics.REDIS_READY.set(application.redis_pool.ready_count() if application.redis_pool else 0)
+        # Copy the stats of the components.
+        metrics.set_cache_stats('blocked_clients', application.limiter.stats()['blocked_cache'])
+        metrics.set_cache_stats('geoip', application.geo_resolver.stats())
+        metrics.set_cache_stats('phone_numbers', application.phone_cache.stats())
+        metrics.GOVERNOR_WAIT.labels('avg').set(governor.total_wait / governor.started if governor.started else 0.0)
+        metrics.GOVERNOR_WAIT.labels('max').set(governor.max_wait)
+        client_stats = application.nexmo_client.counters
+        metrics.NEXMO_RETRIES.labels().set(client_stats['retries'])
+        metrics.NEXMO_GAVE_UP.labels().set(client_stats['gave_up'])
+        if application.receipts:
+            receipt_stats = application.receipts.stats()
+            for event in ('received', 'written', 'dropped'):
+                metrics.DLR_RECEIPTS.labels(event).set(receipt_stats[event])
+            metrics.DLR_BATCHES.labels('written').set(receipt_stats['batches'])
+            metrics.DLR_BATCHES.labels('failed').set(receipt_stats['failed_batches'])
+            metrics.DLR_PENDING.set(receipt_stats['pending'])
+            metrics.DLR_FLUSH_MAX.set(application.receipts.flush_time_max)
+        if application.idempotency:
+            idempotency_stats = application.idempotency.stats()
+            for outcome in ('stored', 'released', 'errors'):
+                metrics.IDEMPOTENCY_KEYS.labels(outcome).set(idempotency_stats[outcome])
+            metrics.IDEMPOTENCY_WAITING.set(idempotency_stats['waiting'])
+        self.set_header('Content-Type', metrics.CONTENT_TYPE)
+        self.finish(metrics.expose())
+
+
+
+class ProfileHandler(BaseHandler):
+    """
+    Admin route of the application's profiling.RequestProfiler. Requests
+    must carry the admin token in the X-Admin-Token header.
+    GET reports the aggregated results (query string parameters 'sort' and
+    'limit'), POST sets the 'sample_rate' and DELETE discards the results.
+    """
+    track_in_flight = False
 
+    def prepare(self):
+        token = self.request.headers.get('X-Admin-Token', '')
+        admin_token = self.settings.get('admin_token')
+        if not admin_token or not hmac.compare_digest(utf8(token), utf8(admin_token)):
+            raise web.HTTPError(403)
+        super(ProfileHandler, self).prepare()
+
+    def get(self):
+        sort = self.get_argument('sort', 'cumulative')
+        if sort not in profiling.SORT_KEYS:
+            raise web.HTTPError(400, 'sort must be one of: {}'.format(', '.join(profiling.SORT_KEYS)))
+        try:
+            limit = int(self.get_argument('limit', 50))
+        except ValueError:
+            raise web.HTTPError(400, 'limit must be a number')
+        self.set_header('Content-Type', 'text/plain; charset=UTF-8')
+        self.finish(self.application.profiler.report(sort, limit))
+
+    def post(self):
+        try:
+            sample_rate = float(self.get_argument('sample_rate'))
+        except ValueError:
+            sample_rate = -1
+        if not 0 <= sample_rate <= 1:
+            raise web.HTTPError(400, 'sample_rate must be between 0 and 1')
+        self.application.profiler.sample_rate = sample_rate
+        logging.info('Profiling sample rate set to {}'.format(sample_rate))
+        self.finish(dict(self.application.profiler.stats(), status='ok'))
+
+    def delete(self):
+        self.application.profiler.reset()
+        self.finish(dict(self.application.profiler.stats(), status='ok'))
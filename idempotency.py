@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+# coding=UTF-8
+# Title:       idempotency.py
+# Description: Records the responses of message requests to answer duplicates without sending again.
+# Author       David Nellessen <david.nellessen@familo.net>
+# Date:        16.10.26
+# Note:
+# ==============================================================================
+
+# Import modules
+import hashlib
+import json
+import logging
+import math
+from tornado import gen
+from tornado.concurrent import Future
+from limiter import RedisScript
+import metrics
+
+
+# Prefix of the Redis keys holding the recorded responses.
+KEY_PREFIX = 'idempotency:'
+
+# Value of a key whose request is still being processed.
+PENDING = 'pending'
+
+# Seconds a claim outlives the longest send, covering the wait for the send
+# governor and the queueing of the request.
+PENDING_MARGIN = 30
+
+# Returned by IdempotencyStore.claim() for a duplicate of a request another
+# process is still processing.
+IN_PROGRESS = object()
+
+# Passed to duplicates waiting for a request that failed, they claim the key
+# again.
+RELEASED = object()
+
+
+class IdempotencyStore(object):
+    """
+    Records the responses of requests by an idempotency key in Redis for
+    'ttl' seconds, so duplicates (double clicks, client retries) get the
+    recorded response instead of being processed again.
+
+    A request claims its key with claim() and must call complete() with its
+    response. The claim and the lookup of a recorded response are one atomic
+    Redis call. A claimed key expires after 'pending_ttl' seconds if the
+    process dies before completing it, so it must be longer than the
+    slowest request, see get_pending_ttl(). Duplicates of a request this process
+    is still processing wait for its response, or are processed one after
+    another if it fails.
+
+    Like limiter.RedisLimiter this uses the Redis connection of
+    'application'.
+    """
+    # Returns the recorded value or claims the key and returns 1.
+    claim_script = RedisScript("""
+local value = redis.call('GET', KEYS[1])
+if value then
+    return value
+end
+redis.call('SET', KEYS[1], '""" + PENDING + """', 'EX', ARGV[1])
+return 1
+""")
+
+    def __init__(self, application, ttl=60, pending_ttl=30):
+        self.application = application
+        self.ttl = ttl
+        self.pending_ttl = pending_ttl
+        self.waiting = {}
+        self.counters = {'claims': 0, 'hits': 0, 'coalesced': 0, 'in_progress': 0, 'stored': 0, 'released': 0,
+                         'errors': 0}
+
+    @staticmethod
+    def get_pending_ttl(nexmo_client):
+        """
+        Returns the seconds a claim must last for requests sending with the
+        nexmoclient.AsyncNexmoClient 'nexmo_client'.
+        """
+        return int(math.ceil(nexmo_client.get_max_send_time())) + PENDING_MARGIN
+
+    @staticmethod
+    def get_key(key):
+        return KEY_PREFIX + hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+    @gen.coroutine
+    def claim(self, key):
+        """
+        Resolves to None if the request with the idempotency 'key' is to be
+        processed, to a tuple of the status code and the response of a
+        previous request or to IN_PROGRESS. If Redis is unavailable the
+        request is processed.
+        """
+        if key in self.waiting:
+            self.counters['coalesced'] += 1
+            metrics.IDEMPOTENCY.labels('coalesced').inc()
+            result = yield self.waiting[key]
+            if result is RELEASED:
+                result = yield self.claim(key)
+            raise gen.Return(result)
+        future = self.waiting[key] = Future()
+        try:
+            value = yield self.claim_script(self.application.redis, [self.get_key(key)], [self.pending_ttl])
+        except Exception:
+            logging.exception('Claiming idempotency key failed')
+            self.counters['errors'] += 1
+            value = None
+        if value is None or value == 1:
+            self.counters['claims'] += 1
+            metrics.IDEMPOTENCY.labels('claim').inc()
+            raise gen.Return(None)
+        if value == PENDING:
+            self.counters['in_progress'] += 1
+            metrics.IDEMPOTENCY.labels('in_progress').inc()
+            result = IN_PROGRESS
+        else:
+            self.counters['hits'] += 1
+            metrics.IDEMPOTENCY.labels('hit').inc()
+            result = tuple(json.loads(value))
+        del self.waiting[key]
+        future.set_result(result)
+        raise gen.Return(result)
+
+    @gen.coroutine
+    def complete(self, key, code, response, record=True):
+        """
+        Completes a claimed key with the status code and the response of its
+        request. The response is recorded if 'record' is True and duplicates
+        waiting in this process get it. Otherwise the key is released so that
+        a retry is processed again, and so is the first duplicate waiting.
+        """
+        future = self.waiting.pop(key, None)
+        if future and record:
+            future.set_result((code, response))
+        redis_key = self.get_key(key)
+        try:
+            if record:
+                result = yield gen.Task(self.application.redis.setex, redis_key, self.ttl,
+                                        json.dumps([code, response]))
+                self.counters['stored'] += 1
+            else:
+                result = yield gen.Task(self.application.redis.delete, redis_key)
+                self.counters['released'] += 1
+            if isinstance(result, Exception):
+                raise result
+        except Exception:
+            logging.exception('Completing idempotency key failed')
+            self.counters['errors'] += 1
+        if future and not record:
+            # Only after the key was deleted, so that it can be claimed again.
+            future.set_result(RELEASED)
+
+    def stats(self):
+        stats = dict(self.counters)
+        stats['waiting'] = len(self.waiting)
+        return stats
@@ -0,0 +1,517 @@
+#!/usr/bin/env python
+# coding=UTF-8
+# Title:       limiter.py
+# Description: Rate limiter engines used by BaseHandler.limit_call
+# Author       David Nellessen <david.nellessen@familo.net>
+# Date:        16.10.26
+# Note:
+# ==============================================================================
+
+# Import modules
+import binascii
+import hashlib
+import heapq
+import logging
+import socket
+import time
+import zlib
+from collections import deque
+from tornado import gen
+from tornado.iostream import StreamClosedError
+from cache import LRUCache
+from redispool import RedisUnavailableError
+
+
+class LimiterUnavailableError(Exception):
+    """
+    Raised by a limiter that fails closed if it can not count a call.
+    """
+    pass
+
+
+class RedisScript(object):
+    """
+    A Lua script that is executed with EVALSHA. If Redis does not know the
+    script yet (e.g. after a restart or SCRIPT FLUSH) it falls back to EVAL
+    which also loads the script for subsequent calls. This way a script
+    costs exactly one round trip in the common case.
+
+    Note: toredis' eval() and evalsha() overwrite their args parameter, so
+    the commands are sent with send_message() directly.
+    """
+    def __init__(self, source):
+        self.source = source
+        self.sha = hashlib.sha1(source).hexdigest()
+
+    @gen.coroutine
+    def __call__(self, redis, keys, args):
+        params = [len(keys)] + list(keys) + list(args)
+        result = yield gen.Task(redis.send_message, ['EVALSHA', self.sha] + params)
+        if isinstance(result, Exception) and str(result).startswith('NOSCRIPT'):
+            result = yield gen.Task(redis.send_message, ['EVAL', self.source] + params)
+        if isinstance(result, Exception):
+            raise result
+        raise gen.Return(result)
+
+
+# Matches the keys of all limiter strategies and key layouts.
+KEY_PATTERN = 'limit_call_*'
+
+
+def pack_ip(ip):
+    """
+    Returns the binary representation of an IPv4 or IPv6 address.
+    """
+    try:
+        if ':' in ip:
+            return socket.inet_pton(socket.AF_INET6, ip)
+        return socket.inet_pton(socket.AF_INET, ip)
+    except (socket.error, ValueError):
+        # Not an IP address, e.g. a unix socket. Keep it as it is.
+        return ip
+
+
+def reset_limits(redis):
+    """
+    Deletes all limit counters of the Redis limiter backend in any key
+    layout. 'redis' is a synchronous redis-py client, e.g. in tests.
+    """
+    for key in redis.scan_iter(KEY_PATTERN):
+        redis.delete(key)
+
+
+class BaseLimiter(object):
+    """
+    Interface of the rate limiter backends. A call is allowed if it was
+    done less than 'amount' times in the last 'expire' seconds with the
+    same 'chash' and the same remote IP address. How this is counted
+    depends on the strategy:
+
+    fixed_window: Counts calls in a window of 'expire' seconds starting
+    with the first call. A client may do up to twice 'amount' calls
+    across a window boundary.
+
+    gcra: The generic cell rate algorithm stores one timestamp per client,
+    the theoretical arrival time of the next call. It allows bursts of
+    'amount' calls and then one call every 'expire' / 'amount' seconds.
+
+    A call may have a 'cost' of several units, e.g. for batch requests. It
+    is allowed only if all units fit into the limit and then counts as
+    'cost' calls.
+
+    Clients known to be over their limit are remembered in a local
+    LRUCache until their limit expires. Repeated calls of these clients
+    are rejected without asking the backend. Set 'blocked_cache_size' to
+    0 to disable this.
+
+    Backends implement a hit_<strategy>() method for every strategy.
+    """
+    def __init__(self, blocked_cache_size=0):
+        self.blocked_cache = LRUCache(blocked_cache_size)
+
+    @staticmethod
+    def get_key(chash, remote_ip, strategy='fixed_window'):
+        if strategy == 'fixed_window':
+            return 'limit_call_' + chash + '_' + remote_ip
+        return 'limit_call_' + strategy + '_' + chash + '_' + remote_ip
+
+    @staticmethod
+    def get_policy_key(chash, dimension, amount, expire, value=''):
+        # Limits of a dimension differing in their window or amount, e.g. a
+        # burst and a sustained limit per IP, are counted separately.
+        return 'limit_call_policy_{}_{}_{}_{}_{}'.format(chash, dimension, expire, amount, value)
+
+    @gen.coroutine
+    def check(self, chash, remote_ip, amount, expire, strategy='fixed_window', cost=1):
+        """
+        Returns True if the call is allowed (and counts it) or False if the
+        limit is acceded.
+        """
+        if self.blocked_cache.size and self.blocked_cache.get((chash, remote_ip)):
+            raise gen.Return(False)
+        allowed, ttl = yield getattr(self, 'hit_' + strategy)(chash, remote_ip, amount, expire, cost)
+        if not allowed:
+            logging.info('Call Limitation acceded: ' + self.get_key(chash, remote_ip, strategy))
+            # Calls of a smaller cost may still be allowed if this one is not.
+            if ttl > 0 and cost == 1:
+                self.blocked_cache.set((chash, remote_ip), True, time.time() + ttl / 1000.0)
+            raise gen.Return(False)
+        raise gen.Return(True)
+
+    @gen.coroutine
+    def check_many(self, limits):
+        """
+        Checks several fixed window limits of a call at once, e.g. per IP,
+        receiver and handler (see LIMIT_DIMENSIONS). 'limits' is a list of
+        tuples (key, amount, expire, cost) with distinct keys, e.g. from
+        get_policy_key(). The call is counted by all limits only if every
+        one allows it. Resolves to None if the call is allowed or to the
+        index of the first limit acceded otherwise.
+        """
+        allowed, ttl, index = yield self.hit_many(limits)
+        if not allowed:
+            logging.info('Call Limitation acceded: ' + limits[index][0])
+            raise gen.Return(index)
+        raise gen.Return(None)
+
+    def hit_fixed_window(self, chash, remote_ip, amount, expire, cost=1):
+        """
+        Counts a call of 'remote_ip' for 'chash' costing 'cost' units if it
+        is allowed. Must return a Future resolving to a tuple (allowed,
+        ttl) where ttl is the time in milliseconds until the next call is
+        allowed if this call is not.
+        """
+        raise NotImplementedError()
+
+    def hit_gcra(self, chash, remote_ip, amount, expire, cost=1):
+        """
+        Like hit_fixed_window() but using the generic cell rate algorithm.
+        """
+        raise NotImplementedError()
+
+    def hit_many(self, limits):
+        """
+        Counts a call for all 'limits' if every one allows it. Must return a
+        Future resolving to a tuple (allowed, ttl, index) where index is
+        the index of the first limit acceded or None.
+        """
+        raise NotImplementedError()
+
+    @staticmethod
+    def get_emission_interval(amount, expire):
+        """
+        Returns the time in milliseconds between two calls allowed by gcra.
+        """
+        return max(1, int(round(expire * 1000.0 / amount)))
+
+    def stats(self):
+        return {'blocked_cache': self.blocked_cache.stats()}
+
+
+class RedisLimiter(BaseLimiter):
+    """
+    Rate limiter storing its counters in Redis. Every strategy runs
+    atomically in one Lua script on a single key, so there is only one
+    round trip per call and no race between several application instances.
+
+    With the 'plain' key layout there is one key per handler and client
+    (see get_key()). With the 'compact' layout fixed window counters are
+    grouped into Redis hashes per handler and window, spread over
+    'compact_shards' hashes. The field is the binary packed IP address
+    (4 or 16 bytes) and every hash expires once at the end of its window.
+    Windows are aligned to multiples of 'expire' seconds in this layout.
+    Keep the hashes below Redis' hash-max-ziplist-entries so they are
+    stored as compact ziplists. Switching the layout needs no migration,
+    counters of the former layout just expire. The gcra strategy always
+    uses plain keys since it stores a single value per client anyway.
+
+    If no Redis connection is available or the reply is lost, the call is
+    counted in the 'redis_errors' stats and LimiterUnavailableError is
+    raised, unless the limiter fails open ('fail_open'), in which case the
+    call is allowed.
+    """
+    # ARGV[1] is the amount, ARGV[2] the expiry in seconds and ARGV[3] the
+    # cost. Returns {1, 0} if the call is allowed or {0, ttl in ms}
+    # otherwise.
+    fixed_window_script = RedisScript("""
+local current = tonumber(redis.call('GET', KEYS[1]))
+if (current or 0) + tonumber(ARGV[3]) > tonumber(ARGV[1]) then
+    return {0, redis.call('PTTL', KEYS[1])}
+end
+redis.call('INCRBY', KEYS[1], ARGV[3])
+if not current then
+    redis.call('EXPIRE', KEYS[1], ARGV[2])
+end
+return {1, 0}
+""")
+
+    # ARGV[1] is the emission interval, ARGV[2] the period in ms and ARGV[3]
+    # the cost. Returns
+    # {1, 0} if the call is allowed or {0, ms until it is allowed} otherwise.
+    # TIME is used so all instances share Redis' clock, which requires
+    # effects replication of the script.
+    gcra_script = RedisScript("""
+redis.replicate_commands()
+local time = redis.call('TIME')
+local now = tonumber(time[1]) * 1000 + math.floor(tonumber(time[2]) / 1000)
+local interval = tonumber(ARGV[1])
+local tat = tonumber(redis.call('GET', KEYS[1]))
+if not tat or tat < now then
+    tat = now
+end
+local new_tat = tat + interval * tonumber(ARGV[3])
+local wait = new_tat - now - tonumber(ARGV[2])
+if wait > 0 then
+    return {0, wait}
+end
+redis.call('SET', KEYS[1], string.format('%d', new_tat), 'PX', new_tat - now)
+return {1, 0}
+""")
+
+    # ARGV[1] is the packed IP address as hex, ARGV[2] the amount, ARGV[3]
+    # the UNIX time the window ends and ARGV[4] the cost. Returns like
+    # fixed_window_script.
+    compact_fixed_window_script = RedisScript("""
+local field = string.gsub(ARGV[1], '..', function(c) return string.char(tonumber(c, 16)) end)
+local current = tonumber(redis.call('HGET', KEYS[1], field))
+if (current or 0) + tonumber(ARGV[4]) > tonumber(ARGV[2]) then
+    return {0, redis.call('PTTL', KEYS[1])}
+end
+redis.call('HINCRBY', KEYS[1], field, ARGV[4])
+if not current then
+    redis.call('EXPIREAT', KEYS[1], ARGV[3])
+end
+return {1, 0}
+""")
+
+    # Every key is a fixed window counter. ARGV holds the amount, the expiry
+    # in seconds and the cost for every key. Returns {1, 0, 0} if the call
+    # is allowed by all counters or {0, ttl in ms, index of the counter}
+    # otherwise.
+    many_script = RedisScript("""
+local counts = {}
+for i, key in ipairs(KEYS) do
+    local current = tonumber(redis.call('GET', key))
+    if (current or 0) + tonumber(ARGV[i * 3]) > tonumber(ARGV[i * 3 - 2]) then
+        return {0, redis.call('PTTL', key), i}
+    end
+    counts[i] = current or false
+end
+for i, key in ipairs(KEYS) do
+    redis.call('INCRBY', key, ARGV[i * 3])
+    if not counts[i] then
+        redis.call('EXPIRE', key, ARGV[i * 3 - 1])
+    end
+end
+return {1, 0, 0}
+""")
+
+    def __init__(self, application, blocked_cache_size=10000, key_layout='plain', compact_shards=4096,
+                 fail_open=False):
+        super(RedisLimiter, self).__init__(blocked_cache_size)
+        self.application = application
+        self.key_layout = key_layout
+        self.compact_shards = compact_shards
+        self.fail_open = fail_open
+        self.redis_errors = 0
+
+    @gen.coroutine
+    def run_script(self, script, keys, args, default=(True, 0)):
+        try:
+            try:
+                result = yield script(self.application.redis, keys, args)
+            except StreamClosedError:
+                # The connection closed right now, the pool reconnects it in the
+                # background. Just try again with the next one.
+                result = yield script(self.application.redis, keys, args)
+        except RedisUnavailableError:
+            logging.warning('No Redis connection available for ' + ', '.join(keys))
+            result = None
+        else:
+            if result is None:
+                # The connection was lost while waiting for the reply.
+                logging.warning('No reply from Redis for ' + ', '.join(keys))
+        if result is None:
+            self.redis_errors += 1
+            if not self.fail_open:
+                raise LimiterUnavailableError('Counting the call failed for ' + ', '.join(keys))
+            raise gen.Return(default)
+        raise gen.Return(tuple(result))
+
+    def stats(self):
+        stats = super(RedisLimiter, self).stats()
+        stats['redis_errors'] = self.redis_errors
+        return stats
+
+    def hit_fixed_window(self, chash, remote_ip, amount, expire, cost=1):
+        if self.key_layout == 'compact':
+            window = int(time.time() // expire)
+            packed_ip = pack_ip(remote_ip)
+            key = self.get_compact_key(chash, packed_ip, window, self.compact_shards)
+            return self.run_script(self.compact_fixed_window_script, [key],
+                                   [binascii.hexlify(packed_ip), amount, (window + 1) * expire, cost])
+        key = self.get_key(chash, remote_ip)
+        return self.run_script(self.fixed_window_script, [key], [amount, expire, cost])
+
+    @staticmethod
+    def get_compact_key(chash, packed_ip, window, shards):
+        """
+        Returns the key of the hash holding the counter of 'packed_ip' for
+        handler 'chash' in the given window.
+        """
+        handler_id = '%08x' % (zlib.crc32(chash) & 0xffffffff)
+        shard = (zlib.crc32(packed_ip) & 0xffffffff) % shards
+        return 'limit_call_{}:{}:{}'.format(handler_id, window, shard)
+
+    @gen.coroutine
+    def hit_many(self, limits):
+        args = []
+        for key, amount, expire, cost in limits:
+            args += [amount, expire, cost]
+        allowed, ttl, index = yield self.run_script(self.many_script, [limit[0] for limit in limits], args,
+                                                    (True, 0, 0))
+        raise gen.Return((bool(allowed), ttl, index - 1 if not allowed else None))
+
+    def hit_gcra(self, chash, remote_ip, amount, expire, cost=1):
+        key = self.get_key(chash, remote_ip, 'gcra')
+        return self.run_script(self.gcra_script, [key],
+                               [self.get_emission_interval(amount, expire), expire * 1000, cost])
+
+
+class MemoryLimiter(BaseLimiter):
+    """
+    Rate limiter keeping its counters in process memory. Use it for
+    deployments running a single process only, since the counters are not
+    shared.
+
+    Counters are registered in expiry buckets of 'bucket_width' seconds.
+    Every call sweeps at most 'sweep_batch' counters of buckets that have
+    expired, so there is never a full scan. If more than 'max_entries'
+    counters exist the ones expiring next are dropped early.
+    """
+    def __init__(self, max_entries=1000000, bucket_width=1, sweep_batch=100, clock=time.time):
+        super(MemoryLimiter, self).__init__(0)
+        self.max_entries = max_entries
+        self.bucket_width = bucket_width
+        self.sweep_batch = sweep_batch
+        self.clock = clock
+        self.counters = {}
+        self.buckets = {}
+        self.bucket_heap = []
+        self.evictions = 0
+
+    def get_bucket(self, expires):
+        return int(expires // self.bucket_width)
+
+    def get_counter(self, key, now):
+        """
+        Returns the counter [value, expires] for 'key' or None if there is
+        no counter or it has expired.
+        """
+        counter = self.counters.get(key)
+        if counter is None or counter[1] <= now:
+            return None
+        return counter
+
+    def set_counter(self, key, value, expires):
+        counter = self.counters.get(key)
+        bucket = self.get_bucket(expires)
+        if counter is None or self.get_bucket(counter[1]) != bucket:
+            if bucket not in self.buckets:
+                self.buckets[bucket] = deque()
+                heapq.heappush(self.bucket_heap, bucket)
+            self.buckets[bucket].append(key)
+        self.counters[key] = [value, expires]
+
+    @gen.coroutine
+    def hit_fixed_window(self, chash, remote_ip, amount, expire, cost=1):
+        key = self.get_key(chash, remote_ip)
+        now = self.clock()
+        self.sweep(now)
+        counter = self.get_counter(key, now)
+        if (counter[0] if counter else 0) + cost > amount:
+            raise gen.Return((False, int((counter[1] - now) * 1000) if counter else 0))
+        if counter is None:
+            self.set_counter(key, cost, now + expire)
+        else:
+            counter[0] += cost
+        raise gen.Return((True, 0))
+
+    @gen.coroutine
+    def hit_many(self, limits):
+        now = self.clock()
+        self.sweep(now)
+        counters = []
+        for index, (key, amount, expire, cost) in enumerate(limits):
+            counter = self.get_counter(key, now)
+            if (counter[0] if counter else 0) + cost > amount:
+                raise gen.Return((False, int((counter[1] - now) * 1000) if counter else 0, index))
+            counters.append(counter)
+        for (key, amount, expire, cost), counter in zip(limits, counters):
+            if counter is None:
+                self.set_counter(key, cost, now + expire)
+            else:
+                counter[0] += cost
+        raise gen.Return((True, 0, None))
+
+    @gen.coroutine
+    def hit_gcra(self, chash, remote_ip, amount, expire, cost=1):
+        key = self.get_key(chash, remote_ip, 'gcra')
+        now = self.clock()
+        self.sweep(now)
+        counter = self.get_counter(key, now)
+        tat = max(counter[0], now) if counter else now
+        new_tat = tat + self.get_emission_interval(amount, expire) * cost / 1000.0
+        wait = new_tat - now - expire
+        if wait > 0:
+            raise gen.Return((False, int(wait * 1000)))
+        self.set_counter(key, new_tat, new_tat)
+        raise gen.Return((True, 0))
+
+    def sweep(self, now):
+        """
+        Removes up to 'sweep_batch' counters of expired buckets, or of the
+        next buckets to expire if there are too many counters.
+        """
+        current = self.get_bucket(now)
+        budget = self.sweep_batch
+        while self.bucket_heap and budget > 0:
+            bucket = self.bucket_heap[0]
+            if bucket >= current and len(self.counters) <= self.max_entries:
+                break
+            keys = self.buckets[bucket]
+            key = keys.popleft()
+            budget -= 1
+            counter = self.counters.get(key)
+            # The key may have been registered again in a later bucket.
+            if counter is not None and self.get_bucket(counter[1]) == bucket:
+                del self.counters[key]
+                if bucket >= current:
+                    self.evictions += 1
+            if not keys:
+                heapq.heappop(self.bucket_heap)
+                del self.buckets[bucket]
+
+    def stats(self):
+        stats = super(MemoryLimiter, self).stats()
+        stats.update({'counters': len(self.counters),
+                      'max_entries': self.max_entries,
+                      'buckets': len(self.buckets),
+                      'evictions': self.evictions})
+        return stats
+
+
+BACKENDS = {
+    'redis': RedisLimiter,
+    'memory': MemoryLimiter,
+}
+
+STRATEGIES = ('fixed_window', 'gcra')
+
+KEY_LAYOUTS = ('plain', 'compact')
+
+# Dimensions of a limit policy: the client's IP address, the receiver's
+# phone number, the receiver's country calling code and the handler as a
+# whole.
+LIMIT_DIMENSIONS = ('ip', 'receiver', 'country', 'handler')
+
+
+def validate_policy(policy):
+    """
+    Raises ValueError if 'policy', a list of limits like in
+    configuration.LIMIT_POLICIES, is invalid.
+    """
+    if not isinstance(policy, (list, tuple)) or not policy:
+        raise ValueError('a policy must be a non-empty list of limits')
+    for limit in policy:
+        try:
+            dimension, amount, expires = limit['dimension'], limit['amount'], limit['expires']
+        except (KeyError, TypeError):
+            raise ValueError('every limit needs a dimension, an amount and expires')
+        if dimension not in LIMIT_DIMENSIONS:
+            raise ValueError('dimension must be one of: {}'.format(', '.join(LIMIT_DIMENSIONS)))
+        if not isinstance(amount, int) or not isinstance(expires, int) or amount < 1 or expires < 1:
+            raise ValueError('amount and expires must be positive integers')
+    limits = [(limit['dimension'], limit['amount'], limit['expires']) for limit in policy]
+    if len(set(limits)) != len(limits):
+        raise ValueError('limits must not be given twice')
@@ -0,0 +1,250 @@
+#!/usr/bin/env python
+# coding=UTF-8
+# Title:       metrics.py
+# Description: Counters, gauges and histograms exposed in the Prometheus text format.
+# Author       David Nellessen <david.nellessen@familo.net>
+# Date:        16.10.26
+# Note:        See https://prometheus.io/docs/instrumenting/exposition_formats/
+# ==============================================================================
+
+# Import modules
+import bisect
+
+
+# Content type of the text exposition format.
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# Upper bounds in seconds of the buckets of the latency histograms.
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5,
+                   5.0, 10.0)
+
+# All metrics in the order they are exposed.
+REGISTRY = []
+
+
+def format_value(value):
+    if isinstance(value, float):
+        if value == float('inf'):
+            return '+Inf'
+        return repr(value)
+    return str(value)
+
+
+def format_labels(names, values):
+    if not names:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(name, str(value).replace('\\', r'\\').replace('"', r'\"')
+                                          .replace('\n', r'\n'))
+                          for name, value in zip(names, values)) + '}'
+
+
+class Metric(object):
+    """
+    A metric with a child per combination of label values. Recording is done
+    on the children returned by labels(), which can be kept to spare the
+    lookup on hot paths. Metrics without labels record directly.
+    """
+    type = None
+
+    def __init__(self, name, documentation, labelnames=(), registry=REGISTRY):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.children = {}
+        if registry is not None:
+            registry.append(self)
+
+    def labels(self, *values):
+        child = self.children.get(values)
+        if child is None:
+            if len(values) != len(self.labelnames):
+                raise ValueError('{} expects the labels {}'.format(self.name, ', '.join(self.labelnames)))
+            child = self.children[values] = self.new_child()
+        return child
+
+    def new_child(self):
+        raise NotImplementedError
+
+    def expose(self):
+        """
+        Returns the lines of this metric in the text exposition format.
+        """
+        lines = ['# HELP {} {}'.format(self.name, self.documentation),
+                 '# TYPE {} {}'.format(self.name, self.type)]
+        for values, child in sorted(self.children.items()):
+            lines += self.expose_child(values, child)
+        return lines
+
+    def expose_child(self, values, child):
+        return ['{}{} {}'.format(self.name, format_labels(self.labelnames, values), format_value(child.value))]
+
+
+class CounterChild(object):
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def set(self, value):
+        # For totals counted by a component, see set_cache_stats().
+        self.value = value
+
+
+class Counter(Metric):
+    """
+    A value that only goes up, e.g. the number of requests.
+    """
+    type = 'counter'
+    new_child = CounterChild
+
+    def inc(self, amount=1):
+        self.labels().inc(amount)
+
+
+class GaugeChild(object):
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0
+
+    def set(self, value):
+        self.value = value
+
+
+class Gauge(Metric):
+    """
+    A value that goes up and down, e.g. the number of requests in flight.
+    """
+    type = 'gauge'
+    new_child = GaugeChild
+
+    def set(self, value):
+        self.labels().set(value)
+
+
+class HistogramChild(object):
+    __slots__ = ('buckets', 'counts', 'sum')
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        # The last count is for values above the largest bucket.
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+
+class Histogram(Metric):
+    """
+    Counts observed values, e.g. latencies in seconds, in buckets. The counts
+    are kept per bucket and only summed up when exposed, so an observation
+    costs one binary search.
+    """
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS, registry=REGISTRY):
+        super(Histogram, self).__init__(name, documentation, labelnames, registry)
+        self.buckets = tuple(sorted(buckets))
+
+    def new_child(self):
+        return HistogramChild(self.buckets)
+
+    def observe(self, value):
+        self.labels().observe(value)
+
+    def expose_child(self, values, child):
+        lines = []
+        total = 0
+        for bound, count in zip(self.buckets + (float('inf'),), child.counts):
+            total += count
+            lines.append('{}_bucket{} {}'.format(self.name, format_labels(self.labelnames + ('le',),
+                                                                          values + (format_value(float(bound)),)),
+                                                total))
+        labels = format_labels(self.labelnames, values)
+        lines.append('{}_sum{} {}'.format(self.name, labels, format_value(child.sum)))
+        lines.append('{}_count{} {}'.format(self.name, labels, total))
+        return lines
+
+
+def set_cache_stats(cache, stats):
+    """
+    Copies the stats() of a cache.LRUCache named 'cache' to the cache metrics.
+    """
+    for event, name in (('hit', 'hits'), ('miss', 'misses'), ('eviction', 'evictions'),
+                        ('expiration', 'expirations')):
+        CACHE_EVENTS.labels(cache, event).set(stats[name])
+    CACHE_ENTRIES.labels(cache).set(stats['size'])
+    lookups = stats['hits'] + stats['misses']
+    CACHE_HIT_RATIO.labels(cache).set(float(stats['hits']) / lookups if lookups else 0.0)
+
+
+def expose(registry=REGISTRY):
+    """
+    Returns all metrics of 'registry' in the text exposition format.
+    """
+    lines = []
+    for metric in registry:
+        lines += metric.expose()
+    return '\n'.join(lines) + '\n'
+
+
+# Metrics of this application. They are recorded per process.
+REQUESTS = Counter('sms_http_requests_total', 'HTTP requests by handler and response code', ('handler', 'code'))
+REQUEST_DURATION = Histogram('sms_http_request_duration_seconds', 'Duration of HTTP requests by handler',
+                             ('handler',))
+REQUESTS_IN_FLIGHT = Gauge('sms_http_requests_in_flight', 'HTTP requests being processed')
+RESPONSES = Counter('sms_responses_total', 'API responses by handler, status and error code',
+                    ('handler', 'status', 'error'))
+STAGE_DURATION = Histogram('sms_stage_duration_seconds', 'Duration of request processing stages', ('stage',))
+NEXMO_ATTEMPTS = Counter('sms_nexmo_attempts_total', 'Requests to Nexmo by outcome (sent, retry, failed)',
+                         ('outcome',))
+NEXMO_MESSAGES = Counter('sms_nexmo_messages_total', 'Message parts by the status code reported by Nexmo',
+                         ('status',))
+NEXMO_IN_FLIGHT = Gauge('sms_nexmo_requests_in_flight', 'Requests to Nexmo in flight')
+NEXMO_QUEUED = Gauge('sms_nexmo_requests_queued', 'Requests to Nexmo waiting for the send rate or a free slot')
+REDIS_DURATION = Histogram('sms_redis_command_duration_seconds', 'Round trip time of Redis commands',
+                           ('command',))
+REDIS_READY = Gauge('sms_redis_connections_ready', 'Ready connections of the Redis pool')
+EVENT_LOOP_LAG = Histogram('sms_event_loop_lag_seconds', 'Delay of callbacks scheduled on the event loop')
+SHED_REQUESTS = Counter('sms_shed_requests_total', 'Requests rejected while overloaded by handler and reason',
+                        ('handler', 'reason'))
+IDEMPOTENCY = Counter('sms_idempotency_requests_total',
+                      'Message requests with an idempotency key by outcome (claim, hit, coalesced, in_progress)',
+                      ('outcome',))
+BREAKER_STATE = Gauge('sms_nexmo_breaker_state', 'State of the Nexmo circuit breaker, 1 for the current state',
+                      ('state',))
+BREAKER_TRIPS = Counter('sms_nexmo_breaker_trips_total', 'Times the Nexmo circuit breaker opened')
+BREAKER_REJECTED = Counter('sms_nexmo_breaker_rejected_total', 'Requests to Nexmo rejected by the circuit breaker')
+
+# Metrics copied from the stats() of the components when exposed.
+CACHE_EVENTS = Counter('sms_cache_events_total', 'Lookups and removals of the in-process caches by cache and event',
+                       ('cache', 'event'))
+CACHE_ENTRIES = Gauge('sms_cache_entries', 'Entries of the in-process caches', ('cache',))
+CACHE_HIT_RATIO = Gauge('sms_cache_hit_ratio', 'Share of lookups of the in-process caches that were hits',
+                        ('cache',))
+GOVERNOR_WAIT = Gauge('sms_nexmo_governor_wait_seconds',
+                      'Average and maximum time requests to Nexmo waited for the send rate or a free slot',
+                      ('statistic',))
+NEXMO_RETRIES = Counter('sms_nexmo_retries_total', 'Messages retried after a temporary Nexmo failure')
+NEXMO_GAVE_UP = Counter('sms_nexmo_gave_up_total', 'Messages not retried anymore after temporary Nexmo failures')
+DLR_RECEIPTS = Counter('sms_dlr_receipts_total', 'Delivery receipts by event (received, written, dropped)',
+                       ('event',))
+DLR_BATCHES = Counter('sms_dlr_batches_total', 'Batches of delivery receipts written to Redis by outcome',
+                      ('outcome',))
+DLR_PENDING = Gauge('sms_dlr_receipts_pending', 'Delivery receipts buffered and not yet written to Redis')
+DLR_FLUSH_MAX = Gauge('sms_dlr_flush_duration_max_seconds', 'Longest write of a batch of delivery receipts')
+IDEMPOTENCY_KEYS = Counter('sms_idempotency_keys_total',
+                           'Completed idempotency keys by outcome (stored, released, errors)', ('outcome',))
+IDEMPOTENCY_WAITING = Gauge('sms_idempotency_requests_waiting',
+                            'Requests of this process holding an idempotency key that duplicates may wait for')
+
+# Stages of STAGE_DURATION recorded on hot paths.
+LIMIT_CHECK = STAGE_DURATION.labels('limit_check')
+NUMBER_PARSING = STAGE_DURATION.labels('number_parsing')
+GEOIP_LOOKUP = STAGE_DURATION.labels('geoip_lookup')
+NEXMO_FETCH = STAGE_DURATION.labels('nexmo_fetch')
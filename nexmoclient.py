@@ -8,39 +8,369 @@
 # ==============================================================================
 
 # Import modules
+import heapq
+import itertools
 import json
 import logging
-import phonenumbers
-from tornado.httpclient import AsyncHTTPClient, HTTPRequest
-from tornado.httputil import url_concat
+import random
+import time
+import uuid
+from collections import deque
+from tornado import gen
+from tornado.concurrent import Future
+from tornado.httpclient import HTTPRequest
+from tornado.ioloop import IOLoop
+from tornado.simple_httpclient import SimpleAsyncHTTPClient
+try:
+    from urllib import urlencode
+except ImportError:
+    from urllib.parse import urlencode
+import metrics
+from phonecache import PhoneNumberCache
+
+
+# Outcomes of a send attempt.
+SENT = 'sent'
+RETRY = 'retry'
+FAILED = 'failed'
+
+# Nexmo message statuses that may succeed later: throttled, internal error
+# and communication failed.
+RETRY_STATUSES = ('1', '5', '13')
+
+# HTTP status codes of failed requests that may succeed later besides 5xx.
+RETRY_HTTP_CODES = (408, 429)
+
+# States of CircuitBreaker.
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+
+class NexmoUnavailableError(Exception):
+    """
+    Raised when a message is not sent because the circuit breaker is open.
+    """
+    pass
+
+
+# HTTP client implementations: auto uses curl if pycurl is installed.
+HTTP_CLIENTS = ('auto', 'curl', 'simple')
+
+
+def create_http_client(kind='auto', max_clients=20):
+    """
+    Creates a private HTTP client of the given kind sending at most
+    'max_clients' requests at a time. The curl client keeps connections to
+    Nexmo alive and reuses them, sparing a TCP and TLS handshake per
+    message. The simple client opens a connection per request.
+    """
+    if kind in ('auto', 'curl'):
+        try:
+            from tornado.curl_httpclient import CurlAsyncHTTPClient
+            return CurlAsyncHTTPClient(force_instance=True, max_clients=max_clients)
+        except ImportError:
+            if kind == 'curl':
+                raise
+            logging.info('pycurl is not installed, connections to Nexmo are not reused')
+    return SimpleAsyncHTTPClient(force_instance=True, max_clients=max_clients)
+
+
+class RetryPolicy(object):
+    """
+    Retries a send up to 'max_attempts' times in total as long as it
+    finishes within 'deadline' seconds. The delays grow exponentially from
+    'base_delay' to 'max_delay' seconds and are jittered so that retries of
+    many messages don't hit Nexmo at the same time.
+    """
+    def __init__(self, max_attempts=3, deadline=10, base_delay=0.5, max_delay=5):
+        self.max_attempts = max_attempts
+        self.deadline = deadline
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def get_delay(self, attempt):
+        """
+        Returns the delay in seconds before the attempt after 'attempt'.
+        """
+        return min(self.max_delay, self.base_delay * 2 ** (attempt - 1)) * random.uniform(0.5, 1.0)
+
+    def allows(self, attempts, elapsed):
+        """
+        Tells if another attempt may be done after 'attempts' attempts
+        starting 'elapsed' seconds after the first one.
+        """
+        return attempts < self.max_attempts and elapsed <= self.deadline
+
+
+# Priorities of SendGovernor.acquire(), lower values are served first.
+PRIORITY_HIGH = 0
+PRIORITY_BULK = 10
+
+
+class SendGovernor(object):
+    """
+    Paces outbound requests to at most 'rate' per second using a token
+    bucket holding up to 'burst' tokens (default one second worth of
+    requests) and allows at most 'max_in_flight' requests at a time. A rate
+    of 0 disables pacing.
+
+    Requests wait in a priority queue, FIFO within the same priority, so a
+    burst is smoothed out instead of exceeding the account's throughput
+    limit. acquire() resolves once a request may start and release() must be
+    called when it finished.
+    """
+    def __init__(self, rate=30, burst=None, max_in_flight=20, clock=time.time):
+        self.rate = rate
+        self.burst = burst or max(1, rate)
+        self.max_in_flight = max_in_flight
+        self.clock = clock
+        self.tokens = float(self.burst)
+        self.updated = clock()
+        self.queue = []
+        self.counter = itertools.count()
+        self.in_flight = 0
+        self.timeout = None
+        self.started = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def acquire(self, priority=PRIORITY_HIGH):
+        """
+        Returns a Future resolving when the request may be sent.
+        """
+        future = Future()
+        heapq.heappush(self.queue, (priority, next(self.counter), self.clock(), future))
+        self.schedule()
+        return future
+
+    def release(self):
+        self.in_flight -= 1
+        self.schedule()
+
+    def refill(self, now):
+        if self.rate:
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def schedule(self):
+        """
+        Starts as many queued requests as tokens and in-flight slots allow
+        and sets a timeout for when the next token is available.
+        """
+        now = self.clock()
+        self.refill(now)
+        while self.queue and self.in_flight < self.max_in_flight and (not self.rate or self.tokens >= 1):
+            priority, _, enqueued, future = heapq.heappop(self.queue)
+            if self.rate:
+                self.tokens -= 1
+            self.in_flight += 1
+            self.started += 1
+            wait = now - enqueued
+            self.total_wait += wait
+            self.max_wait = max(self.max_wait, wait)
+            future.set_result(wait)
+        if self.queue and self.in_flight < self.max_in_flight and self.timeout is None:
+            delay = (1 - self.tokens) / self.rate
+            self.timeout = IOLoop.current().call_later(delay, self.on_timeout)
+
+    def on_timeout(self):
+        self.timeout = None
+        self.schedule()
+
+    def stats(self):
+        """
+        Returns the queue depth and wait time metrics as a dict.
+        """
+        return {'rate': self.rate,
+                'queue_depth': len(self.queue),
+                'in_flight': self.in_flight,
+                'started': self.started,
+                'wait_avg_ms': round(self.total_wait * 1000 / self.started, 3) if self.started else None,
+                'wait_max_ms': round(self.max_wait * 1000, 3)}
+
+
+class CircuitBreaker(object):
+    """
+    Stops sending requests to Nexmo while it is failing or slow. The breaker
+    opens when at least 'min_requests' requests finished within the last
+    'window' seconds and the share of temporarily failed requests reaches
+    'error_rate' or the share of requests taking longer than 'latency'
+    seconds reaches 'latency_rate'. An error_rate or latency of 0 disables
+    the respective check.
+
+    While open, requests are rejected at once. After 'reset_timeout' seconds
+    the breaker is half open and lets 'probes' requests through at a time.
+    It closes if a probe succeeds and opens again if it fails.
+
+    Every change of the state starts a new generation. Results of requests
+    allowed in an earlier generation, e.g. sent before the breaker opened,
+    are ignored, so that they are not taken for probes.
+    """
+    def __init__(self, error_rate=0.5, latency=5, latency_rate=0.5, min_requests=20, window=30, reset_timeout=10,
+                 probes=1, clock=time.time):
+        self.error_rate = error_rate
+        self.latency = latency
+        self.latency_rate = latency_rate
+        self.min_requests = min_requests
+        self.window = window
+        self.reset_timeout = reset_timeout
+        self.probes = probes
+        self.clock = clock
+        self.state = None
+        self.generation = 0
+        self.set_state(CLOSED)
+        self.opened = 0
+        self.probing = 0
+        self.results = deque()
+        self.failures = 0
+        self.slow = 0
+        self.counters = {'trips': 0, 'rejected': 0}
+
+    def allow(self):
+        """
+        Tells if a request may be sent now. Returns the token to pass to
+        record() with the result of the request or None if it is rejected.
+        Rejected requests are counted.
+        """
+        if self.state == OPEN and self.clock() - self.opened >= self.reset_timeout:
+            logging.info('Circuit breaker is half open, probing Nexmo')
+            self.set_state(HALF_OPEN)
+            self.probing = 0
+        if self.state == CLOSED:
+            return self.generation
+        if self.state == HALF_OPEN and self.probing < self.probes:
+            self.probing += 1
+            return self.generation
+        self.counters['rejected'] += 1
+        metrics.BREAKER_REJECTED.inc()
+        return None
+
+    def is_open(self):
+        """
+        Tells if requests are rejected without probing.
+        """
+        return self.state == OPEN and self.clock() - self.opened < self.reset_timeout
+
+    def record(self, token, failed, duration):
+        """
+        Records the result of a request allowed with 'token' that failed
+        temporarily if 'failed' and took 'duration' seconds.
+        """
+        if token != self.generation:
+            return
+        now = self.clock()
+        slow = bool(self.latency) and duration > self.latency
+        if self.state == HALF_OPEN:
+            self.probing = max(0, self.probing - 1)
+            if failed or slow:
+                self.trip(now)
+            else:
+                logging.info('Circuit breaker closed, Nexmo recovered')
+                self.set_state(CLOSED)
+            return
+        self.results.append((now, failed, slow))
+        self.failures += failed
+        self.slow += slow
+        while self.results and self.results[0][0] < now - self.window:
+            _, old_failed, old_slow = self.results.popleft()
+            self.failures -= old_failed
+            self.slow -= old_slow
+        total = len(self.results)
+        if total >= self.min_requests and (
+                (self.error_rate and self.failures >= total * self.error_rate) or
+                (self.latency and self.slow >= total * self.latency_rate)):
+            self.trip(now)
+
+    def trip(self, now):
+        logging.error('Circuit breaker opened, not sending to Nexmo for {}s'.format(self.reset_timeout))
+        self.set_state(OPEN)
+        self.opened = now
+        self.probing = 0
+        self.results.clear()
+        self.failures = self.slow = 0
+        self.counters['trips'] += 1
+        metrics.BREAKER_TRIPS.inc()
+
+    def set_state(self, state):
+        self.state = state
+        self.generation += 1
+        for name in (CLOSED, OPEN, HALF_OPEN):
+            metrics.BREAKER_STATE.labels(name).set(int(name == state))
+
+    def stats(self):
+        """
+        Returns the state and the metrics of the current window as a dict.
+        """
+        total = len(self.results)
+        stats = dict(self.counters)
+        # An open breaker whose reset timeout passed is half open on the next request.
+        stats.update({'state': HALF_OPEN if self.state == OPEN and not self.is_open() else self.state,
+                      'window_requests': total,
+                      'window_error_rate': round(float(self.failures) / total, 3) if total else None,
+                      'window_slow_rate': round(float(self.slow) / total, 3) if total else None})
+        return stats
 
 
 class AsyncNexmoClient(object):
     def __init__(self, api_key, api_secret, domain='rest.nexmo.com', endpoint='sms/json',
-                 ssl=False, long_virtual_number=None, dlr_url=None, development_mode=False):
+                 ssl=False, long_virtual_number=None, dlr_url=None, development_mode=False,
+                 phone_cache=None, send_concurrency=10, send_rate=30, max_in_flight=20, retry_policy=None,
+                 http_client='auto', connect_timeout=5, request_timeout=20, circuit_breaker=None):
         """
         :param dlr_url: when using this parameter a callback-url has to be defined on
         `https://dashboard.nexmo.com/private/settings`
+        :param phone_cache: a phonecache.PhoneNumberCache, e.g. the one shared
+        with the request handlers
+        :param send_concurrency: maximum number of concurrent requests of send_many()
+        :param send_rate: maximum number of requests per second to Nexmo, 0 for no limit
+        :param max_in_flight: maximum number of concurrent requests to Nexmo
+        :param retry_policy: a RetryPolicy for temporarily failed sends
+        :param http_client: the HTTP client implementation, see HTTP_CLIENTS
+        :param connect_timeout: seconds to wait for a connection to Nexmo
+        :param request_timeout: seconds to wait for a whole request to Nexmo
+        :param circuit_breaker: a CircuitBreaker failing fast while Nexmo is unavailable
         :return:
         """
-        self.http_client = AsyncHTTPClient()
+        self.http_client = create_http_client(http_client, max_in_flight)
+        self.connect_timeout = connect_timeout
+        self.request_timeout = request_timeout
         self.api_key = api_key
         self.api_secret = api_secret
         self.domain = domain
         self.endpoint = endpoint
         self.ssl = ssl
+        self.url = "{protocol}://{domain}/{endpoint}".format(protocol='https' if ssl else 'http', domain=domain,
+                                                             endpoint=endpoint)
         self.long_virtual_number = long_virtual_number
         self.dlr_url = dlr_url
         self.development_mode = development_mode
+        self.phone_cache = phone_cache or PhoneNumberCache()
+        self.send_concurrency = send_concurrency
+        self.governor = SendGovernor(send_rate, max_in_flight=max_in_flight)
+        self.retry_policy = retry_policy or RetryPolicy()
+        self.circuit_breaker = circuit_breaker or CircuitBreaker()
+        self.counters = dict.fromkeys(['attempts', 'attempts_' + SENT, 'attempts_' + RETRY, 'attempts_' + FAILED,
+                                       'retries', 'gave_up'], 0)
+        self.counters.update({'attempt_time': 0.0, 'attempt_time_max': 0.0})
+
+    def get_max_send_time(self):
+        """
+        Returns the seconds a send may take apart from waiting for the
+        governor: the last attempt starts before the retry deadline and may
+        take the request timeout.
+        """
+        return self.retry_policy.deadline + self.request_timeout
 
-    def assamble_url(self, sender, to, text):
+    def assamble_params(self, sender, to, text):
         """
-        Assambles the url for sending a message. This will url encode
-        all parameters.
+        Assambles the form parameters for sending a message.
         """
-        phonenumber = phonenumbers.parse(to)
+        phonenumber = self.phone_cache.parse(to)
+        if phonenumber is None:
+            raise ValueError('Invalid receiver phone number: {}'.format(to))
         # Nexmo seems to dislike escaped "+" so it's replaced with a double zero
-        to = "00" + phonenumbers.format_number(phonenumber, phonenumbers.PhoneNumberFormat.E164)[1:]
+        to = "00" + phonenumber.e164[1:]
         # Replace sender for north american numbers.
         # See sender sestrictions: https://help.nexmo.com/hc/en-us/articles/204017023-USA-Direct-route-
         if self.long_virtual_number and to[0:3] == '001':
@@ -53,65 +383,174 @@ class AsyncNexmoClient(object):
                   'type': 'text'}
         if self.dlr_url:
             params['status-report-req'] = 1
+        return params
 
-        if self.ssl:
-            protocol = 'https'
-        else:
-            protocol = 'http'
-        url = "{protocol}://{domain}/{endpoint}".format(protocol=protocol, domain=self.domain, endpoint=self.endpoint)
-        url = url_concat(url, params)
-        return url
-
-    def send_message(self, sender, to, text, callback=None):
-        """
-        Sends a message through the Nexmo Gateway.
-        """
-        url = self.assamble_url(sender, to, text)
-        logging.debug('Requesting Nexmo service: ' + url)
-        request = HTTPRequest(url=url, method='GET')
-
-        # Define response callback.
-        def handle_request(response):
-            if response.error:
-                logging.warning("Request failed: " + str(response.error))
-                if callback:
-                    callback(False)
-                    return
-
-            try:
-                json_response = json.loads(response.body)
-            except ValueError as exc:
-                logging.error("response was not json", exc_info=1)
-                callback(False)
-                return
-
-            message_was_send = []
-            try:
-                for message in json_response['messages']:
-                    if message['status'] != "0":
-                        message_was_send.append(False)
-                    else:
-                        message_was_send.append(True)
-
-                if len(message_was_send) > 1:
-                    logging.warn("message was sent as multipart in {} parts".format(len(message_was_send)))
-
-                if not all(message_was_send):
-                    logging.error("sending of {} messages failed. Error message: {}".format(len(filter(lambda x: x is False, message_was_send)), json_response))
-                    callback(False)
-                    return
-
-            except ValueError:
-                logging.error("response is unexpected", exc_info=True)
-                callback(False)
-                return
-            callback(True)
+    def send_message(self, sender, to, text, callback=None, priority=PRIORITY_HIGH):
+        """
+        Sends a message through the Nexmo Gateway and calls 'callback' with
+        the list of its message IDs if it was sent or False otherwise, also if
+        Nexmo is unavailable. See send().
+        """
+        future = self.send(sender, to, text, priority)
+        if callback:
+            def on_sent(future):
+                try:
+                    result = future.result()
+                except NexmoUnavailableError:
+                    result = False
+                callback(result)
+            IOLoop.current().add_future(future, on_sent)
 
+    @gen.coroutine
+    def send(self, sender, to, text, priority=PRIORITY_HIGH):
+        """
+        Sends a message through the Nexmo Gateway and resolves to the list of
+        Nexmo message IDs, one per part, if it was sent or False otherwise.
+        Delivery receipts refer to these IDs. Each attempt is queued by the governor
+        with the given priority until the send rate allows it. Attempts
+        failing temporarily are retried according to the retry policy.
+        Raises NexmoUnavailableError if the circuit breaker rejects an
+        attempt.
+        """
+        try:
+            body = urlencode(self.assamble_params(sender, to, text))
+        except ValueError:
+            logging.error("invalid receiver {}".format(to))
+            raise gen.Return(False)
         if self.development_mode:
             # in development mode no requests are send everything is a (huge) success
-            callback(True)
-        else:
-            self.http_client.fetch(request, handle_request)
+            raise gen.Return([uuid.uuid4().hex])
+        start = time.time()
+        attempt = 0
+        while True:
+            token = self.circuit_breaker.allow()
+            if token is None:
+                raise NexmoUnavailableError('Nexmo is unavailable, message to {} not sent'.format(to))
+            outcome, message_ids = yield self.send_attempt(body, priority, token)
+            if outcome != RETRY:
+                raise gen.Return(message_ids if outcome == SENT else False)
+            attempt += 1
+            delay = self.retry_policy.get_delay(attempt)
+            if not self.retry_policy.allows(attempt, time.time() - start + delay):
+                logging.error("sending failed after {} attempts".format(attempt))
+                self.counters['gave_up'] += 1
+                raise gen.Return(False)
+            logging.info("retrying to send message in {:.2f}s".format(delay))
+            self.counters['retries'] += 1
+            yield gen.sleep(delay)
+
+    @gen.coroutine
+    def send_attempt(self, body, priority=PRIORITY_HIGH, token=None):
+        """
+        Posts the form encoded 'body' to the Nexmo service once. Resolves to
+        the outcome and the message IDs, see get_outcome(). The result is
+        recorded by the circuit breaker for the 'token' it allowed the
+        attempt with.
+        """
+        # The body contains the API credentials and is not logged.
+        logging.debug('Requesting Nexmo service: ' + self.url)
+        request = HTTPRequest(url=self.url, method='POST', body=body,
+                              headers={'Content-Type': 'application/x-www-form-urlencoded'},
+                              connect_timeout=self.connect_timeout, request_timeout=self.request_timeout)
+        yield self.governor.acquire(priority)
+        start = time.time()
+        try:
+            response = yield self.http_client.fetch(request, raise_error=False)
+        finally:
+            self.governor.release()
+        duration = time.time() - start
+        metrics.NEXMO_FETCH.observe(duration)
+        outcome, message_ids = self.get_outcome(response)
+        metrics.NEXMO_ATTEMPTS.labels(outcome).inc()
+        self.circuit_breaker.record(token, outcome == RETRY, duration)
+        self.counters['attempts'] += 1
+        self.counters['attempts_' + outcome] += 1
+        self.counters['attempt_time'] += duration
+        self.counters['attempt_time_max'] = max(self.counters['attempt_time_max'], duration)
+        raise gen.Return((outcome, message_ids))
+
+    @staticmethod
+    def get_outcome(response):
+        """
+        Tells if a response of the Nexmo service means that the message was
+        sent (SENT), failed temporarily (RETRY: throttling, gateway errors,
+        timeouts or connection errors) or failed permanently (FAILED).
+        Returns a tuple of the outcome and the IDs of the sent message parts.
+        """
+        if response.error:
+            logging.warning("Request failed: " + str(response.error))
+            # Tornado reports timeouts and connection errors as code 599.
+            if response.code in RETRY_HTTP_CODES or response.code >= 500:
+                return RETRY, []
+            return FAILED, []
+
+        try:
+            json_response = json.loads(response.body)
+        except ValueError as exc:
+            logging.error("response was not json", exc_info=1)
+            return FAILED, []
+
+        try:
+            statuses = [message['status'] for message in json_response['messages']]
+            message_ids = [message.get('message-id') for message in json_response['messages']
+                           if message['status'] == "0"]
+        except (KeyError, TypeError, AttributeError):
+            logging.error("response is unexpected", exc_info=True)
+            return FAILED, []
+        for status in statuses:
+            metrics.NEXMO_MESSAGES.labels(status).inc()
+
+        if len(statuses) > 1:
+            logging.warn("message was sent as multipart in {} parts".format(len(statuses)))
+
+        failed = [status for status in statuses if status != "0"]
+        if failed:
+            logging.error("sending of {} messages failed. Error message: {}".format(len(failed), json_response))
+            # Parts that were sent would be sent twice by a retry.
+            if len(failed) == len(statuses) and all(status in RETRY_STATUSES for status in failed):
+                return RETRY, message_ids
+            return FAILED, message_ids
+        return SENT, message_ids
+
+    def stats(self):
+        """
+        Returns the send attempt counters, the governor and the circuit
+        breaker metrics as a dict.
+        """
+        stats = dict(self.counters)
+        stats['attempt_time_avg_ms'] = (round(stats['attempt_time'] * 1000 / stats['attempts'], 3)
+                                        if stats['attempts'] else None)
+        stats['attempt_time_max_ms'] = round(stats.pop('attempt_time_max') * 1000, 3)
+        del stats['attempt_time']
+        stats['governor'] = self.governor.stats()
+        stats['circuit_breaker'] = self.circuit_breaker.stats()
+        return stats
+
+    @gen.coroutine
+    def send_many(self, sender, receivers, text, concurrency=None):
+        """
+        Sends the same message to many receivers (phone numbers in international
+        notation) with at most 'concurrency' (default send_concurrency)
+        requests at a time. All receivers are validated before the first
+        message is sent. Resolves to a list with the result of send()
+        for every receiver, False for invalid ones and None for those not sent
+        because Nexmo is unavailable. The messages are queued with a lower
+        priority than single messages.
+        """
+        parsed = [self.phone_cache.parse(receiver) for receiver in receivers]
+        results = [False] * len(receivers)
+        pending = iter([i for i, number in enumerate(parsed) if number is not None])
+
+        @gen.coroutine
+        def worker():
+            for i in pending:
+                try:
+                    results[i] = yield self.send(sender, parsed[i].e164, text, PRIORITY_BULK)
+                except NexmoUnavailableError:
+                    results[i] = None
+
+        yield [worker() for _ in range(max(1, concurrency or self.send_concurrency))]
+        raise gen.Return(results)
 
 
 class SMSSender(object):
@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+# coding=UTF-8
+# Title:       phonecache.py
+# Description: Caches parsed and formatted phone numbers.
+# Author       David Nellessen <david.nellessen@familo.net>
+# Date:        16.10.26
+# Note:
+# ==============================================================================
+
+# Import modules
+import time
+from collections import namedtuple
+import phonenumbers
+import metrics
+from cache import LRUCache
+
+
+# A parsed phone number together with its formatted representations.
+ParsedNumber = namedtuple('ParsedNumber', ['number', 'international', 'e164'])
+
+
+class PhoneNumberCache(object):
+    """
+    Parses and formats phone numbers, memoizing the results (including
+    numbers that could not be parsed) by raw number and region in a
+    LRUCache of 'size' entries. Popular numbers and repeated submissions
+    of a form are thereby parsed only once.
+
+    Cached ParsedNumber instances are shared, so the phone number objects
+    they hold must not be modified.
+    """
+    def __init__(self, size=10000):
+        self.cache = LRUCache(size)
+
+    def parse(self, number, region=None):
+        """
+        Returns a ParsedNumber for 'number' or None if it can not be parsed.
+        'region' is the country code assumed for numbers not given in
+        international notation.
+        """
+        start = time.time()
+        key = (number, region)
+        parsed = self.cache.get(key, False)
+        if parsed is False:
+            parsed = self.parse_uncached(number, region)
+            self.cache.set(key, parsed)
+        metrics.NUMBER_PARSING.observe(time.time() - start)
+        return parsed
+
+    @staticmethod
+    def parse_uncached(number, region=None):
+        try:
+            numberobj = phonenumbers.parse(number, region)
+        except phonenumbers.NumberParseException:
+            return None
+        return ParsedNumber(numberobj,
+                            phonenumbers.format_number(numberobj, phonenumbers.PhoneNumberFormat.INTERNATIONAL),
+                            phonenumbers.format_number(numberobj, phonenumbers.PhoneNumberFormat.E164))
+
+    def stats(self):
+        """
+        Returns the counters of the cache and its hit rate as a dict.
+        """
+        stats = self.cache.stats()
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_rate'] = round(float(stats['hits']) / lookups, 4) if lookups else None
+        return stats
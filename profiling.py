@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+# coding=UTF-8
+# Title:       profiling.py
+# Description: Profiles a sample of requests with cProfile.
+# Author       David Nellessen <david.nellessen@familo.net>
+# Date:        16.10.26
+# Note:
+# ==============================================================================
+
+# Import modules
+import cProfile
+import pstats
+import random
+from StringIO import StringIO
+
+
+# Orders of the profile report, see pstats.Stats.sort_stats().
+SORT_KEYS = ('cumulative', 'tottime', 'calls', 'ncalls', 'time')
+
+
+class RequestProfiler(object):
+    """
+    Profiles a 'sample_rate' share of requests and aggregates the results
+    of all profiled requests in one cProfile.Profile.
+
+    Requests are interleaved on the IOLoop and a thread can run one profiler
+    only, so the profiler runs while at least one sampled request is in
+    flight. The report therefore includes the work done for other requests
+    meanwhile, which is representative of the load as long as the sample
+    rate is low. A sample rate of 0 disables profiling at no cost.
+    """
+    def __init__(self, sample_rate=0.0):
+        self.sample_rate = sample_rate
+        self.profile = cProfile.Profile()
+        self.active = 0
+        self.sampled = 0
+
+    def start(self):
+        """
+        Decides if a starting request is profiled and returns True if so.
+        Every profiled request must call stop() when it finished.
+        """
+        if not self.sample_rate or random.random() >= self.sample_rate:
+            return False
+        if not self.active:
+            self.profile.enable()
+        self.active += 1
+        self.sampled += 1
+        return True
+
+    def stop(self):
+        self.active -= 1
+        if not self.active:
+            self.profile.disable()
+
+    def reset(self):
+        """
+        Discards the results profiled so far.
+        """
+        if self.active:
+            self.profile.disable()
+        self.profile = cProfile.Profile()
+        self.sampled = 0
+        if self.active:
+            self.profile.enable()
+
+    def report(self, sort='cumulative', limit=50):
+        """
+        Returns the aggregated results as text, the top 'limit' functions
+        ordered by 'sort' (see SORT_KEYS).
+        """
+        if not self.sampled:
+            return 'No requests profiled yet.\n'
+        stream = StringIO()
+        # Creating the stats disables the profiler.
+        stats = pstats.Stats(self.profile, stream=stream)
+        if self.active:
+            self.profile.enable()
+        stream.write('{} requests profiled, sample rate {}\n'.format(self.sampled, self.sample_rate))
+        stats.sort_stats(sort).print_stats(limit)
+        return stream.getvalue()
+
+    def stats(self):
+        return {'sample_rate': self.sample_rate,
+                'sampled': self.sampled,
+                'active': self.active}
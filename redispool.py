@@ -0,0 +1,199 @@
+#!/usr/bin/env python
+# coding=UTF-8
+# Title:       redispool.py
+# Description: A pool of toredis connections that reconnects in the background.
+# Author       David Nellessen <david.nellessen@familo.net>
+# Date:        16.10.26
+# Note:
+# ==============================================================================
+
+# Import modules
+import logging
+import random
+import time
+from datetime import timedelta
+import tornado.ioloop
+import toredis
+import metrics
+
+
+class RedisUnavailableError(Exception):
+    """
+    Raised if no connection of the pool is ready.
+    """
+    pass
+
+
+class PooledClient(toredis.Client):
+    """
+    A toredis client that reports disconnects to its pool.
+    """
+    def __init__(self, pool, io_loop=None):
+        super(PooledClient, self).__init__(io_loop=io_loop)
+        self.pool = pool
+        self.ready = False
+        self.failures = 0
+        self.pending_ping = False
+        self.initialized = False
+
+    def send_message(self, args, callback=None):
+        """
+        Sends a command like toredis.Client.send_message() and records its
+        round trip time.
+        """
+        if callback is None:
+            return super(PooledClient, self).send_message(args, callback)
+        histogram = metrics.REDIS_DURATION.labels(args[0])
+        start = time.time()
+        def on_reply(result):
+            histogram.observe(time.time() - start)
+            callback(result)
+        return super(PooledClient, self).send_message(args, on_reply)
+
+    def on_disconnect(self):
+        if self.pool:
+            self.pool.on_disconnect(self)
+
+    def abort(self):
+        """
+        Closes the connection without sending QUIT.
+        """
+        if self._stream:
+            self._stream.close()
+
+
+class RedisPool(object):
+    """
+    Holds 'size' connections to Redis. Commands are distributed round robin
+    over the ready connections, each of which pipelines the commands sent
+    to it. Lost connections are reconnected in the background with capped
+    exponential backoff, so request handlers never have to wait for a
+    reconnect. A periodic PING detects connections that stopped answering.
+    """
+    def __init__(self, host='localhost', port=6379, password='', db=0, size=4,
+                 health_check_interval=5, max_backoff=30, io_loop=None):
+        self.host = host
+        self.port = port
+        self.password = password
+        self.db = db
+        self.health_check_interval = health_check_interval
+        self.max_backoff = max_backoff
+        self.io_loop = io_loop or tornado.ioloop.IOLoop.current()
+        self.clients = [PooledClient(self, io_loop=self.io_loop) for _ in range(max(1, size))]
+        self.index = 0
+        self.reconnects = 0
+        self.health_check = None
+        self.initial_callback = None
+        self.initial_pending = 0
+
+    def connect(self, callback=None):
+        """
+        Connects all clients and starts the health checks. 'callback' is
+        called with the number of ready connections once every client has
+        tried to connect for the first time.
+        """
+        self.initial_callback = callback
+        self.initial_pending = len(self.clients)
+        for client in self.clients:
+            self.connect_client(client)
+        if self.health_check_interval:
+            self.health_check = tornado.ioloop.PeriodicCallback(self.check_health,
+                                                                self.health_check_interval * 1000,
+                                                                io_loop=self.io_loop)
+            self.health_check.start()
+
+    def close(self):
+        if self.health_check:
+            self.health_check.stop()
+        for client in self.clients:
+            client.pool = None
+            client.ready = False
+            client.abort()
+
+    def get(self):
+        """
+        Returns the next ready client or raises RedisUnavailableError.
+        """
+        for _ in range(len(self.clients)):
+            self.index = (self.index + 1) % len(self.clients)
+            client = self.clients[self.index]
+            if client.ready:
+                return client
+        raise RedisUnavailableError('No Redis connection available')
+
+    def ready_count(self):
+        return len([client for client in self.clients if client.ready])
+
+    def stats(self):
+        return {'size': len(self.clients),
+                'ready': self.ready_count(),
+                'reconnects': self.reconnects}
+
+    def connect_client(self, client):
+        def on_select(result):
+            if isinstance(result, Exception) or result is None:
+                logging.error('Redis select failed: {}'.format(result))
+                client.abort()
+                return
+            client.ready = True
+            client.failures = 0
+            client.pending_ping = False
+            self.initial_done(client)
+
+        def on_auth(result):
+            if isinstance(result, Exception) or result is None:
+                logging.error('Redis authentication failed: {}'.format(result))
+                client.abort()
+                return
+            client.select(self.db, callback=on_select)
+
+        def on_connect():
+            if self.password:
+                client.auth(self.password, callback=on_auth)
+            else:
+                on_auth('OK')
+        client.connect(host=self.host, port=self.port, callback=on_connect)
+
+    def initial_done(self, client):
+        if not client.initialized:
+            client.initialized = True
+            self.initial_pending -= 1
+            if self.initial_pending == 0 and self.initial_callback:
+                callback, self.initial_callback = self.initial_callback, None
+                callback(self.ready_count())
+
+    def on_disconnect(self, client):
+        if client.pool is not self:
+            return
+        if client.ready:
+            logging.warning('Lost connection to Redis')
+        client.ready = False
+        client.failures += 1
+        self.initial_done(client)
+        delay = min(self.max_backoff, 0.1 * 2 ** client.failures) * random.uniform(0.5, 1.0)
+        logging.debug('Reconnecting to Redis in {:.2f}s'.format(delay))
+        self.io_loop.add_timeout(timedelta(seconds=delay), self.reconnect, client)
+
+    def reconnect(self, client):
+        if client.pool is not self:
+            return
+        self.reconnects += 1
+        self.connect_client(client)
+
+    def check_health(self):
+        """
+        Pings every ready client. Clients that did not answer the previous
+        ping are closed and thereby reconnected.
+        """
+        for client in self.clients:
+            if not client.ready:
+                continue
+            if client.pending_ping:
+                logging.warning('Redis connection did not answer PING')
+                client.abort()
+                continue
+            client.pending_ping = True
+
+            def on_pong(result, client=client):
+                client.pending_ping = False
+            client.ping(callback=on_pong)
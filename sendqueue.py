@@ -0,0 +1,327 @@
+#!/usr/bin/env python
+# coding=UTF-8
+# Title:       sendqueue.py
+# Description: A Redis backed queue of messages sent by worker processes.
+# Author       David Nellessen <david.nellessen@familo.net>
+# Date:        16.10.26
+# Note:        Start workers with worker.py
+# ==============================================================================
+
+# Import modules
+import logging
+import math
+import time
+import uuid
+from tornado import gen, locks
+from tornado.escape import to_unicode
+from limiter import RedisScript
+from nexmoclient import NexmoUnavailableError
+from redispool import RedisUnavailableError
+
+
+# Redis list of queued job IDs, sorted set of the IDs of jobs being sent by
+# the time they were taken from the queue and prefix of the job hashes.
+QUEUE_KEY = 'sms_queue'
+SENDING_KEY = 'sms_sending'
+JOB_KEY_PREFIX = 'sms_job:'
+
+# States of a job.
+QUEUED = 'queued'
+SENDING = 'sending'
+SENT = 'sent'
+FAILED = 'failed'
+
+
+class QueueUnavailableError(Exception):
+    """
+    Raised if messages could not be queued because Redis is unavailable.
+    """
+    pass
+
+
+class SendQueue(object):
+    """
+    Queues messages in Redis to be sent by worker processes. Every message is
+    a job stored in a hash holding its state, sender, receiver and text. The
+    IDs of queued jobs are kept in a list. Jobs expire 'job_ttl' seconds
+    after they were queued.
+
+    Jobs taken from the queue are kept in a sorted set by the time they were
+    taken until they are finished. recover() puts back jobs that were taken
+    too long ago, e.g. by a worker that died.
+
+    Like limiter.RedisLimiter this uses the Redis connection of
+    'application'.
+    """
+    # ARGV[1] is the job TTL, ARGV[2] the current time and the following
+    # arguments are job ID, sender, receiver, formatted number and text of
+    # every job.
+    enqueue_script = RedisScript("""
+for i = 3, #ARGV, 5 do
+    local key = '""" + JOB_KEY_PREFIX + """' .. ARGV[i]
+    redis.call('HMSET', key, 'status', '""" + QUEUED + """', 'sender', ARGV[i + 1], 'to', ARGV[i + 2],
+               'number', ARGV[i + 3], 'text', ARGV[i + 4], 'created', ARGV[2], 'updated', ARGV[2])
+    redis.call('EXPIRE', key, ARGV[1])
+    redis.call('LPUSH', KEYS[1], ARGV[i])
+end
+return 1
+""")
+
+    # Pops up to ARGV[1] jobs of the queue KEYS[1] and marks them as being
+    # sent since time ARGV[2] in the sorted set KEYS[2]. Returns job IDs and
+    # the fields of their hashes alternately. Expired jobs are skipped.
+    pop_script = RedisScript("""
+local jobs = {}
+for i = 1, tonumber(ARGV[1]) do
+    local id = redis.call('RPOP', KEYS[1])
+    if not id then
+        break
+    end
+    local key = '""" + JOB_KEY_PREFIX + """' .. id
+    if redis.call('EXISTS', key) == 1 then
+        redis.call('HMSET', key, 'status', '""" + SENDING + """', 'started', ARGV[2], 'updated', ARGV[2])
+        redis.call('ZADD', KEYS[2], ARGV[2], id)
+        table.insert(jobs, id)
+        table.insert(jobs, redis.call('HGETALL', key))
+    end
+end
+return jobs
+""")
+
+    # Sets the fields ARGV[2..] of the job hash KEYS[1] and removes the job
+    # ARGV[1] from the sorted set KEYS[2] of jobs being sent.
+    finish_script = RedisScript("""
+redis.call('HMSET', KEYS[1], unpack(ARGV, 2))
+redis.call('ZREM', KEYS[2], ARGV[1])
+return 1
+""")
+
+    # Puts the jobs of the sorted set KEYS[2] taken before time ARGV[1] back
+    # to the front of the queue KEYS[1] at time ARGV[2] unless they finished
+    # or expired. Returns the number of jobs put back.
+    recover_script = RedisScript("""
+local recovered = 0
+for _, id in ipairs(redis.call('ZRANGEBYSCORE', KEYS[2], '-inf', ARGV[1])) do
+    redis.call('ZREM', KEYS[2], id)
+    local key = '""" + JOB_KEY_PREFIX + """' .. id
+    if redis.call('HGET', key, 'status') == '""" + SENDING + """' then
+        redis.call('HMSET', key, 'status', '""" + QUEUED + """', 'updated', ARGV[2])
+        redis.call('RPUSH', KEYS[1], id)
+        recovered = recovered + 1
+    end
+end
+return recovered
+""")
+
+    def __init__(self, application, job_ttl=86400):
+        self.application = application
+        self.job_ttl = job_ttl
+
+    @staticmethod
+    def get_job_key(job_id):
+        return JOB_KEY_PREFIX + job_id
+
+    @gen.coroutine
+    def enqueue(self, messages):
+        """
+        Queues 'messages', a list of tuples (sender, receiver, formatted
+        number, text), and resolves to the list of their job IDs. Raises
+        QueueUnavailableError if Redis is unavailable or the reply is lost,
+        in which case the messages may or may not be queued.
+        """
+        job_ids = [uuid.uuid4().hex for _ in messages]
+        args = [self.job_ttl, int(time.time())]
+        for job_id, (sender, to, number, text) in zip(job_ids, messages):
+            args += [job_id, to_unicode(sender), to, number, to_unicode(text)]
+        try:
+            result = yield self.enqueue_script(self.application.redis, [QUEUE_KEY], args)
+        except RedisUnavailableError:
+            result = None
+        if result is None:
+            raise QueueUnavailableError('Queueing {} messages failed: no reply from Redis'.format(len(messages)))
+        raise gen.Return(job_ids)
+
+    @gen.coroutine
+    def pop(self, count):
+        """
+        Takes up to 'count' jobs from the queue, marks them as being sent and
+        resolves to a list of (job ID, job dict) tuples.
+        """
+        result = yield self.pop_script(self.application.redis, [QUEUE_KEY, SENDING_KEY], [count, int(time.time())])
+        jobs = []
+        for job_id, fields in zip(result[::2], result[1::2]):
+            jobs.append((job_id, dict(zip(fields[::2], fields[1::2]))))
+        raise gen.Return(jobs)
+
+    @gen.coroutine
+    def requeue(self, job_id):
+        """
+        Puts a job taken from the queue back to its front.
+        """
+        yield self.finish(job_id, QUEUED)
+        result = yield gen.Task(self.application.redis.rpush, QUEUE_KEY, job_id)
+        if isinstance(result, Exception):
+            raise result
+
+    @gen.coroutine
+    def finish(self, job_id, status, **fields):
+        """
+        Sets the final state of a job and additional 'fields'.
+        """
+        fields.update({'status': status, 'updated': int(time.time())})
+        args = [job_id]
+        for name, value in fields.items():
+            args += [name, value]
+        yield self.finish_script(self.application.redis, [self.get_job_key(job_id), SENDING_KEY], args)
+
+    @gen.coroutine
+    def recover(self, timeout):
+        """
+        Puts jobs taken from the queue more than 'timeout' seconds ago and
+        not finished since back to its front. Resolves to their number.
+        """
+        now = int(time.time())
+        result = yield self.recover_script(self.application.redis, [QUEUE_KEY, SENDING_KEY], [now - timeout, now])
+        raise gen.Return(result)
+
+    @gen.coroutine
+    def get_job(self, job_id):
+        """
+        Resolves to the dict of a job or None if it does not exist.
+        """
+        result = yield gen.Task(self.application.redis.hgetall, self.get_job_key(job_id))
+        if isinstance(result, Exception):
+            raise result
+        raise gen.Return(dict(zip(result[::2], result[1::2])) if result else None)
+
+    @gen.coroutine
+    def length(self):
+        result = yield gen.Task(self.application.redis.llen, QUEUE_KEY)
+        raise gen.Return(result)
+
+
+class SendWorker(object):
+    """
+    Sends the messages of a SendQueue with an AsyncNexmoClient. Jobs are
+    taken from the queue in batches of up to 'batch_size' and at most
+    'concurrency' messages are sent at a time. An empty queue is polled
+    every 'poll_interval' seconds.
+
+    Jobs taken from the queue by a worker that dies before finishing them
+    are put back by recover() after 'visibility_timeout' seconds, by default
+    the time a worker may take for a batch (see get_visibility_timeout()).
+    If the worker died after sending, such a message is sent again. Jobs
+    whose processing raised an unexpected error are marked 'failed'. Jobs
+    rejected by the circuit breaker of the Nexmo client are put back and
+    the queue is not polled until the breaker is half open.
+    """
+    # Seconds between looking for jobs to recover.
+    recover_interval = 10
+
+    def __init__(self, queue, nexmo_client, batch_size=50, concurrency=20, poll_interval=0.5,
+                 visibility_timeout=None):
+        self.queue = queue
+        self.nexmo_client = nexmo_client
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.visibility_timeout = visibility_timeout or self.get_visibility_timeout(nexmo_client, batch_size,
+                                                                                   concurrency)
+        self.next_recovery = 0
+        self.semaphore = locks.Semaphore(concurrency)
+        self.in_flight = 0
+        self.idle = locks.Event()
+        self.idle.set()
+        self.running = False
+        self.counters = {'sent': 0, 'failed': 0, 'requeued': 0, 'recovered': 0, 'batches': 0}
+
+    @staticmethod
+    def get_visibility_timeout(nexmo_client, batch_size, concurrency):
+        """
+        Returns the seconds a worker may take for the jobs of a batch: they
+        are sent in rounds of 'concurrency', each taking up to the longest
+        send of 'nexmo_client', plus a minute for waiting for the send
+        governor.
+        """
+        rounds = (batch_size + concurrency - 1) // concurrency
+        return int(math.ceil(rounds * nexmo_client.get_max_send_time())) + 60
+
+    @gen.coroutine
+    def recover(self):
+        """
+        Puts back jobs taken by workers that died, see SendQueue.recover().
+        """
+        self.next_recovery = time.time() + self.recover_interval
+        try:
+            recovered = yield self.queue.recover(self.visibility_timeout)
+        except Exception:
+            logging.exception('Recovering jobs failed')
+            return
+        if recovered:
+            logging.warning('Put back {} jobs taken by workers that died'.format(recovered))
+            self.counters['recovered'] += recovered
+
+    @gen.coroutine
+    def run(self):
+        """
+        Processes jobs until stop() is called and all taken jobs are done.
+        """
+        self.running = True
+        while self.running:
+            if self.nexmo_client.circuit_breaker.is_open():
+                yield gen.sleep(self.poll_interval)
+                continue
+            if time.time() >= self.next_recovery:
+                yield self.recover()
+            try:
+                jobs = yield self.queue.pop(self.batch_size)
+            except Exception:
+                logging.exception('Taking jobs from the queue failed')
+                jobs = []
+            if not jobs:
+                yield gen.sleep(self.poll_interval)
+                continue
+            self.counters['batches'] += 1
+            for job_id, job in jobs:
+                yield self.semaphore.acquire()
+                self.process(job_id, job)
+        yield self.idle.wait()
+
+    def stop(self):
+        self.running = False
+
+    @gen.coroutine
+    def process(self, job_id, job):
+        self.in_flight += 1
+        self.idle.clear()
+        try:
+            message_ids = yield self.nexmo_client.send(job['sender'].decode('utf-8'), job['to'],
+                                                       job['text'].decode('utf-8'))
+            if message_ids:
+                self.counters[SENT] += 1
+                yield self.queue.finish(job_id, SENT, message_ids=','.join(message_ids))
+            else:
+                self.counters[FAILED] += 1
+                yield self.queue.finish(job_id, FAILED)
+        except NexmoUnavailableError:
+            self.counters['requeued'] += 1
+            try:
+                yield self.queue.requeue(job_id)
+            except Exception:
+                logging.exception('Requeueing job {} failed'.format(job_id))
+        except Exception:
+            logging.exception('Processing job {} failed'.format(job_id))
+            self.counters[FAILED] += 1
+            try:
+                yield self.queue.finish(job_id, FAILED)
+            except Exception:
+                logging.exception('Marking job {} as failed failed'.format(job_id))
+        finally:
+            self.in_flight -= 1
+            if not self.in_flight:
+                self.idle.set()
+            self.semaphore.release()
+
+    def stats(self):
+        stats = dict(self.counters)
+        stats['in_flight'] = self.in_flight
+        return stats
@@ -8,12 +8,39 @@
 # ==============================================================================
 
 # Import modules
-from tornado.testing import AsyncHTTPTestCase
-from tornado.httpclient import HTTPRequest
-from app import NexmoApplication
+from tornado.testing import AsyncHTTPTestCase, AsyncTestCase, bind_unused_port, gen_test
+from tornado.httpserver import HTTPServer
+from tornado.httpclient import HTTPClient, HTTPRequest
+from tornado.ioloop import IOLoop
+from tornado.netutil import bind_sockets
+from tornado.concurrent import Future
+from tornado.web import Application, HTTPError, RequestHandler
+from tornado import gen
+from app import NexmoApplication, fork_workers, shutdown, start_server
 import json
+import unittest
 import redis as redis_driver
+import admission
 import configuration
+from cache import LRUCache
+import limiter
+from limiter import MemoryLimiter
+import metrics
+import redispool
+import geolocation
+import nexmoclient
+import sendqueue
+from phonecache import PhoneNumberCache
+from geolocation import GeoIPResolver, RangeGeoIP
+import os
+import random
+import shutil
+import signal
+import socket
+import struct
+import tempfile
+import time
+import pygeoip
 
 # Sandbox API credentials (see https://labs.nexmo.com/).
 SANDBOX_API_KEY = 'SD_98659'
@@ -35,6 +62,15 @@ class BaseTest(AsyncHTTPTestCase):
 
     limit_amount = 5
     limit_expires= 1800
+    limit_strategy = 'fixed_window'
+    limiter_backend = 'redis'
+    limit_key_layout = 'plain'
+    queue_mode = False
+    dlr_url = None
+    idempotency_window = 0
+    server_timing = False
+    admin_token = ''
+    bulk_api_key = 'bulk-key'
     api_key=SANDBOX_API_KEY
     api_secret=SANDBOX_API_SECRET
     domain=SANDBOX_DOMAIN
@@ -45,13 +81,17 @@ class BaseTest(AsyncHTTPTestCase):
         app = NexmoApplication(api_key=self.api_key, api_secret=self.api_secret, domain=self.domain,
                                callback=finish, io_loop=self.io_loop,
                                limit_amount=self.limit_amount, limit_expires=self.limit_expires,
+                               limit_strategy=self.limit_strategy, limiter_backend=self.limiter_backend,
+                               limit_key_layout=self.limit_key_layout, queue_mode=self.queue_mode,
+                               dlr_url=self.dlr_url, idempotency_window=self.idempotency_window,
+                               server_timing=self.server_timing, admin_token=self.admin_token,
+                               bulk_api_key=self.bulk_api_key,
                                message='Test message', sender='Test Sender')
         self.wait()
         return app
 
     def reset_limits(self):
-        for key in self.redis.keys('limit_call_*'):
-            self.redis.delete(key)
+        limiter.reset_limits(self.redis)
 
     def setUp(self):
         super(BaseTest, self).setUp()
@@ -64,6 +104,10 @@ class BaseTest(AsyncHTTPTestCase):
         self.assertEqual(self.limit_amount, self._app.limit_amount)
         self.assertEqual(self.limit_expires, self._app.limit_expires)
 
+    def bulk_fetch(self, path, body):
+        return self.fetch(path, method='POST', body=body,
+                          headers={'Content-Type': 'application/json', 'X-Api-Key': self.bulk_api_key})
+
     def assert_json_response(self, response, result={}):
         self.assertIn('Content-Type', response.headers)
         self.assertIn('json', response.headers['Content-Type'])
@@ -107,6 +151,19 @@ class LimitTestCase(BaseTest):
         response = self.wait()
         self.assert_json_response(response,  {'status': 'error', "error": "limit_acceded"})
 
+    def test_validate_number_batch_limits(self):
+        """Tests if batches are limited like one request per validation_batch_unit numbers.
+        """
+        self.reset_limits()
+        body = json.dumps({'numbers': ['+49176123456'] * 150})
+        for i in range(0, self._app.limit_amount // 2):
+            response = self.fetch('/validate_number/', method='POST', body=body,
+                                  headers={'Content-Type': 'application/json'})
+            self.assertEqual(150, len(response.body.splitlines()))
+        response = self.fetch('/validate_number/', method='POST', body=body,
+                              headers={'Content-Type': 'application/json'})
+        self.assert_json_response(response,  {'status': 'error', "error": "limit_acceded"})
+
     def test_defaultmessage_limits(self):
         """Tests if the validation limits for /defaultmessage/ are taking into account.
         """
@@ -124,6 +181,144 @@ class LimitTestCase(BaseTest):
         response = self.wait()
         self.assert_json_response(response,  {'status': 'error', "error": "limit_acceded"})
 
+    def test_limits_after_script_flush(self):
+        """Tests if limits still work when Redis has lost the limiter script.
+        """
+        self.redis.script_flush()
+        self.http_client.fetch(self.get_url('/validate_number/?number=%2B49176123456'), self.stop)
+        response = self.wait()
+        self.assert_json_response(response,  {'status': 'ok'})
+        self.assertEqual(1, int(self.redis.get('limit_call_number_validation_127.0.0.1')))
+        self.assertGreater(self.redis.ttl('limit_call_number_validation_127.0.0.1'), 0)
+
+
+
+class MemoryLimitTestCase(LimitTestCase):
+    """Tests request limitations with the memory limiter backend.
+    """
+    limiter_backend = 'memory'
+
+    def test_limits_after_script_flush(self):
+        self.skipTest('The memory limiter backend does not use Redis')
+
+
+
+class GcraLimitTestCase(LimitTestCase):
+    """Tests request limitations with the GCRA strategy.
+    """
+    limit_strategy = 'gcra'
+
+    def test_limits_after_script_flush(self):
+        self.redis.script_flush()
+        self.http_client.fetch(self.get_url('/validate_number/?number=%2B49176123456'), self.stop)
+        response = self.wait()
+        self.assert_json_response(response,  {'status': 'ok'})
+        self.assertGreater(self.redis.pttl('limit_call_gcra_number_validation_127.0.0.1'), 0)
+
+
+
+class CompactLimitTestCase(LimitTestCase):
+    """Tests request limitations with the compact key layout.
+    """
+    limit_key_layout = 'compact'
+
+    def test_limits_after_script_flush(self):
+        self.redis.script_flush()
+        self.http_client.fetch(self.get_url('/validate_number/?number=%2B49176123456'), self.stop)
+        response = self.wait()
+        self.assert_json_response(response,  {'status': 'ok'})
+        keys = self.redis.keys(limiter.KEY_PATTERN)
+        self.assertEqual(1, len(keys))
+        self.assertEqual({'\x7f\x00\x00\x01': '1'}, self.redis.hgetall(keys[0]))
+        self.assertGreater(self.redis.ttl(keys[0]), 0)
+
+
+
+class LimitPolicyTestCase(BaseTest):
+    """Tests limit policies of message handlers.
+    """
+    queue_mode = True
+
+    def setUp(self):
+        configuration.LIMIT_POLICIES['/message/'] = [{'dimension': 'ip', 'amount': 10, 'expires': 60},
+                                                     {'dimension': 'receiver', 'amount': 2, 'expires': 60},
+                                                     {'dimension': 'handler', 'amount': 6, 'expires': 60}]
+        super(LimitPolicyTestCase, self).setUp()
+
+    def tearDown(self):
+        del configuration.LIMIT_POLICIES['/message/']
+        super(LimitPolicyTestCase, self).tearDown()
+
+    def test_configuration(self):
+        super(LimitPolicyTestCase, self).test_configuration()
+        limiter.validate_policy(configuration.LIMIT_POLICIES['/message/'])
+        self.assertRaises(ValueError, limiter.validate_policy, [{'dimension': 'planet', 'amount': 1, 'expires': 1}])
+        self.assertRaises(ValueError, limiter.validate_policy, [{'dimension': 'ip', 'amount': 1, 'expires': 1}] * 2)
+
+    def test_receiver_limit(self):
+        for i in range(2):
+            response = self.fetch('/message/?receiver=%2B49176123456')
+            self.assert_json_response(response,  {'status': 'ok', 'message': 'Message queued'})
+        response = self.fetch('/message/?receiver=%2B49176123456')
+        self.assert_json_response(response,  {'status': 'error', 'error': 'limit_acceded', 'limit': 'receiver'})
+        response = self.fetch('/message/?receiver=%2B49176123457')
+        self.assert_json_response(response,  {'status': 'ok', 'message': 'Message queued'})
+
+    def test_bulk(self):
+        body = json.dumps({'receivers': ['+49176123456', '+49176123457', '+49176123458']})
+        response = self.bulk_fetch('/message/', body)
+        self.assert_json_response(response,  {'status': 'ok', 'queued': 3})
+        response = self.bulk_fetch('/message/', body)
+        self.assert_json_response(response,  {'status': 'ok', 'queued': 3})
+        # The handler allows 6 messages in total.
+        response = self.fetch('/message/?receiver=%2B49176123459')
+        self.assert_json_response(response,  {'status': 'error', 'error': 'limit_acceded', 'limit': 'handler'})
+
+
+
+class BurstLimitPolicyTestCase(BaseTest):
+    """Tests a policy with a burst and a sustained limit on the same dimension.
+    """
+    queue_mode = True
+
+    def setUp(self):
+        configuration.LIMIT_POLICIES['/message/'] = [{'dimension': 'ip', 'amount': 2, 'expires': 60},
+                                                     {'dimension': 'ip', 'amount': 100, 'expires': 3600}]
+        super(BurstLimitPolicyTestCase, self).setUp()
+
+    def tearDown(self):
+        del configuration.LIMIT_POLICIES['/message/']
+        super(BurstLimitPolicyTestCase, self).tearDown()
+
+    def test_burst_limit(self):
+        for i in range(2):
+            response = self.fetch('/message/?receiver=%2B49176123456')
+            self.assert_json_response(response,  {'status': 'ok', 'message': 'Message queued'})
+        response = self.fetch('/message/?receiver=%2B49176123456')
+        self.assert_json_response(response,  {'status': 'error', 'error': 'limit_acceded', 'limit': 'ip'})
+
+        # Each limit has its own counter and window.
+        burst = limiter.BaseLimiter.get_policy_key('/message/', 'ip', 2, 60, '127.0.0.1')
+        sustained = limiter.BaseLimiter.get_policy_key('/message/', 'ip', 100, 3600, '127.0.0.1')
+        self.assertEqual(2, int(self.redis.get(burst)))
+        self.assertEqual(2, int(self.redis.get(sustained)))
+        self.assertLessEqual(self.redis.ttl(burst), 60)
+        self.assertGreater(self.redis.ttl(sustained), 60)
+
+
+
+class MemoryLimitPolicyTestCase(LimitPolicyTestCase):
+    """Tests limit policies with the memory limiter backend.
+    """
+    limiter_backend = 'memory'
+
+
+
+class MemoryGcraLimitTestCase(MemoryLimitTestCase):
+    """Tests request limitations with the GCRA strategy and the memory limiter backend.
+    """
+    limit_strategy = 'gcra'
+
 
 
 class DefaultMessageHandlerTestCase(BaseTest):
@@ -159,6 +354,47 @@ class DefaultMessageHandlerTestCase(BaseTest):
         response = self.wait()
         self.assert_json_response(response,  {'status': 'ok', 'message': 'Message sent', 'number': '+49 176123456'})
 
+    def test_validate_number_batch(self):
+        response = self.fetch('/validate_number/?country=DE', method='POST',
+                              body='+49176123456\n0176123456\nabcdefg\n')
+        self.assertIn('json', response.headers['Content-Type'])
+        self.assertEqual([{'input': '+49176123456', 'number': '+49 176123456'},
+                          {'input': '0176123456', 'number': '+49 176123456'},
+                          {'input': 'abcdefg', 'number': False}],
+                         [json.loads(line) for line in response.body.splitlines()])
+
+    def test_validate_number_batch_too_large(self):
+        # Bodies are capped at 64 bytes per number of validation_batch_max_size before they are read.
+        body = json.dumps({'numbers': ['+49176123456']}) + ' ' * 1000 * 64
+        response = self.fetch('/validate_number/', method='POST', body=body,
+                              headers={'Content-Type': 'application/json'})
+        self.assert_json_response(response,  {'status': 'error', 'error': 'batch_too_large'})
+        # Streamed bodies growing larger are cut off.
+        def body_producer(write):
+            return write(body)
+        response = self.fetch('/validate_number/', method='POST', body_producer=body_producer,
+                              headers={'Content-Type': 'application/json'})
+        self.assertNotEqual(200, response.code)
+
+    def test_invalid_country(self):
+        for path, name in (('/validate_number/', 'numbers'), (self.path, 'receivers')):
+            body = json.dumps({name: ['0176123456'], 'country': 49})
+            response = self.bulk_fetch(path, body)
+            self.assertEqual(400, response.code)
+            self.assert_json_response(response, {'status': 'error', 'error': 'invalid_arguments'})
+        # Rejected before the limitation.
+        self.assertEqual([], self.redis.keys(limiter.KEY_PATTERN))
+
+    def test_send_bulk(self):
+        body = json.dumps({'receivers': ['+49176123456', 'abcdefg'], 'country': 'DE'})
+        response = self.bulk_fetch(self.path, body)
+        self.assert_json_response(response,  {'status': 'ok', 'sent': 1, 'failed': 1})
+        results = json.loads(response.body)['results']
+        self.assertEqual(1, len(results[0].pop('message_ids')))
+        self.assertEqual([{'receiver': '+49176123456', 'number': '+49 176123456', 'status': 'ok'},
+                          {'receiver': 'abcdefg', 'number': False, 'status': 'error', 'error': 'receiver_validation'}],
+                         results)
+
     def test_jsonp(self):
         # Tests jsonp requests.
         self.http_client.fetch(self.get_url(self.path + '?receiver=%2B49176123456&callback=callback'), self.stop)
@@ -184,6 +420,23 @@ class ErrorTestCase(BaseTest):
         response = self.wait()
         self.assertEqual(404, response.code)
 
+    def test_in_flight(self):
+        # Test that finished requests, failed ones included, are not awaited on shutdown.
+        self.fetch('/validate_number/?number=%2B49176123456')
+        self.fetch('/message/?receiver=invalid')
+        self.fetch('/validate_number/', method='DELETE')
+        self.assertEqual(0, self._app.in_flight)
+
+    def test_limiter_unavailable(self):
+        # The limiter fails closed by default, requests it can't count are rejected.
+        self.assertFalse(self._app.limiter.fail_open)
+        lost = Future()
+        lost.set_result(None)
+        self._app.limiter.fixed_window_script = lambda redis, keys, args: lost
+        response = self.fetch('/message/?receiver=%2B49176123456')
+        self.assertEqual(503, response.code)
+        self.assert_json_response(response, {'status': 'error', 'error': 'limiter_unavailable'})
+
 
 
 class ConfigurationHandlerTestCase(DefaultMessageHandlerTestCase):
@@ -199,3 +452,982 @@ class ConfigurationHandlerTestCase(DefaultMessageHandlerTestCase):
         super(ConfigurationHandlerTestCase, self).setUp()
 
 
+
+class QueueTestCase(BaseTest):
+    """Tests queueing messages in queue mode.
+    """
+
+    limit_amount = 500
+    queue_mode = True
+
+    def setUp(self):
+        super(QueueTestCase, self).setUp()
+        self.redis.delete(sendqueue.QUEUE_KEY, sendqueue.SENDING_KEY)
+        # Workers send to a stub Nexmo service.
+        StubNexmoHandler.statuses = []
+        StubNexmoHandler.requests = []
+        sock, self.nexmo_port = bind_unused_port()
+        self.nexmo_server = HTTPServer(Application([(r'/sms/json', StubNexmoHandler)]), io_loop=self.io_loop)
+        self.nexmo_server.add_sockets([sock])
+
+    def tearDown(self):
+        self.nexmo_server.stop()
+        super(QueueTestCase, self).tearDown()
+
+    def get_worker(self):
+        return sendqueue.SendWorker(self._app.send_queue,
+                                    nexmoclient.AsyncNexmoClient('key', 'secret',
+                                                                 domain='127.0.0.1:%d' % self.nexmo_port))
+
+    @gen_test
+    def test_queue(self):
+        response = yield self.http_client.fetch(self.get_url('/message/?receiver=%2B49176123456'))
+        self.assertEqual(202, response.code)
+        self.assert_json_response(response,  {'status': 'ok', 'message': 'Message queued', 'number': '+49 176123456'})
+        job_id = json.loads(response.body)['job_id']
+        response = yield self.http_client.fetch(self.get_url('/job/' + job_id))
+        self.assert_json_response(response,  {'status': 'ok', 'state': 'queued', 'number': '+49 176123456'})
+
+        # Send the message like worker.py.
+        worker = self.get_worker()
+        jobs = yield self._app.send_queue.pop(10)
+        self.assertEqual([job_id], [job[0] for job in jobs])
+        yield worker.process(*jobs[0])
+        self.assertEqual(1, worker.stats()['sent'])
+        self.assertEqual(['0049176123456'], StubNexmoHandler.requests[0].arguments['to'])
+        response = yield self.http_client.fetch(self.get_url('/job/' + job_id))
+        self.assert_json_response(response,  {'status': 'ok', 'state': 'sent', 'message_ids': ['1']})
+
+    @gen_test
+    def test_processing_error(self):
+        response = yield self.http_client.fetch(self.get_url('/message/?receiver=%2B49176123456'))
+        job_id = json.loads(response.body)['job_id']
+        worker = self.get_worker()
+        def fail(sender, to, text):
+            raise RuntimeError('Nexmo client broken')
+        worker.nexmo_client.send = fail
+        jobs = yield self._app.send_queue.pop(10)
+        yield worker.process(*jobs[0])
+        self.assertEqual(1, worker.stats()['failed'])
+        job = yield self._app.send_queue.get_job(job_id)
+        self.assertEqual(sendqueue.FAILED, job['status'])
+
+    @gen_test
+    def test_recover(self):
+        response = yield self.http_client.fetch(self.get_url('/message/?receiver=%2B49176123456'))
+        job_id = json.loads(response.body)['job_id']
+        queue = self._app.send_queue
+        # A worker takes the job and dies.
+        yield queue.pop(10)
+        job = yield queue.get_job(job_id)
+        self.assertEqual(sendqueue.SENDING, job['status'])
+        self.assertIn('started', job)
+        self.assertEqual(0, (yield queue.recover(60)))
+
+        # The job is queued again once it was taken longer than the timeout ago.
+        worker = self.get_worker()
+        worker.visibility_timeout = -1
+        yield worker.recover()
+        self.assertEqual(1, worker.stats()['recovered'])
+        job = yield queue.get_job(job_id)
+        self.assertEqual(sendqueue.QUEUED, job['status'])
+        jobs = yield queue.pop(10)
+        self.assertEqual([job_id], [job[0] for job in jobs])
+        yield worker.process(*jobs[0])
+        self.assertEqual(1, worker.stats()['sent'])
+        # Finished jobs are not recovered.
+        self.assertEqual(0, (yield queue.recover(-1)))
+
+    def test_lost_reply(self):
+        lost = Future()
+        lost.set_result(None)
+        self._app.send_queue.enqueue_script = lambda redis, keys, args: lost
+        response = self.fetch('/message/?receiver=%2B49176123456')
+        self.assertEqual(200, response.code)
+        self.assert_json_response(response,  {'status': 'error', 'error': 'queue_unavailable'})
+        body = json.dumps({'receivers': ['+49176123456']})
+        response = self.bulk_fetch('/message/', body)
+        self.assert_json_response(response,  {'status': 'error', 'error': 'queue_unavailable'})
+
+    def test_bulk(self):
+        # Bulk receivers are not counted for limit_amount but for bulk_limit_amount.
+        body = json.dumps({'receivers': ['+491761234%02d' % i for i in range(self.limit_amount * 2)]})
+        response = self.bulk_fetch('/message/', body)
+        self.assertEqual(202, response.code)
+        self.assert_json_response(response,  {'status': 'ok', 'queued': self.limit_amount * 2})
+        response = self.fetch('/message/?receiver=%2B49176123456')
+        self.assert_json_response(response,  {'status': 'ok', 'message': 'Message queued'})
+
+        # Bulk requests need the bulk API key.
+        response = self.fetch('/message/', method='POST', body=body, headers={'Content-Type': 'application/json'})
+        self.assertEqual(403, response.code)
+        response = self.fetch('/message/', method='POST', body=body,
+                              headers={'Content-Type': 'application/json', 'X-Api-Key': 'wrong'})
+        self.assertEqual(403, response.code)
+
+    def test_unknown_job(self):
+        response = self.fetch('/job/' + '0' * 32)
+        self.assertEqual(404, response.code)
+        self.assert_json_response(response,  {'status': 'error', 'error': 'job_not_found'})
+
+
+
+class IdempotencyTestCase(BaseTest):
+    """Tests answering duplicate message requests with the recorded response.
+    """
+
+    limit_amount = 2
+    queue_mode = True
+    idempotency_window = 60
+
+    def setUp(self):
+        super(IdempotencyTestCase, self).setUp()
+        for key in self.redis.keys('idempotency:*'):
+            self.redis.delete(key)
+
+    def test_duplicates(self):
+        hits = metrics.IDEMPOTENCY.labels('hit').value
+        responses = [self.fetch('/message/?receiver=%2B49176123456') for i in range(4)]
+        self.assertEqual([202] * 4, [response.code for response in responses])
+        self.assertEqual(1, len(set(json.loads(response.body)['job_id'] for response in responses)))
+        self.assertNotIn('Idempotent-Replayed', responses[0].headers)
+        self.assertEqual('true', responses[1].headers['Idempotent-Replayed'])
+        self.assertEqual(3, self._app.idempotency.stats()['hits'])
+        self.assertEqual(hits + 3, metrics.IDEMPOTENCY.labels('hit').value)
+
+        # Duplicates did not count for the limitation.
+        response = self.fetch('/message/?receiver=%2B49176123457')
+        self.assert_json_response(response,  {'status': 'ok', 'message': 'Message queued'})
+
+    def test_idempotency_key(self):
+        first = self.fetch('/message/?receiver=%2B49176123456', headers={'Idempotency-Key': 'a'})
+        second = self.fetch('/message/?receiver=%2B49176123456&idempotency_key=b')
+        self.assertNotEqual(json.loads(first.body)['job_id'], json.loads(second.body)['job_id'])
+        response = self.fetch('/message/?receiver=%2B49176123456&idempotency_key=a')
+        self.assertEqual(json.loads(first.body), json.loads(response.body))
+
+    @gen_test
+    def test_concurrent_duplicates(self):
+        coalesced = metrics.IDEMPOTENCY.labels('coalesced').value
+        responses = yield [self.http_client.fetch(self.get_url('/message/?receiver=%2B49176123456'))
+                           for i in range(2)]
+        self.assertEqual(json.loads(responses[0].body), json.loads(responses[1].body))
+        self.assertEqual(1, self._app.idempotency.stats()['coalesced'])
+        self.assertEqual(coalesced + 1, metrics.IDEMPOTENCY.labels('coalesced').value)
+
+    def test_claim_outlives_slow_send(self):
+        client = self._app.nexmo_client
+        self.assertGreater(self._app.idempotency.pending_ttl, client.retry_policy.deadline + client.request_timeout)
+        ttls = []
+        @gen.coroutine
+        def slow_enqueue(messages):
+            yield gen.sleep(1)
+            # Another process would still see the claim after the slowest possible send.
+            ttls.extend(self.redis.ttl(key) for key in self.redis.keys('idempotency:*'))
+            raise gen.Return(['0' * 32])
+        self._app.send_queue.enqueue = slow_enqueue
+        response = self.fetch('/message/?receiver=%2B49176123456')
+        self.assertEqual(202, response.code)
+        self.assertEqual(1, len(ttls))
+        self.assertGreater(ttls[0], client.get_max_send_time() - 1)
+        self.assertEqual(json.loads(response.body), json.loads(self.fetch('/message/?receiver=%2B49176123456').body))
+
+    def test_release_on_error(self):
+        def fail(messages):
+            raise RuntimeError('Queue broken')
+        self._app.send_queue.enqueue = fail
+        response = self.fetch('/message/?receiver=%2B49176123456')
+        self.assertEqual(500, response.code)
+        # The key was released before the error was raised.
+        self.assertEqual(1, self._app.idempotency.stats()['released'])
+        self.assertEqual([], self.redis.keys('idempotency:*'))
+
+    @gen_test
+    def test_retry_waiting_duplicates(self):
+        # A duplicate waiting for a failed request is processed instead of getting its error.
+        enqueue = self._app.send_queue.enqueue
+        calls = []
+        @gen.coroutine
+        def fail_once(messages):
+            calls.append(messages)
+            if len(calls) == 1:
+                yield gen.sleep(0.1)
+                raise RuntimeError('Queue broken')
+            result = yield enqueue(messages)
+            raise gen.Return(result)
+        self._app.send_queue.enqueue = fail_once
+        responses = yield [self.http_client.fetch(self.get_url('/message/?receiver=%2B49176123456'), raise_error=False)
+                           for i in range(2)]
+        self.assertEqual([500, 202], sorted(response.code for response in responses))
+        self.assertEqual(2, len(calls))
+        self.assertEqual(1, self._app.idempotency.stats()['coalesced'])
+        self.assertEqual(1, len(self.redis.keys('idempotency:*')))
+
+
+
+class DLRTestCase(BaseTest):
+    """Tests receiving delivery receipts.
+    """
+
+    dlr_url = 'http://localhost/dlr/'
+
+    def setUp(self):
+        super(DLRTestCase, self).setUp()
+        self.redis.delete('sms_dlr:0A0000001234ABCD')
+
+    def send_receipt(self, status):
+        return self.fetch('/dlr/?msisdn=49176123456&to=Sender&network-code=26202&messageId=0A0000001234ABCD'
+                          '&price=0.03330000&status={}&err-code=0&message-timestamp=2026-10-16+12%3A00%3A00'.format(status))
+
+    def test_receipts(self):
+        self.assertEqual(200, self.send_receipt('buffered').code)
+        response = self.fetch('/status/0A0000001234ABCD')
+        self.assert_json_response(response,  {'status': 'ok', 'state': 'buffered', 'err_code': '0'})
+        # Details of the receipt are not public.
+        for field in ('number', 'price', 'network'):
+            self.assertNotIn(field, json.loads(response.body))
+
+        # Receipts are written to Redis when flushed.
+        self.assertEqual(200, self.send_receipt('delivered').code)
+        self.io_loop.run_sync(self._app.receipts.flush)
+        self.assertEqual(0, self._app.receipts.stats()['pending'])
+        self.assertEqual('delivered', self.redis.hget('sms_dlr:0A0000001234ABCD', 'status'))
+
+        # A late intermediate state does not replace the final one.
+        self.send_receipt('buffered')
+        self.io_loop.run_sync(self._app.receipts.flush)
+        response = self.fetch('/status/0A0000001234ABCD')
+        self.assert_json_response(response,  {'status': 'ok', 'state': 'delivered',
+                                               'timestamp': '2026-10-16 12:00:00'})
+        self.assertEqual('26202', self.redis.hget('sms_dlr:0A0000001234ABCD', 'network'))
+
+    def test_invalid_receipt(self):
+        self.assertEqual(400, self.fetch('/dlr/?messageId=0A0000001234ABCD').code)
+
+    def test_unknown_message(self):
+        response = self.fetch('/status/0A0000001234ABCE')
+        self.assertEqual(404, response.code)
+        self.assert_json_response(response,  {'status': 'error', 'error': 'receipt_not_found'})
+
+
+
+class MetricsTestCase(BaseTest):
+    """Tests the Prometheus metrics endpoint.
+    """
+    dlr_url = 'http://localhost/dlr/'
+    idempotency_window = 60
+
+    def test_metrics(self):
+        self.fetch('/validate_number/?number=%2B49176123456')
+        self.fetch('/message/?receiver=invalid')
+        response = self.fetch('/metrics')
+        self.assertEqual(200, response.code)
+        self.assertEqual(metrics.CONTENT_TYPE, response.headers['Content-Type'])
+        self.assertIn('sms_http_requests_total{handler="ConfiguredNumberValidationHandler",code="200"}', response.body)
+        self.assertIn('sms_responses_total{handler="DefaultMessageHandler",status="error",error="receiver_validation"}',
+                      response.body)
+        self.assertIn('sms_stage_duration_seconds_count{stage="number_parsing"}', response.body)
+        self.assertIn('sms_stage_duration_seconds_count{stage="limit_check"}', response.body)
+        self.assertIn('sms_redis_command_duration_seconds_count{command="EVALSHA"}', response.body)
+        self.assertIn('sms_nexmo_requests_in_flight 0', response.body)
+
+    def test_component_metrics(self):
+        self.fetch('/validate_number/?number=0176123456')
+        self.fetch('/validate_number/?number=0176123456')
+        response = self.fetch('/metrics')
+        self.assertIn('sms_cache_events_total{cache="phone_numbers",event="hit"}', response.body)
+        self.assertIn('sms_cache_hit_ratio{cache="phone_numbers"}', response.body)
+        self.assertIn('sms_cache_events_total{cache="geoip",event="miss"}', response.body)
+        self.assertIn('sms_cache_entries{cache="blocked_clients"} 0', response.body)
+        self.assertIn('sms_nexmo_governor_wait_seconds{statistic="max"}', response.body)
+        self.assertIn('sms_nexmo_retries_total 0', response.body)
+        self.assertIn('sms_nexmo_gave_up_total 0', response.body)
+        self.assertIn('sms_dlr_receipts_total{event="received"}', response.body)
+        self.assertIn('sms_dlr_receipts_pending 0', response.body)
+        self.assertIn('sms_idempotency_keys_total{outcome="stored"}', response.body)
+        self.assertIn('sms_idempotency_requests_waiting 0', response.body)
+
+
+
+class ServerTimingTestCase(BaseTest):
+    """Tests the Server-Timing header.
+    """
+    server_timing = True
+
+    def test_server_timing(self):
+        response = self.fetch('/validate_number/?number=176123456&country=DE')
+        timings = [timing.split(';')[0] for timing in response.headers['Server-Timing'].split(', ')]
+        self.assertEqual(['limit', 'parse', 'total'], timings)
+
+        # The country of numbers in national notation is located by IP address.
+        response = self.fetch('/validate_number/?number=0176123456')
+        self.assertIn('geoip;dur=', response.headers['Server-Timing'])
+
+    def test_limited_message_not_parsed(self):
+        # Clients over their limit are rejected before the receiver is parsed.
+        for i in range(self.limit_amount):
+            self.fetch('/message/?receiver=invalid')
+        response = self.fetch('/message/?receiver=invalid')
+        self.assert_json_response(response,  {'status': 'error', 'error': 'limit_acceded'})
+        timings = [timing.split(';')[0] for timing in response.headers['Server-Timing'].split(', ')]
+        self.assertEqual(['limit', 'total'], timings)
+
+
+
+class ProfileTestCase(BaseTest):
+    """Tests the profiling admin route.
+    """
+    admin_token = 'secret'
+
+    def admin_fetch(self, path, **kwargs):
+        return self.fetch(path, headers={'X-Admin-Token': self.admin_token}, **kwargs)
+
+    def test_profile(self):
+        self.assertEqual(403, self.fetch('/admin/profile').code)
+        self.assertIn('No requests profiled', self.admin_fetch('/admin/profile').body)
+        self.assert_json_response(self.admin_fetch('/admin/profile?sample_rate=1', method='POST', body=''),
+                                  {'status': 'ok', 'sample_rate': 1.0})
+        self.fetch('/validate_number/?number=%2B49176123456')
+        self.assertEqual(0, self._app.profiler.active)
+        # Metrics scrapes and admin requests are not profiled.
+        self.fetch('/metrics')
+        self.admin_fetch('/admin/profile')
+        self.assertEqual(1, self._app.profiler.stats()['sampled'])
+        response = self.admin_fetch('/admin/profile?sort=tottime&limit=5')
+        self.assertEqual(200, response.code)
+        self.assertIn('requests profiled', response.body)
+        self.assertEqual(400, self.admin_fetch('/admin/profile?sort=unknown').code)
+        self.assertEqual(400, self.admin_fetch('/admin/profile?sample_rate=2', method='POST', body='').code)
+        self.assert_json_response(self.admin_fetch('/admin/profile', method='DELETE'), {'status': 'ok', 'sampled': 0})
+
+    def test_empty_token(self):
+        # An empty admin token never grants access.
+        self._app.settings['admin_token'] = ''
+        self.assertEqual(403, self.fetch('/admin/profile', headers={'X-Admin-Token': ''}).code)
+
+
+
+class AdmissionTestCase(BaseTest):
+    """Tests rejecting requests while the application is overloaded.
+    """
+
+    def assert_overloaded(self, path, reason):
+        response = self.fetch(path)
+        self.assertEqual(503, response.code)
+        self.assertEqual('1', response.headers['Retry-After'])
+        self.assert_json_response(response, {'status': 'error', 'error': 'overloaded'})
+        self.assertEqual(1, self._app.admission.stats()[reason])
+
+    def test_event_loop_lag(self):
+        self._app.admission.max_lag = 0.5
+        self._app.lag_monitor.lag = 0.6
+        self.assert_overloaded('/validate_number/?number=%2B49176123456', admission.EVENT_LOOP_LAG)
+        # Nothing was counted for the limitation.
+        self.assertIsNone(self.redis.get('limit_call_number_validation_127.0.0.1'))
+        self._app.lag_monitor.lag = 0.4
+        self.assertEqual(200, self.fetch('/validate_number/?number=%2B49176123456').code)
+
+    def test_nexmo_backlog(self):
+        self._app.admission.max_pending_sends = 10
+        self._app.nexmo_client.governor.in_flight = 11
+        try:
+            self.assert_overloaded('/message/?receiver=%2B49176123456', admission.NEXMO_BACKLOG)
+        finally:
+            self._app.nexmo_client.governor.in_flight = 0
+        self.assertIn('sms_shed_requests_total{handler="DefaultMessageHandler",reason="nexmo_backlog"}',
+                      self.fetch('/metrics').body)
+
+
+
+class LagMonitorTestCase(AsyncTestCase):
+    """Tests measuring the event loop lag.
+    """
+
+    @gen_test
+    def test_lag(self):
+        monitor = admission.LagMonitor(interval=0.01, io_loop=self.io_loop)
+        monitor.start()
+        yield gen.sleep(0.05)
+        self.assertLess(monitor.lag, 0.05)
+        # Block the event loop.
+        time.sleep(0.1)
+        yield gen.sleep(0.02)
+        self.assertGreaterEqual(monitor.max_lag, 0.08)
+        monitor.stop()
+
+
+
+class ShutdownTestCase(AsyncTestCase):
+    """Tests waiting for the requests in flight on shutdown.
+    """
+
+    class FakeServer(object):
+        stopped = False
+
+        def stop(self):
+            self.stopped = True
+
+    class FakeReceipts(object):
+        stopped = flushed = False
+
+        def stop(self):
+            self.stopped = True
+
+        @gen.coroutine
+        def flush(self):
+            self.flushed = True
+
+    class FakeApplication(object):
+        def __init__(self, in_flight, receipts):
+            self.in_flight = in_flight
+            self.receipts = receipts
+
+    def setUp(self):
+        super(ShutdownTestCase, self).setUp()
+        self.server = self.FakeServer()
+        self.receipts = self.FakeReceipts()
+        self.app = self.FakeApplication(2, self.receipts)
+
+    def finish_request(self):
+        self.app.in_flight -= 1
+
+    @gen_test
+    def test_drain(self):
+        self.io_loop.call_later(0.05, self.finish_request)
+        self.io_loop.call_later(0.1, self.finish_request)
+        start = time.time()
+        yield shutdown(self.server, self.app, 5)
+        self.assertLess(time.time() - start, 1)
+        self.assertTrue(self.server.stopped)
+        self.assertEqual(0, self.app.in_flight)
+        self.assertTrue(self.receipts.stopped)
+        self.assertTrue(self.receipts.flushed)
+
+    @gen_test
+    def test_timeout(self):
+        start = time.time()
+        yield shutdown(self.server, self.app, 0.2)
+        self.assertGreaterEqual(time.time() - start, 0.2)
+        self.assertEqual(2, self.app.in_flight)
+        self.assertTrue(self.receipts.flushed)
+
+
+
+class SharedSocketTestCase(unittest.TestCase):
+    """Tests serving on sockets bound before forking like with --processes.
+    """
+
+    class PidHandler(RequestHandler):
+        def get(self):
+            self.write(str(os.getpid()))
+
+    def test_forked_worker(self):
+        sockets = bind_sockets(0, '127.0.0.1')
+        for sock in sockets:
+            self.addCleanup(sock.close)
+        pid = os.fork()
+        if pid == 0:
+            try:
+                io_loop = IOLoop()
+                io_loop.make_current()
+                start_server(Application([(r'/', self.PidHandler)]), sockets)
+                io_loop.call_later(10, io_loop.stop)
+                io_loop.start()
+            finally:
+                os._exit(0)
+        self.addCleanup(os.waitpid, pid, 0)
+        self.addCleanup(os.kill, pid, signal.SIGTERM)
+        # The parent does not accept connections, the worker does.
+        response = HTTPClient().fetch('http://127.0.0.1:{}/'.format(sockets[0].getsockname()[1]))
+        self.assertEqual(str(pid), response.body)
+
+    def test_sigint(self):
+        # The parent stops its workers with SIGTERM on SIGINT, which workers ignore themselves.
+        read_fd, write_fd = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            try:
+                os.close(read_fd)
+                fork_workers(1)
+                def on_signal(signum, frame):
+                    os.write(write_fd, str(signum))
+                    os._exit(0)
+                signal.signal(signal.SIGTERM, on_signal)
+                os.write(write_fd, 'ready')
+                time.sleep(10)
+            finally:
+                os._exit(0)
+        os.close(write_fd)
+        self.addCleanup(os.close, read_fd)
+        self.addCleanup(os.waitpid, pid, 0)
+        self.assertEqual('ready', os.read(read_fd, 5))
+        # Wait for the parent to pass on signals.
+        time.sleep(0.5)
+        os.kill(pid, signal.SIGINT)
+        self.assertEqual(str(signal.SIGTERM), os.read(read_fd, 10))
+
+
+
+class MetricsFormatTestCase(unittest.TestCase):
+    """Tests the text exposition of metrics.
+    """
+
+    def test_histogram(self):
+        histogram = metrics.Histogram('test_seconds', 'A test', ('stage',), buckets=(0.1, 1), registry=None)
+        for value in (0.05, 0.1, 0.5, 5):
+            histogram.labels('a"b').observe(value)
+        self.assertEqual(['# HELP test_seconds A test',
+                          '# TYPE test_seconds histogram',
+                          'test_seconds_bucket{stage="a\\"b",le="0.1"} 2',
+                          'test_seconds_bucket{stage="a\\"b",le="1.0"} 3',
+                          'test_seconds_bucket{stage="a\\"b",le="+Inf"} 4',
+                          'test_seconds_sum{stage="a\\"b"} 5.65',
+                          'test_seconds_count{stage="a\\"b"} 4'], histogram.expose())
+
+    def test_counter(self):
+        registry = []
+        counter = metrics.Counter('test_total', 'A test', registry=registry)
+        counter.inc()
+        counter.inc(2)
+        self.assertEqual('# HELP test_total A test\n# TYPE test_total counter\ntest_total 3\n',
+                         metrics.expose(registry))
+        self.assertRaises(ValueError, counter.labels, 'unexpected')
+
+
+
+class LRUCacheTestCase(unittest.TestCase):
+    """Tests the in-process LRU cache.
+    """
+
+    def setUp(self):
+        self.now = 1000.0
+        self.cache = LRUCache(2, clock=lambda: self.now)
+
+    def test_eviction(self):
+        self.cache.set('a', 1)
+        self.cache.set('b', 2)
+        self.assertEqual(1, self.cache.get('a'))
+        self.cache.set('c', 3)
+        self.assertEqual(None, self.cache.get('b'))
+        self.assertEqual(1, self.cache.get('a'))
+        self.assertEqual(3, self.cache.get('c'))
+        self.assertEqual(1, self.cache.stats()['evictions'])
+
+    def test_expiry(self):
+        self.cache.set('a', 1, expires=self.now + 10)
+        self.assertEqual(1, self.cache.get('a'))
+        self.now += 10
+        self.assertEqual(None, self.cache.get('a'))
+        self.assertEqual(0, len(self.cache))
+        stats = self.cache.stats()
+        self.assertEqual(1, stats['hits'])
+        self.assertEqual(1, stats['misses'])
+        self.assertEqual(1, stats['expirations'])
+
+    def test_disabled(self):
+        cache = LRUCache(0)
+        cache.set('a', 1)
+        self.assertEqual(None, cache.get('a'))
+
+
+
+class RedisLimiterFailureTestCase(AsyncTestCase):
+    """Tests that the Redis limiter fails closed without Redis unless it
+    fails open.
+    """
+
+    class FakeApplication(object):
+        @property
+        def redis(self):
+            raise redispool.RedisUnavailableError('Redis is not configured')
+
+    @gen_test
+    def test_unavailable(self):
+        redis_limiter = limiter.RedisLimiter(self.FakeApplication(), blocked_cache_size=0, fail_open=True)
+        self.assertTrue((yield redis_limiter.check('test', '1.2.3.4', 1, 10)))
+        self.assertEqual(None, (yield redis_limiter.check_many([('a', 1, 10, 1), ('b', 1, 10, 1)])))
+        self.assertEqual(2, redis_limiter.stats()['redis_errors'])
+
+    @gen_test
+    def test_lost_reply(self):
+        # A script resolves to None if the connection is lost while waiting for the reply.
+        redis_limiter = limiter.RedisLimiter(self, blocked_cache_size=0, fail_open=True)
+        self.redis = None
+        lost = Future()
+        lost.set_result(None)
+        redis_limiter.fixed_window_script = lambda redis, keys, args: lost
+        self.assertTrue((yield redis_limiter.check('test', '1.2.3.4', 1, 10)))
+        self.assertEqual(1, redis_limiter.stats()['redis_errors'])
+
+    @gen_test
+    def test_fail_closed(self):
+        redis_limiter = limiter.RedisLimiter(self.FakeApplication(), blocked_cache_size=0)
+        with self.assertRaises(limiter.LimiterUnavailableError):
+            yield redis_limiter.check('test', '1.2.3.4', 1, 10)
+        with self.assertRaises(limiter.LimiterUnavailableError):
+            yield redis_limiter.check_many([('a', 1, 10, 1)])
+        self.assertEqual(2, redis_limiter.stats()['redis_errors'])
+
+
+
+class MemoryLimiterTestCase(AsyncTestCase):
+    """Tests counter expiry of the memory limiter backend.
+    """
+
+    def setUp(self):
+        super(MemoryLimiterTestCase, self).setUp()
+        self.now = 1000.0
+        self.limiter = MemoryLimiter(max_entries=2, sweep_batch=10, clock=lambda: self.now)
+
+    @gen_test
+    def test_limit_expires(self):
+        for i in range(3):
+            self.assertTrue((yield self.limiter.check('test', '1.2.3.4', 3, 10)))
+        self.assertFalse((yield self.limiter.check('test', '1.2.3.4', 3, 10)))
+        self.now += 10
+        self.assertTrue((yield self.limiter.check('test', '1.2.3.4', 3, 10)))
+
+    @gen_test
+    def test_bounded_memory(self):
+        for i in range(10):
+            yield self.limiter.check('test', '10.0.0.%d' % i, 3, 10)
+        self.assertLessEqual(len(self.limiter.counters), 3)
+        self.assertGreater(self.limiter.stats()['evictions'], 0)
+        self.now += 20
+        yield self.limiter.check('test', '1.2.3.4', 3, 10)
+        self.assertEqual(1, len(self.limiter.counters))
+
+    @gen_test
+    def test_gcra(self):
+        # A burst of 3 calls, then one call every 10 / 3 seconds.
+        for i in range(3):
+            self.assertTrue((yield self.limiter.check('test', '1.2.3.4', 3, 10, 'gcra')))
+        self.assertFalse((yield self.limiter.check('test', '1.2.3.4', 3, 10, 'gcra')))
+        self.now += 3
+        self.assertFalse((yield self.limiter.check('test', '1.2.3.4', 3, 10, 'gcra')))
+        self.now += 0.5
+        self.assertTrue((yield self.limiter.check('test', '1.2.3.4', 3, 10, 'gcra')))
+        self.assertFalse((yield self.limiter.check('test', '1.2.3.4', 3, 10, 'gcra')))
+
+    @gen_test
+    def test_check_many(self):
+        limits = [('ip', 5, 10, 1), ('receiver', 2, 10, 1)]
+        for i in range(2):
+            self.assertIsNone((yield self.limiter.check_many(limits)))
+        self.assertEqual(1, (yield self.limiter.check_many(limits)))
+        # A rejected call is not counted by any limit.
+        self.assertEqual(2, self.limiter.counters['ip'][0])
+        self.assertIsNone((yield self.limiter.check_many([('ip', 5, 10, 3)])))
+
+
+
+class PhoneNumberCacheTestCase(unittest.TestCase):
+    """Tests parsing and caching phone numbers.
+    """
+
+    def test_parse(self):
+        cache = PhoneNumberCache()
+        parsed = cache.parse('030 12345678', 'DE')
+        self.assertEqual('+49 30 12345678', parsed.international)
+        self.assertEqual('+493012345678', parsed.e164)
+        self.assertEqual(None, cache.parse('030 12345678'))
+        self.assertEqual(None, cache.parse('no number', 'DE'))
+
+    def test_cache(self):
+        cache = PhoneNumberCache()
+        for i in range(3):
+            self.assertEqual('+4915112345678', cache.parse('0151 12345678', 'DE').e164)
+            self.assertEqual(None, cache.parse('no number', 'DE'))
+        stats = cache.stats()
+        self.assertEqual(2, stats['misses'])
+        self.assertEqual(4, stats['hits'])
+        self.assertEqual(0.6667, stats['hit_rate'])
+
+
+
+class SendGovernorTestCase(AsyncTestCase):
+    """Tests pacing of outbound requests.
+    """
+
+    @gen_test
+    def test_rate(self):
+        governor = nexmoclient.SendGovernor(rate=50, burst=1)
+        start = time.time()
+        for i in range(5):
+            yield governor.acquire()
+            governor.release()
+        # The first request starts at once, the others every 20ms.
+        self.assertGreaterEqual(time.time() - start, 0.075)
+        self.assertEqual(5, governor.stats()['started'])
+        self.assertEqual(0, governor.stats()['queue_depth'])
+
+    @gen_test
+    def test_priority(self):
+        governor = nexmoclient.SendGovernor(rate=0, max_in_flight=1)
+        yield governor.acquire()
+        bulk = governor.acquire(nexmoclient.PRIORITY_BULK)
+        single = governor.acquire()
+        self.assertEqual(2, governor.stats()['queue_depth'])
+        governor.release()
+        self.assertTrue(single.done())
+        self.assertFalse(bulk.done())
+        governor.release()
+        self.assertTrue(bulk.done())
+
+
+
+class CircuitBreakerTestCase(unittest.TestCase):
+    """Tests opening, probing and closing of the circuit breaker.
+    """
+
+    def setUp(self):
+        self.now = 1000.0
+        self.breaker = nexmoclient.CircuitBreaker(error_rate=0.5, latency=1, min_requests=4, window=10,
+                                                  reset_timeout=5, clock=lambda: self.now)
+
+    def request(self, failed, duration=0.1):
+        self.breaker.record(self.breaker.allow(), failed, duration)
+
+    def assertMetricState(self, state):
+        for name in (nexmoclient.CLOSED, nexmoclient.OPEN, nexmoclient.HALF_OPEN):
+            self.assertEqual(int(name == state), metrics.BREAKER_STATE.labels(name).value)
+
+    def test_error_rate(self):
+        trips = metrics.BREAKER_TRIPS.labels().value
+        rejected = metrics.BREAKER_REJECTED.labels().value
+        for failed in (False, True, False):
+            self.request(failed)
+        self.assertEqual(nexmoclient.CLOSED, self.breaker.state)
+        self.assertMetricState(nexmoclient.CLOSED)
+        self.request(True)
+        self.assertEqual(nexmoclient.OPEN, self.breaker.state)
+        self.assertMetricState(nexmoclient.OPEN)
+        self.assertEqual(trips + 1, metrics.BREAKER_TRIPS.labels().value)
+        self.assertFalse(self.breaker.allow())
+        self.assertEqual(1, self.breaker.stats()['rejected'])
+        self.assertEqual(rejected + 1, metrics.BREAKER_REJECTED.labels().value)
+
+    def test_latency(self):
+        for duration in (2, 0.1, 2, 0.1):
+            self.request(False, duration)
+        self.assertEqual(nexmoclient.OPEN, self.breaker.state)
+
+    def test_window(self):
+        for failed in (True, True, False):
+            self.request(failed)
+        self.now += 11
+        self.request(False)
+        self.assertEqual(nexmoclient.CLOSED, self.breaker.state)
+        self.assertEqual(1, self.breaker.stats()['window_requests'])
+
+    def test_half_open(self):
+        self.breaker.trip(self.now)
+        self.now += 5
+        self.assertEqual(nexmoclient.HALF_OPEN, self.breaker.stats()['state'])
+        probe = self.breaker.allow()
+        self.assertTrue(probe)
+        self.assertMetricState(nexmoclient.HALF_OPEN)
+        self.assertFalse(self.breaker.allow())
+        self.breaker.record(probe, True, 0.1)
+        self.assertEqual(nexmoclient.OPEN, self.breaker.state)
+        self.assertMetricState(nexmoclient.OPEN)
+        self.now += 5
+        probe = self.breaker.allow()
+        self.assertTrue(probe)
+        self.breaker.record(probe, False, 0.1)
+        self.assertEqual(nexmoclient.CLOSED, self.breaker.state)
+        self.assertMetricState(nexmoclient.CLOSED)
+        self.assertTrue(self.breaker.allow())
+        self.assertEqual(2, self.breaker.stats()['trips'])
+
+    def test_straggler(self):
+        # A request sent before the breaker opened and finishing after the reset timeout is no probe.
+        straggler = self.breaker.allow()
+        for i in range(4):
+            self.request(True)
+        self.assertEqual(nexmoclient.OPEN, self.breaker.state)
+        self.now += 5
+        probe = self.breaker.allow()
+        self.assertTrue(probe)
+        self.breaker.record(straggler, False, 0.1)
+        self.assertEqual(nexmoclient.HALF_OPEN, self.breaker.state)
+        self.assertFalse(self.breaker.allow())
+        self.breaker.record(probe, True, 0.1)
+        self.assertEqual(nexmoclient.OPEN, self.breaker.state)
+        # Nor does it count once the breaker closed again.
+        self.now += 5
+        self.breaker.record(self.breaker.allow(), False, 0.1)
+        self.assertEqual(nexmoclient.CLOSED, self.breaker.state)
+        self.breaker.record(straggler, True, 0.1)
+        self.assertEqual(0, self.breaker.stats()['window_requests'])
+
+
+
+class StubNexmoHandler(RequestHandler):
+    """Answers Nexmo API requests with the statuses in 'statuses', one per request.
+    """
+    statuses = []
+    requests = []
+
+    def get(self):
+        self.requests.append(self.request)
+        status = self.statuses.pop(0) if self.statuses else '0'
+        if status == 'http_503':
+            raise HTTPError(503)
+        self.write({'message-count': '1', 'messages': [{'status': status, 'message-id': str(len(self.requests))}]})
+
+    post = get
+
+
+class NexmoClientTestCase(AsyncHTTPTestCase):
+    """Tests sending messages to a stub Nexmo service.
+    """
+
+    def get_app(self):
+        StubNexmoHandler.statuses = []
+        StubNexmoHandler.requests = []
+        return Application([(r'/sms/json', StubNexmoHandler)])
+
+    def get_client(self, **kwargs):
+        kwargs.setdefault('retry_policy', nexmoclient.RetryPolicy(3, 10, base_delay=0.01))
+        return nexmoclient.AsyncNexmoClient('key', 'secret', domain='127.0.0.1:%d' % self.get_http_port(), **kwargs)
+
+    @gen_test
+    def test_send(self):
+        client = self.get_client()
+        self.assertEqual(['1'], (yield client.send('Sender', '+49176123456', u'Test message')))
+        self.assertEqual(1, client.stats()['attempts_sent'])
+
+    @gen_test
+    def test_post(self):
+        client = self.get_client(http_client='simple')
+        self.assertTrue((yield client.send('Sender', '+49176123456', u'Test message')))
+        request = StubNexmoHandler.requests[0]
+        self.assertEqual('POST', request.method)
+        self.assertEqual('', request.query)
+        self.assertEqual(['secret'], request.body_arguments['api_secret'])
+        self.assertEqual(['0049176123456'], request.body_arguments['to'])
+
+    @gen_test
+    def test_retry(self):
+        StubNexmoHandler.statuses = ['1', 'http_503']
+        client = self.get_client()
+        self.assertTrue((yield client.send('Sender', '+49176123456', u'Test message')))
+        stats = client.stats()
+        self.assertEqual(3, stats['attempts'])
+        self.assertEqual(2, stats['retries'])
+
+    @gen_test
+    def test_retry_gives_up(self):
+        StubNexmoHandler.statuses = ['1', '1', '1']
+        client = self.get_client()
+        self.assertFalse((yield client.send('Sender', '+49176123456', u'Test message')))
+        self.assertEqual(1, client.stats()['gave_up'])
+
+    @gen_test
+    def test_permanent_error(self):
+        StubNexmoHandler.statuses = ['4']
+        client = self.get_client()
+        self.assertFalse((yield client.send('Sender', '+49176123456', u'Test message')))
+        self.assertEqual(1, len(StubNexmoHandler.requests))
+
+    @gen_test
+    def test_circuit_breaker(self):
+        StubNexmoHandler.statuses = ['http_503', 'http_503']
+        client = self.get_client(retry_policy=nexmoclient.RetryPolicy(1),
+                                 circuit_breaker=nexmoclient.CircuitBreaker(min_requests=2))
+        for i in range(2):
+            self.assertFalse((yield client.send('Sender', '+49176123456', u'Test message')))
+        with self.assertRaises(nexmoclient.NexmoUnavailableError):
+            yield client.send('Sender', '+49176123456', u'Test message')
+        results = yield client.send_many('Sender', ['+49176123456', 'invalid'], u'Test message')
+        self.assertEqual([None, False], results)
+        self.assertEqual(2, len(StubNexmoHandler.requests))
+        self.assertEqual(nexmoclient.OPEN, client.stats()['circuit_breaker']['state'])
+
+
+
+class GeoIPResolverTestCase(unittest.TestCase):
+    """Tests country lookups by IP address.
+    """
+
+    def setUp(self):
+        self.resolver = GeoIPResolver(pygeoip.GeoIP('GeoIP.dat', pygeoip.MEMORY_CACHE),
+                                      pygeoip.GeoIP('GeoIPv6.dat', pygeoip.MEMORY_CACHE))
+
+    def test_lookup(self):
+        self.assertEqual('DE', self.resolver.country_code_by_addr('85.214.132.117'))
+        self.assertEqual('US', self.resolver.country_code_by_addr('2001:4860:4860::8888'))
+        self.assertEqual('US', self.resolver.country_code_by_addr('::ffff:8.8.8.8'))
+        self.assertEqual(None, self.resolver.country_code_by_addr('127.0.0.1'))
+        self.assertEqual(None, self.resolver.country_code_by_addr('not an ip'))
+
+    def test_cache(self):
+        for i in range(3):
+            self.assertEqual('DE', self.resolver.country_code_by_addr('85.214.132.117'))
+        self.assertEqual(2, self.resolver.stats()['hits'])
+        self.assertEqual(1, self.resolver.stats()['misses'])
+
+
+
+class RangeGeoIPTestCase(unittest.TestCase):
+    """Tests if the compiled GeoIP range arrays match pygeoip.
+    """
+
+    def assert_matches_pygeoip(self, filename, ipv6, corpus):
+        expected = pygeoip.GeoIP(filename, pygeoip.MEMORY_CACHE)
+        engine = RangeGeoIP(filename, ipv6)
+        results = [expected.country_code_by_addr(addr) for addr in corpus]
+        self.assertEqual(results, [engine.country_code_by_addr(addr) for addr in corpus])
+        self.assertEqual(results, engine.country_codes_by_addrs(corpus))
+
+    def test_ipv4(self):
+        random.seed(4)
+        corpus = [socket.inet_ntoa(struct.pack('>I', random.getrandbits(32))) for _ in range(5000)]
+        self.assert_matches_pygeoip('GeoIP.dat', False, corpus + ['0.0.0.0', '255.255.255.255'])
+
+    def test_ipv6(self):
+        random.seed(6)
+        corpus = [socket.inet_ntop(socket.AF_INET6, struct.pack('>QQ', random.getrandbits(61) | 1 << 61,
+                                                                random.getrandbits(64)))
+                  for _ in range(5000)]
+        self.assert_matches_pygeoip('GeoIPv6.dat', True, corpus + ['2001:4860:4860::8888', 'ffff::'])
+
+    def test_invalid_addresses(self):
+        engine = RangeGeoIP('GeoIP.dat')
+        self.assertEqual(['US', None], engine.country_codes_by_addrs(['8.8.8.8', 'not an ip']))
+
+    @unittest.skipIf(geolocation.numpy is None, 'NumPy is not installed')
+    def test_mmap_cache(self):
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        filename = os.path.join(path, 'GeoIPv6.dat')
+        shutil.copy('GeoIPv6.dat', filename)
+        addrs = ['2001:4860:4860::8888', 'ffff::', '::ffff:8.8.8.8']
+        expected = [RangeGeoIP('GeoIPv6.dat', True).country_code_by_addr(addr) for addr in addrs]
+        for _ in range(2):
+            # Compiles the cache file first, then maps the existing one.
+            engine = RangeGeoIP(filename, True, mmap_cache=True)
+            self.assertTrue(engine.mapped)
+            self.assertTrue(os.path.exists(filename + '.ranges'))
+            self.assertEqual(expected, [engine.country_code_by_addr(addr) for addr in addrs])
+            self.assertEqual(expected, engine.country_codes_by_addrs(addrs))
+
+    @unittest.skipIf(geolocation.numpy is None, 'NumPy is not installed')
+    def test_invalid_mmap_cache(self):
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        filename = os.path.join(path, 'GeoIP.dat')
+        shutil.copy('GeoIP.dat', filename)
+        RangeGeoIP(filename, mmap_cache=True)
+        with open(filename + '.ranges', 'rb') as f:
+            valid = f.read()
+        # Truncated and foreign cache files are compiled again.
+        for content in (valid[:len(valid) // 2], 'not a ranges file', ''):
+            with open(filename + '.ranges', 'wb') as f:
+                f.write(content)
+            engine = RangeGeoIP(filename, mmap_cache=True)
+            self.assertTrue(engine.mapped)
+            self.assertEqual('US', engine.country_code_by_addr('8.8.8.8'))
+            with open(filename + '.ranges', 'rb') as f:
+                self.assertEqual(valid, f.read())
@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+# coding=UTF-8
+# Title:       worker.py
+# Description: Sends the messages queued by the application in queue mode.
+# Author       David Nellessen <david.nellessen@familo.net>
+# Date:        16.10.26
+# Note:        Takes the same Nexmo and Redis options as app.py
+# ==============================================================================
+
+# Import modules
+import logging
+import os
+import signal
+import tornado.ioloop
+import tornado.options
+from tornado.options import define
+import app
+import nexmoclient
+import redispool
+import sendqueue
+
+
+# Define command line parameters. Nexmo and Redis options are defined in app.
+define('worker_batch_size', default=int(os.environ.get('WORKER_BATCH_SIZE', 50)), type=int, help='Number of jobs taken from the queue at once (default 50)')
+define('worker_concurrency', default=int(os.environ.get('WORKER_CONCURRENCY', 20)), type=int, help='Maximum number of messages sent at a time (default 20)')
+define('worker_poll_interval', default=float(os.environ.get('WORKER_POLL_INTERVAL', 0.5)), type=float, help='Seconds between polls of an empty queue (default 0.5)')
+define('worker_visibility_timeout', default=int(os.environ.get('WORKER_VISIBILITY_TIMEOUT', 0)), type=int, help='Seconds after that jobs taken by a worker that died are queued again, 0 derives it from the batch size, concurrency and Nexmo timeouts (default 0)')
+
+
+class Worker(object):
+    """
+    Holds the Redis pool and the SendWorker of a worker process. It
+    provides the 'redis' member the SendQueue makes use of.
+    """
+    def __init__(self, redis_pool, nexmo_client, batch_size=50, concurrency=20, poll_interval=0.5,
+                 visibility_timeout=None):
+        self.redis_pool = redis_pool
+        self.queue = sendqueue.SendQueue(self)
+        self.sender = sendqueue.SendWorker(self.queue, nexmo_client, batch_size, concurrency, poll_interval,
+                                           visibility_timeout)
+
+    @property
+    def redis(self):
+        return self.redis_pool.get()
+
+
+def main():
+    """
+    Main function to start a worker. It runs until it receives SIGTERM or
+    SIGINT and then finishes the messages it already took from the queue.
+    """
+    tornado.options.parse_command_line()
+    options = tornado.options.options
+    io_loop = tornado.ioloop.IOLoop.instance()
+    nexmo_client = nexmoclient.AsyncNexmoClient(options.nexmo_api_key, options.nexmo_api_secret,
+                                                options.nexmo_domain, options.nexmo_endpoint, options.nexmo_ssl,
+                                                options.nexmo_long_virtual_number, options.nexmo_dlr_url,
+                                                options.development_mode, None, options.nexmo_send_concurrency,
+                                                options.nexmo_send_rate, options.nexmo_max_in_flight,
+                                                nexmoclient.RetryPolicy(options.nexmo_retry_attempts,
+                                                                        options.nexmo_retry_deadline),
+                                                options.nexmo_http_client, options.nexmo_connect_timeout,
+                                                options.nexmo_request_timeout,
+                                                nexmoclient.CircuitBreaker(options.nexmo_breaker_error_rate,
+                                                                           options.nexmo_breaker_latency,
+                                                                           reset_timeout=options.nexmo_breaker_reset_timeout))
+    redis_pool = redispool.RedisPool(options.redis_host, options.redis_port, options.redis_password, options.redis_db,
+                                     size=options.redis_pool_size,
+                                     health_check_interval=options.redis_health_check_interval, io_loop=io_loop)
+    worker = Worker(redis_pool, nexmo_client, options.worker_batch_size, options.worker_concurrency,
+                    options.worker_poll_interval, options.worker_visibility_timeout)
+
+    def on_signal(signum, frame):
+        logging.info('Stopping worker after the current jobs')
+        io_loop.add_callback_from_signal(worker.sender.stop)
+    signal.signal(signal.SIGTERM, on_signal)
+    signal.signal(signal.SIGINT, on_signal)
+
+    def on_ready(status):
+        logging.info('Worker connected to Redis, processing queue')
+        io_loop.add_future(worker.sender.run(), lambda future: io_loop.stop())
+    redis_pool.connect(callback=on_ready)
+    io_loop.start()
+    logging.info('Worker stopped: {}'.format(worker.sender.stats()))
+
+
+# Run main method if script is run from command line.
+if __name__ == "__main__":
+    main()